@@ -15,8 +15,21 @@ import lxml.etree as ET
 #import xml.etree.ElementTree as ET
 import configparser
 import argparse
+import ast
 import hashlib
+import json
 import logging
+import logging.handlers
+import atexit
+import contextlib
+import functools
+import tracemalloc
+import concurrent.futures
+import math
+import mmap
+import threading
+import cProfile
+import time
 #import uuid
 import glob
 import csv
@@ -65,297 +78,441 @@ def is_equal_except(dict1,dict2,not_key):
 def bold(message):
     return(color.BOLD+message+color.END)
 
+
+#the most entries kept by each memo cache (parsed stash codes, uuid hashes, compiled and split expressions)
+#comfortably more than one suite and the mappings need, but bounded as the daemon and async runner resolve
+#many suites in one long-lived process
+MEMO_SIZE=16384
+
 def is_subset(subset_dict, main_dict):
     return all(main_dict.get(key) == value for key, value in subset_dict.items())
 
- 
-def read_cf_mappings():
+
+class Profiler:
     '''
-    read the cf mappings from the mappings files linked to from the config file
+    records wall time, cpu time and optionally peak (traced) memory for each pipeline stage,
+    call counts and times for the main per-diagnostic methods, and the time taken by each row of the cf diagnostics file
+    does nothing (beyond a flag check) unless start() has been called - i.e. --profile was given
+    memory is only traced with --profile_memory - tracemalloc slows every allocation, so the times it reports
+    are not comparable with the times of a run without it
+    the stage stack and recursion depths are kept per thread, and the records are updated under a lock,
+    so stages timed in several threads at once (cf_to_um_async.py, load_reference) don't interfere
     '''
-    cf_mappings = configparser.ConfigParser()   
-    # turn of the lowercaseization of keys
-    cf_mappings.optionxform = lambda option: option
-    #configFilePath = 'common_mappings.cfg'
-    configFilePath = main_config['main']['mappings']
-    if ',' in configFilePath:
-       #this contains multiple config files, split into a list
-       configFilePaths=configFilePath.split(',')
-       for path in configFilePaths:
-          if not os.path.isfile(path):
-             plog("ROSE conf file "+path+" does not exist")
-             exit()
+    def __init__(self):
+        self.enabled=False
+        self.memory=False
+        self.stages={} # stage name -> {'calls','wall','cpu'} and 'peak' if memory is traced
+        self.functions={} # function name -> {'calls','wall','cpu'}
+        self.diagnostics=[] # [row, wall, cpu] for every row
+        self.local=threading.local() # stack and depth of this thread
+        self.lock=threading.Lock()
+        self.cprofile=None
+        self.dump_file=None
+
+    @property
+    def stack(self):
+        #names and running peaks of the stages this thread is currently inside
+        if not hasattr(self.local,'stack'):
+            self.local.stack=[]
+        return(self.local.stack)
+
+    @property
+    def depth(self):
+        #recursion depth of each timed function in this thread - only the outermost call is timed
+        if not hasattr(self.local,'depth'):
+            self.local.depth={}
+        return(self.local.depth)
+
+    def start(self,dump_file=None,memory=False):
+        self.enabled=True
+        self.memory=memory
+        if memory:
+            tracemalloc.start()
+        if dump_file:
+            self.dump_file=dump_file
+            self.cprofile=cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        '''
+        time a pipeline stage - stages can be nested, and are reported as parent/child
+        '''
+        if not self.enabled:
+            yield
+            return
+        #peak memory is tracked across nested stages by handing each child's peak up to its parent
+        if self.memory:
+            peak=tracemalloc.get_traced_memory()[1]
+            if self.stack:
+                self.stack[-1][1]=max(self.stack[-1][1],peak)
+            tracemalloc.reset_peak()
+        full_name='/'.join([item[0] for item in self.stack]+[name])
+        #create the record now, so that parents are listed before their children
+        with self.lock:
+            record=self.stages.setdefault(full_name,{'calls':0,'wall':0.0,'cpu':0.0})
+            if self.memory:
+                record.setdefault('peak',0)
+        self.stack.append([name,0])
+        wall0=time.perf_counter()
+        cpu0=time.process_time()
+        try:
+            yield
+        finally:
+            wall=time.perf_counter()-wall0
+            cpu=time.process_time()-cpu0
+            name,child_peak=self.stack.pop()
+            if self.memory:
+                peak=max(tracemalloc.get_traced_memory()[1],child_peak)
+                if self.stack:
+                    self.stack[-1][1]=max(self.stack[-1][1],peak)
+                tracemalloc.reset_peak()
+            with self.lock:
+                record['calls']+=1
+                record['wall']+=wall
+                record['cpu']+=cpu
+                if self.memory:
+                    record['peak']=max(record['peak'],peak)
+
+    @contextlib.contextmanager
+    def diagnostic(self,name):
+        #time a single row of the cf diagnostics file
+        if not self.enabled:
+            yield
+            return
+        wall0=time.perf_counter()
+        cpu0=time.process_time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.diagnostics.append([name,time.perf_counter()-wall0,time.process_time()-cpu0])
+
+    def timed(self,name):
+        '''
+        decorator - counts calls to a function and times the outermost call of any recursion
+        '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args,**kwargs):
+                if not self.enabled:
+                    return(func(*args,**kwargs))
+                depth=self.depth.get(name,0)
+                with self.lock:
+                    record=self.functions.setdefault(name,{'calls':0,'wall':0.0,'cpu':0.0})
+                    record['calls']+=1
+                if depth>0:
+                    return(func(*args,**kwargs))
+                self.depth[name]=1
+                wall0=time.perf_counter()
+                cpu0=time.process_time()
+                try:
+                    return(func(*args,**kwargs))
+                finally:
+                    with self.lock:
+                        record['wall']+=time.perf_counter()-wall0
+                        record['cpu']+=time.process_time()-cpu0
+                    self.depth[name]=0
+            return(wrapper)
+        return(decorator)
+
+    def as_dict(self,top=10):
+        slowest=sorted(self.diagnostics,key=lambda x:x[1],reverse=True)[:top]
+        return({'stages':self.stages,
+                'functions':self.functions,
+                'diagnostics':{'count':len(self.diagnostics),
+                               'wall':sum(x[1] for x in self.diagnostics),
+                               'cpu':sum(x[2] for x in self.diagnostics),
+                               'slowest':slowest}})
+
+    def report(self,top=10):
+        '''
+        log a breakdown table of the stages, timed functions and the top slowest diagnostics
+        '''
+        psummary("")
+        psummary(bold("Profile"))
+        if self.memory:
+            psummary("(times include the tracemalloc overhead of --profile_memory)")
+        psummary(f'{"stage":48} {"calls":>6} {"wall(s)":>9} {"cpu(s)":>9}'+(f' {"peak(MB)":>9}' if self.memory else ''))
+        for name in self.stages:
+            record=self.stages[name]
+            #indent child stages under their parent
+            label='  '*name.count('/')+name.split('/')[-1]
+            psummary(f'{label:48} {record["calls"]:6d} {record["wall"]:9.3f} {record["cpu"]:9.3f}'+
+                     (f' {record["peak"]/2**20:9.1f}' if self.memory else ''))
+        if self.functions:
+            psummary("")
+            psummary(f'{"function":48} {"calls":>6} {"wall(s)":>9} {"cpu(s)":>9}')
+            for name in sorted(self.functions,key=lambda x:self.functions[x]['wall'],reverse=True):
+                record=self.functions[name]
+                psummary(f'{name:48} {record["calls"]:6d} {record["wall"]:9.3f} {record["cpu"]:9.3f}')
+        if self.diagnostics:
+            psummary("")
+            psummary(f'{"slowest diagnostics":48} {"":>6} {"wall(s)":>9} {"cpu(s)":>9}')
+            for name,wall,cpu in sorted(self.diagnostics,key=lambda x:x[1],reverse=True)[:top]:
+                psummary(f'{name:55} {wall:9.3f} {cpu:9.3f}')
+
+    def finish(self,top=10,json_file=None):
+        #stop profiling, write the cProfile and json dumps if requested, and report
+        if not self.enabled:
+            return()
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump_file)
+            plog("Written cProfile stats to "+self.dump_file)
+        if json_file:
+            with open(json_file,'w') as outfile:
+                json.dump(self.as_dict(top),outfile,indent=1)
+            plog("Written profile to "+json_file)
+        self.report(top)
+        self.enabled=False
+        if self.memory:
+            tracemalloc.stop()
+
+profiler=Profiler()
 
-       cf_mappings.read(configFilePaths)
-    else:
-       if not os.path.isfile(configFilePath):
-          plog("ROSE conf file "+configFilePath+" does not exist")
-          exit()
-       cf_mappings.read(configFilePath)
-    return(cf_mappings)
+ 
+#############  Atmosphere/Land class for UM
+#lines 1 and 2 of each STASHmaster record - the type, and the rest of the line after the first |
+stashmaster_records=re.compile(rb'^([12])\|([^\n]*)',re.MULTILINE)
 
 
-def diags_from_expression(diag):
-    '''
-    extracts the stash codes, nemo and cice  and cf_diags from the mapping expression for diag
-    '''
-    expression0=cf_mappings[diag]['expression']
-    
-    nemo_cice_diags=[]
+def to_int(value):
+    #a rose value as an int, or None if it isn't one
+    try:
+        return(int(value))
+    except (TypeError,ValueError):
+        return(None)
 
-    
-    #    if 'umo' in diag:
-    #        import pdb; pdb.set_trace()
-    
-    #Run through expression and extract all the UM stashcodes and other diagnostic names
-   
-    #remove any \n
-    expression=expression0.replace('\n',' ')
-    #extract any UM stash codes
-    pattern_s = r'm\d{2}s\d{2}i\d{3}\[.*?\]'
-    um_diags = re.findall(pattern_s, expression)
-    #remove any stash codes of the form mNNsNNiNN[XXX]
-    #[XXX] defines the meaning and levels etc
-    expression = re.sub(pattern_s,'', expression)
-    #extract all UM stash codes that do not have a following [XXX]
-    pattern_s = r'm\d{2}s\d{2}i\d{3}'
-    um_diags_nobracket = re.findall(pattern_s, expression)
-    #remove any stash codes of the form mNNsNNiNN
-    expression = re.sub(pattern_s,'', expression)
-    #remove any functions of the form 'function('
-    pattern=r'[0-9a-z_]+\('
-    expression=re.sub(pattern,'',expression)
-    #replace '*' by space - as some expressions don't include spaces around *!
-    expression=expression.replace('*',' ')
-    #remove commas,  + - and and ( or )
-    translation_table = str.maketrans("", "", ",+-/()")
-    expression=expression.translate(translation_table)
-    #Now split into parts
-    sub_diags=[x for x in expression.split(' ') if x !='']
-    if sub_diags:
-        for sub_diag in sub_diags:
-            #does this string contain any lower case letters?
-            lower_case=re.search(r'[a-z]',sub_diag)
-            if lower_case:
-                #this should contain a nemo or cice diagnostic
-                if not ('=' in sub_diag or 'mask' in sub_diag or '_0' in sub_diag):
-                    #if sub_diag contains an '=' this is probably a mask argument - so we can ignore
-                    #if sub_diag contains 'mask' it is probably a mask - so we can ignore
-                    #if sub_diag contains '_0' it is probably a REFERENCE diag from another experiment - so we will ignore it
-                    #let's remove any square bracket expressions remaining (eg thetao[depth<2025])
-                    sub_diag=re.sub('\[.*?\]','',sub_diag)
-                    nemo_cice_diags.append(sub_diag)
-    #convert to list if unique elements 
-    um_diags=list(set(um_diags))
-    um_diags_nobracket=list(set(um_diags_nobracket))
-    nemo_cice_diags=list(set(nemo_cice_diags))
-    
-    return(um_diags,um_diags_nobracket,nemo_cice_diags)
 
-def add_nemo_cice_diagnostic(diag,freq,dims):
+def unquote(value):
+    #a rose string value without its quotes, interned - eg "'UPMEAN'" -> 'UPMEAN'
+    return(sys.intern(value.replace("'","")))
+
+
+class StashCode:
     '''
-    Adds a single diag directly to ocean or ice
+    a stash code as written in a mapping expression (eg m01s03i236[lbproc=128]), split into its parts once
+    code is the bare stash code, isec and item are kept as text for the section names and as ints for comparisons
+    options are the [..] settings - they are shared by every use of the code, so must not be changed
     '''
-        #Here the diag has no CF mapping OR we have no um diags, and only 1 nemo or cice diag and this points back to itself (e.g evs -> evs )
-    #We need to look in the NEMO and CICE diagnostics for the final mappings
-    if diag=='ice_present':
-        #mappings in common_mappings.cfg is wrong for sitimefrac !
-        #ice_present in the confing by ice_history_shared.F90 is f_icepresent
-        #           fdiag='f_icepresent'
-        #        else:
-        #           fdiag='f_'+this_expression
-        diag='icepresent'
+    __slots__=('code','model','isec','item','key','options')
 
-    #is diag a cice diagnostic?
-    if 'f_'+diag in cice.cice_diagnostics:
-        plog(diag+" is a CICE diagnostic, adding..")
-        cice.addIceDiag('f_'+diag,freq,dims)
-        return()
+    def __init__(self,text):
+        match=re.match(r'm(\d{2})s(\d{2})i(\d{3})(?:\[(.*?)\])?',text)
+        self.model,self.isec,self.item,options=match.groups()
+        self.code=sys.intern('m'+self.model+'s'+self.isec+'i'+self.item)
+        self.key=(int(self.isec),int(self.item))
+        self.options={}
+        if options is not None:
+            self.options=dict(pair.split('=') for pair in options.split(','))
 
 
-    
-    #Here diag is either a nemo diag that exists in the xml definitions or it is undefined
-    #Check all the XML definitions
-        
-    #either diag is NOT defined in the mapping tables, OR it IS, but the definition is circular! (eg umo -> umo )
-    fields=nemo.nemo_full_diagnostics.findall(".//field[@name='"+diag+"']")
-    if len(fields)>0:
-        #we found a matching diagnostics in the NEMO defined diagnostics
-        plog("Adding NEMO diag "+diag)
-        nemo.addOceanDiag(diag,freq,dims)     
-        return()
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def parse_stash_code(text):
+    return(StashCode(text))
 
-    fields=nemo.nemo_diagnostic_request.findall(".//field[@name='"+diag+"']")
-    if len(fields)>0:
 
-        #we found a matching diagnostics in the NEMO user defined diagnostics
-        plog("Adding NEMO diag "+diag)
-        new_line=dict(line)
-        new_line['variable']=diag
-        nemo.addOceanDiag(diag,freq,dims)
-        return()
+def custom_sort(item):
+    #custom sort for secton items that should ignore the prefix "!!"
+    return(item[0].lstrip('!!'))
 
-        
-    #is this diagnostics just commented out in the user defined diagnostics?
-    found_in_comments=False
-    for off_diag in nemo.nemo_diagnostic_request_off:
-        fields=off_diag.findall(".//field[@name='"+diag+"']")
-        if len(fields)==1:
-            plog(diag+" found in the commented out diagnostics")
-            plog("uncommenting "+diag)
-            
-            this_freq=nemo.freq_map[freq]
-            file_group=nemo.get_file_group(this_freq)
-            #does this diag have a parent in the off_diag?
-            parent=fields[0].getparent()
-            if len(parent)==0:
-               plog("No parent found for "+diag+" in comments!")
-               import pdb; pdb.set_trace()
-            this_name_suffix=parent.attrib['name_suffix']
 
-            #is there an EXISTING file within this filegroup that has this suffix
-            existing_file=file_group.findall(".//file[@name_suffix='"+this_name_suffix+"']")
-            if not existing_file:
-                #no - so we need to add it
-                this_id=parent.attrib['id']
-                if this_id in nemo.file_element_id_list:
-                    #a file with this ID already exists
-                    #Need to add one
-                    new_file_id=nemo.get_unique_file_id()
-                    parent.attrib['id']=new_file_id
-                if not 'output_freq' in parent.attrib:
-                    #add a output_freq if there is not one already
-                    parent.attrib['output_freq']=this_freq
-                plog("Adding new file element for "+this_name_suffix)
-                new_file_element=ET.SubElement(file_group,'file')
-                new_file_element.attrib.update(dict(parent.attrib))
+def uuid_items(section):
+    #the items of a rose section that go into its uuid hash, in order - the frozen form the hash is memoised on
+    if 'isec' in section:
+        #this must be a streq:
+        return(tuple((key,str(section[key])) for key in section))
+    #must be domain or use or something?
+    #if so, we want to exclude the NAME label from the hash calclation
+    #this allows us to compare sections that are identical, except for the names
+    return(tuple((key,str(section[key])) for key in section if not key in ['use_name','dom_name','tim_name']))
 
-            #add this field to the file group
-            plog(this_name_suffix)
-            #SOMETHING GOING WRONG HERE!
-            nemo.add_field_to_file_group(fields[0],file_group,this_name_suffix)
-            return()
-            #What is the best way to uncomment this?
-            #Need to go Into addOceanDiag somewhrer
-        if len(fields)>1:
-           plog("Too many  matches of "+diag+" in the comment fields!")
-           import pdb; pdb.set_trace()
 
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def uuid_hash(items):
+    #computes the correct hash for this stash (as in TidyStashValidate in stash_indices.py)
+    text=''
+    #sort the keys, ignoring the '!!' prefix during the sort
+    for key,value in sorted(items,key=custom_sort):
+        #sometimes the value can come from a multi-line and may have \n and = - remove these for the uuid hash
+        text+=key+'='+value.replace('\n','').replace('=','')+'\n'
+    return(hashlib.sha1(text.encode(encoding="utf8")).hexdigest()[:8])
 
-    if check_output:
-        nemo.nc_check_ocean(diag,freq,dims)
-    #if we are here - we didn't find the diag anywhere!
-    plog(diag+" not found in anywhere in NEMO diagnostics definitions")
-    nemo.missing.append(diag)
 
-                    
-def add_cf_diagnostic(diag,freq,dims):
+#Typed records of the STASH sections in the rose and CMIP6 reference confs
+#these are read once, so adding a diagnostic compares ints and names rather than reading ConfigParser sections,
+#and new STASH requests are only turned into rose sections when the STASH is written
+
+class StashRequest:
     '''
-    add a cf diagnostic
-    using the CF mappings (*cfg) from mipconvert
-    a cf_diagnostic from a given realm (e.g. ocean) may map to a function of diagnostics from the UM, NEMO and CICE AND other cf_diagnostics
-    cf_diag = function( UM_diag, NEMO_diag, CICE_diag, cf_diag_2)
-    where cf_diag_2 can be ANOTHER cf_diagnostic that in turn needs mapping
-    Sometimes cf mappings will map to themselves - this implies they are variables intrinsic to the model (eg NEMO or CICE)
+    a umstash_streq - a STASH code output on a domain with a time profile and usage
+    section is the name of the rose section it came from (or will be written to)
     '''
-    
-    plog(">>>>>>  "+diag)
+    __slots__=('isec','item','dom_name','tim_name','use_name','package','ens_name','section','_hash')
+
+    def __init__(self,isec,item,dom_name,tim_name,use_name,package="'EXTRA'",ens_name="''",section=None):
+        self.isec=isec
+        self.item=item
+        self.dom_name=dom_name
+        self.tim_name=tim_name
+        self.use_name=use_name
+        self.package=package
+        self.ens_name=ens_name
+        self.section=section
+        self._hash=hash(self.canonical())
+
+    @classmethod
+    def from_section(cls,name,section):
+        return(cls(to_int(section['isec']),to_int(section['item']),sys.intern(section['dom_name']),
+                   sys.intern(section['tim_name']),sys.intern(section['use_name']),
+                   section.get('package'),section.get('ens_name'),name))
+
+    def canonical(self):
+        return((self.isec,self.item,self.dom_name,self.tim_name,self.use_name))
+
+    def __eq__(self,other):
+        return(isinstance(other,StashRequest) and self.canonical()==other.canonical())
+
+    def __hash__(self):
+        return(self._hash)
+
+    def as_section(self):
+        #the rose namelist items, as they are written
+        return({'dom_name':self.dom_name,
+                'ens_name':self.ens_name,
+                'isec':str(self.isec),
+                'item':str(self.item),
+                'package':self.package,
+                'tim_name':self.tim_name,
+                'use_name':self.use_name})
+
+
+def canonical_value(value):
+    #a rose value in a form that compares the same however it is written - 01 and 1, .TRUE. and .true., 1,2 and 1, 2
+    value=value.strip()
+    if ',' in value:
+        return(tuple(canonical_value(item) for item in value.split(',')))
+    for convert in [int,float]:
+        try:
+            return(convert(value))
+        except ValueError:
+            pass
+    if value.startswith('.') and value.endswith('.'):
+        return(value.lower())
+    return(value)
+
+
+class SpaceDomain:
+    '''
+    a umstash_domain - the output levels (iopl), pseudo level type (plt) and pseudo level list as ints
+    two domains are equal if their active items are, whatever their names
+    '''
+    __slots__=('name','section','iopl','plt','pslist','items','_hash')
+
+    def __init__(self,name,section):
+        self.section=name
+        self.name=sys.intern(section['dom_name'])
+        self.iopl=to_int(section.get('iopl'))
+        self.plt=to_int(section.get('plt'))
+        self.pslist=None
+        if 'pslist' in section:
+            pslist=[to_int(num) for num in section['pslist'].split(',')]
+            if not None in pslist:
+                self.pslist=tuple(pslist)
+        self.items=frozenset((key,section[key]) for key in section
+                             if not (('!!' in key) or ('meta' in key) or key=='dom_name'))
+        self._hash=hash(self.items)
+
+    def __eq__(self,other):
+        return(isinstance(other,SpaceDomain) and self.items==other.items)
+
+    def canonical(self):
+        #what the UM does with this domain - the levels, pseudo levels, masks etc with their values normalised
+        #a range of levels (ilevs=1, levb to levt) is the same as the list of those levels (ilevs=2, levlst)
+        values={key:canonical_value(value) for key,value in self.items}
+        if values.get('ilevs')==1 and isinstance(values.get('levb'),int) and isinstance(values.get('levt'),int):
+            values['ilevs']=2
+            values['levlst']=tuple(range(values.pop('levb'),values.pop('levt')+1))
+        for key in ['levlst','rlevlst','pslist']:
+            if key in values and not isinstance(values[key],tuple):
+                values[key]=(values[key],)
+        return(frozenset(values.items()))
+
+    def __hash__(self):
+        return(self._hash)
+
+
+class TimeProfile:
+    '''
+    a umstash_time - matched against the part time profiles in UM.tim_dom
+    '''
+    __slots__=('name','section','values','items','_hash')
 
-    ##HERE we need to proceed if the diag is in cf_mappings
-    ##IF it is, but the expression points back to itself - need to map to natice nemo or cice
-    ##IF it is NOT, we need to map to native nemo or cice 
-    
-    
-    #if not diag in cf_mappings:
-    #   print("No mapping for "+diag+" in the mapping files?")
-    #   import pdb; pdb.set_trace()
-    #if 'evs' in diag:
-    #   import pdb; pdb.set_trace()
+    def __init__(self,name,section):
+        self.section=name
+        self.values=dict(section)
+        self.name=sys.intern(self.values['tim_name'])
+        #XIOS time profiles have an extra ts_enabled item, which is ignored when comparing
+        self.items=frozenset((key,value) for key,value in self.values.items()
+                             if not (('!!' in key) or ('meta' in key) or key in ['ts_enabled','tim_name']))
+        self._hash=hash(self.items)
 
-    
-    nemo_cice_diags=[]
-    
-    if diag in cf_mappings:
-        #diag has a mapping in cf_mappings - work through each term in the mapping expression and add each sub diagnostic in that expression
-        um_diags,um_diags_nobracket,nemo_cice_diags=diags_from_expression(diag)
- 
-        # if we have no um diags, and only 1 nemo or cice diag and this points back to itself (e.g evs -> evs )
-        # then we probably have a native nemo or cice diag and need to move on to searches in the xml and conf files
-        # We NOT this here for all the other cases 
-        if not (len(nemo_cice_diags)==1 and nemo_cice_diags[0]==diag and len(um_diags)==0 and len(um_diags_nobracket)==0):
-            #Now add the UM diags
-            for um_diag in um_diags:
-                if diag==um_diag:
-                    #this is the should never happen!
-                    import pdb; pdb.set_trace()
-                #plog("Add "+um_diag)
-                um.add_stash(um_diag,freq,dims)
-               
-                
-                #WHAT ABOUT [] heres? blev and lbproc, lblev? 
-                #um.add_stash(um_diag,freq,dims)
+    def matches(self,time_filter):
+        return(all(self.values.get(key)==value for key,value in time_filter.items()))
 
-            #And the UM diags with NO post stash brackets
-            for um_diag in um_diags_nobracket:
-                if diag==um_diag:
-                    #this is the should never happen!
-                    import pdb; pdb.set_trace()
-                #plog("Add "+um_diag)
-                um.add_stash(um_diag,freq,dims)
-               
-                #um.add_stash(um_diag,freq,dims)
-
-            #For everything else we need to recurse as these diags may have additional mappings
-            for nemo_cice_diag in nemo_cice_diags:
-                #is nemo_cice_diag a nemo diagnostic?
-                #Skip any Ofx files
-                if nemo_cice_diag in cf_mappings:
-                    if cf_mappings[nemo_cice_diag]['mip_table_id']=='Ofx':
-                        plog(nemo_cice_diag+" is just an Ofx field- skipping")
-                        continue
-                        #skip to next nemo_cice_diag
-                if not nemo_cice_diag==diag:
-                   #only recurse IF we are not about to enter an infinite loop!
-                   # eg  evs -> func (a,b,evs)
-                   
-                   add_cf_diagnostic(nemo_cice_diag,freq,dims)
-                else:
-                   plog("Nemo diag and diag matches!")
-                   plog("Adding "+diag+" directly")
-                   add_nemo_cice_diagnostic(diag,freq,dims)
-                   
+    def canonical(self):
+        #what the UM does with this profile - profiles with the same canonical form can be merged
+        return(self.items)
 
-            return()
+    def __eq__(self,other):
+        return(isinstance(other,TimeProfile) and self.items==other.items)
 
-    #Here the diag has no CF mapping OR we have no um diags, and only 1 nemo or cice diag and this points back to itself (e.g evs -> evs )
-    #We need to look in the NEMO and CICE diagnostics for the final mappings
+    def __hash__(self):
+        return(self._hash)
 
-    if nemo_cice_diags:
-        #we have a single nemo or cice diagnostic that exists in the cf mappings
-        if len(nemo_cice_diags)>1:
-            plog("Something went wrong!")
-            import pdb; pdb.set_trace()
 
-   
-    #Here nemo_cice_diag is either [] OR nemo_cice_diag == diag
-    #so, use diag from here on
+class Usage:
+    '''
+    a umstash_use - a usage name and the output stream (file_id) it writes to
+    key and stream are the name and file_id without their quotes, as used in the [usage] config and xios streams
+    '''
+    __slots__=('name','key','section','file_id','stream')
+
+    def __init__(self,name,section):
+        self.section=name
+        self.name=sys.intern(section['use_name'])
+        self.key=unquote(self.name)
+        self.file_id=section.get('file_id')
+        self.stream=None
+        if self.file_id is not None:
+            self.stream=unquote(self.file_id)
+
+
+def read_records(conf,record_type,tag):
+    #records for all the sections of conf whose names contain tag, in order
+    return([record_type(key,conf[key]) for key in conf.keys() if tag in key])
+
+
+def cmip6_records(cmip6):
+    #the CMIP6 reference domains and time profiles, shared by all the UM instances in a session
+    return({'domains':read_records(cmip6,SpaceDomain,'umstash_domain'),
+            'times':read_records(cmip6,TimeProfile,'umstash_time')})
 
-    add_nemo_cice_diagnostic(diag,freq,dims)
-    return()
-            
-            
 
- 
-#############  Atmosphere/Land class for UM
 class UM:
     #UM stash  class
     # add_cf_diagnostic() adds an atmosphere/land/landice cf variable as the require STASH codes
-    def __init__(self,umOrXIOS):
+    def __init__(self,session,source=None):
         #we can use the STASH in the um app or the STASH in the xml app (for netcdf)
-        #umOrXIOS = 'um' or 'xios'
+        #session.stash_type = 'um' or 'xios'
         #reads in all configuration files
         #and sets up all mappings
+        #source is an optional rose-app.conf to read in place of the suite one (eg the output of a previous run)
 
+        self.session=session
+        self.config=session.config
+        umOrXIOS=session.stash_type
         self.nc_found=[] #list of UM diagnostics found in the NC file during --check_output
         self.nc_missing=[] #list of UM diagnostics missing in the NC file during --check_output
         self.missing=[] # list of diagnostics we failed to add!
@@ -405,29 +562,35 @@ class UM:
         self.rose_time_domain_mappings={}
         self.rose_space_domain_mappings={}
         self.use_matrix={}
-        self.stash_levels={}
-        self.stash_names={}
+        self.usages={} # Usage records by use_name
+        self.stash_requests={} # StashRequest records by (isec, item)
+        self.new_stash_requests=[] # StashRequest records added, written to rose by write()
+        self.section_hashes={} # uuid hash -> names of the streq, domain, time and use sections with that content
+        self.stream_volumes=None # estimated bytes per model year by output stream - see balanced_usage()
         self.stash_pseudo_levels={}  #pseudo level mapping for stash codes
         #Stash mapping
-        self.stashMap = configparser.ConfigParser()  
-        #turn of the lowercaseization of keys
-        self.stashMap.optionxform = lambda option: option
-        self.configFilePath = main_config['main']['mappings']
-        #stashMap.read(configFilePath)
-        self.read_stash_mappings()
-        self.read_STASHmaster_A_levels()
+        self.configFilePath = self.config['main']['mappings']
+        #reference data is shared by all the UM instances in a session
+        #the stash mappings are the same files as the cf mappings, so are only read once
+        with profiler.stage('mappings'):
+            self.cf_to_stash=session.reference_data('cf_mappings')
+        with profiler.stage('STASHmaster_A'):
+            self.stash_names,self.stash_levels=session.reference_data('STASHmaster_A')
         #main rose-app.conf for this Job
         valid_options=['um','xios']
         if umOrXIOS in valid_options:
             if umOrXIOS=='xios':
-                self.rose_stash=main_config['user']['job_path']+'app/xml/rose-app.conf'
+                self.rose_stash=self.config['user']['job_path']+'app/xml/rose-app.conf'
             else:
-                self.rose_stash=main_config['user']['job_path']+'app/um/rose-app.conf'
+                self.rose_stash=self.config['user']['job_path']+'app/um/rose-app.conf'
         else:
             plog(umOrXIOS+" is not a valid UM class type")
             import pdb; pdb.set_trace()
 
-        self.rose,self.rose_header=self.read_rose_app_conf(self.rose_stash)
+        #the file we actually read - normally the suite STASH, but an incremental run starts from the previous output
+        self.rose_source=source if source else self.rose_stash
+        with profiler.stage('suite rose-app.conf'):
+            self.rose,self.rose_header=session.read_suite_file(self.rose_source,UM.read_rose_app_conf)
         #rose,rose_header=self.read_rose_app_conf(rose_stash)
         #CMIP6 map
 
@@ -440,24 +603,27 @@ class UM:
            import pdb; pdb.set_trace()
 
 
-        cmip6_rose=main_config['main']['cmip6']
         #read in standard CMIP6 time and spatial domain definitions
-        self.cmip6,self.cmip6_header=self.read_rose_app_conf(cmip6_rose)
+        with profiler.stage('CMIP6 reference'):
+            self.cmip6,self.cmip6_header=session.reference_data('cmip6')
 
-        #get list of usages in ROSE -> use_list
-        self.get_use_list()
-        #get a dict of mappings of UPX->umstash_use()
-        self.get_cmip6_use_mappings()
-        
-        #matrix mapping time and space to USAGE for output
-        self.get_use_matrix()
+        with profiler.stage('usage'):
+            #index the STASH requests already in ROSE
+            self.read_stash_requests()
+            #get list of usages in ROSE -> use_list
+            self.get_use_list()
+            #get a dict of mappings of UPX->umstash_use()
+            self.get_cmip6_use_mappings()
+
+            #matrix mapping time and space to USAGE for output
+            self.get_use_matrix()
 
         #these are the mappings from the model output domain name to common names
         self.output_replacements={'atmosphere_hybrid_height_coordinate':'model_level_number'}
         #we allow the user to add extra mappings in the config file under [user]:domain_names
-        if 'domain_names' in main_config['user']:
+        if 'domain_names' in self.config['user']:
                 
-            extra_replacements=main_config['user']['domain_names'].replace("'",'').replace('"','').split(',')
+            extra_replacements=self.config['user']['domain_names'].replace("'",'').replace('"','').split(',')
             for extra_rep in extra_replacements:
                 rep_key,rep_val=extra_rep.split(':')
                 self.output_replacements[rep_key]=rep_val
@@ -470,16 +636,28 @@ class UM:
         #If so, use THAT domain label (dom_name) from ROSE
         #otherwise we need to ADD the cmip6 domain to ROSE
         #self.rose_time_domain_mappings=get_time_mappings(freq_mappings)
-        self.get_time_mappings()
+        with profiler.stage('time mappings'):
+            self.get_time_mappings()
 
         #create mappings for space domain cmip6 -> rose
         #as for time domain, but for space domin
         #self.rose_space_domain_mappings=get_space_mappings(space_mappings)
-        self.get_space_mappings()
+        with profiler.stage('space mappings'):
+            self.get_space_mappings()
+
+        #the domains and time profiles in rose (now including any copied across above) and the CMIP6 reference
+        with profiler.stage('records'):
+            self.domains=read_records(self.rose,SpaceDomain,'umstash_domain')
+            self.domains_by_name={}
+            for domain in self.domains:
+                self.domains_by_name.setdefault(domain.name,domain)
+            self.time_profiles=read_records(self.rose,TimeProfile,'umstash_time')
+            self.cmip6_records=session.reference_data('cmip6_records')
+            self.index_sections()
 
 
 
-    def copy_cmip6_tim_dom_to_rose(self,this_cmip6,this_domain):
+    def copy_cmip6_tim_dom_to_rose(self,this_cmip6,this_domain,freq):
         '''
         copy a cmip6 time domain to the rose stash
         '''
@@ -505,6 +683,8 @@ class UM:
         cmip6_time_sub=cmip6_time.split('(')
         cmip6_time_new=cmip6_time_sub[0]+'('+cmip6_time_sub[1].split('_')[0]+'_'+this_uuid+')'
         self.rose[cmip6_time_new]=cmip6_tim_dom_full
+        self.time_profiles.append(TimeProfile(cmip6_time_new,cmip6_tim_dom_full))
+        self.index_section(cmip6_time_new,cmip6_tim_dom_full)
         #import pdb; pdb.set_trace()
 
         self.rose_time_domain_mappings[freq+'_'+this_cmip6['ityp']]=this_cmip6['tim_name']
@@ -552,7 +732,7 @@ class UM:
                 if not this_use in self.use_matrix[this_time][this_domain]:
                     #only add if this use isn't already in the list
                     self.use_matrix[this_time][this_domain].append(this_use)
-                    check_use_already_exists(this_use)
+                    self.check_use_already_exists(this_use)
                     if not this_use in self.use_list:
                         plog("FISH")
                         #this usage does not exist in ROSE
@@ -569,9 +749,9 @@ class UM:
                     #this usage does not exist in ROSE
                     plog("copying usage "+this_use+" to ROSE")
                     #copy usage with name this_use from CMIP6
-                    new_use=self.cmip6[self.cmip6_use_mappings[this_use]]
+                    new_use=dict(self.cmip6[self.cmip6_use_mappings[this_use]])
                     #create a consistent new file id for this usage
-                    new_use['file_id']=create_new_file_id()
+                    new_use['file_id']=self.create_new_file_id()
                     #copy reference to this usage to ROSE
                     self.rose[self.cmip6_use_mappings[this_use]]=new_use
                     import pdb; pdb.set_trace()
@@ -582,98 +762,80 @@ class UM:
 
 
         
-    def custom_sort(self,item):
-       #custom sort for secton items that should ignore the prefix "!!"
-       return(item.lstrip('!!'))
-
-        #Now rose should have all the required time and space domains defined as in the freq_mappings and space_mappings
     def get_uuid_hash(self,section):
-       #computes the correct hash for this stash (as in TidyStashValidate in stash_indices.py)
-       #NOTE - this currently ONLY works for streq - use and domain will need to have the name fields removed before this is done!
-       text=''
-       
-       if 'isec' in section:
-          #this must be a streq:
-          section_keys=[key for key in section]
-       else:
-          #must be domain or use or something?
-          #if so, we want to exclude the NAME label from the hash calclation
-          #this allows us to compare sections that are identical, except for the names
-          section_keys=[key for key in section if not key in ['use_name','dom_name','tim_name']]
-       #sort the keys, ignoring the '!!' prefix during the sort
-       section_keys.sort(key=self.custom_sort)
-       for key in section_keys:
-          #sometimes the value can come from a multi-line and may have \n and = - remove these for the uuid hash
-          this_value=str(section[key]).replace('\n','').replace('=','')
-          text+=key+'='+this_value+'\n'
-
-       #if 'rlev' in text:
-       #   import pdb; pdb.set_trace()
-
-       uuid=hashlib.sha1(text.encode(encoding="utf8")).hexdigest()[:8]
-     
-       return(uuid)
+       #the uuid hash of a streq, domain, time or use section - computed once for each distinct content
+       return(uuid_hash(uuid_items(section)))
+
+
+    def index_section(self,name,section):
+       #add a section to the reverse index of uuid hash -> section names
+       self.section_hashes.setdefault(self.get_uuid_hash(section),[]).append(name)
+
+
+    def find_section(self,section):
+       #the names of the sections in rose with the same content as section, whatever they are called
+       return(self.section_hashes.get(self.get_uuid_hash(section),[]))
 
 
-       
     def check_use_already_exists(self,use):
        
        #check to ensure that this_use exists and points to an output stream - if not TAKE ACTION!
        if not use in self.use_list:
+          use_key=unquote(use)
           plog(use+" does not already exist in ROSE")
-          if not 'usage' in main_config:
-             plog("No [usage] section in "+conf_file)
-             plog("Please add the following to "+conf_file+" and then re-run ")
-             plog()
-             plog("[usage]")
-             plog(use.replace("'","")+"=<xios_stream_reference>")
-             plog()
-             plog("Where <xios_stream_reference> is either one of the following existing xios streams:")
+          if not 'usage' in self.config:
+             perror("No [usage] section in "+self.session.conf_file)
+             perror("Please add the following to "+self.session.conf_file+" and then re-run ")
+             perror()
+             perror("[usage]")
+             perror(use_key+"=<xios_stream_reference>")
+             perror()
+             perror("Where <xios_stream_reference> is either one of the following existing xios streams:")
              for i in self.xios_stream_ids:
-                      plog(i)
-             plog()
-             plog("Or a new xios_stream that you want to define")
+                      perror(i)
+             perror()
+             perror("Or a new xios_stream that you want to define")
              exit()
           else:
-             usage_section=main_config['usage']
+             usage_section=self.config['usage']
              #remove ' just in case
-             if not use.replace("'","") in usage_section:
-                plog("[usage] section exists in "+conf_file+ " but no usage stream mapping defined for "+use+" in this [usage] section")
-                plog("Please add a use mapping to the [usage] section - something like:")
-                plog(use.replace("'","")+"=<xios_stream_reference>")
-                plog()
-                plog("Where <xios_stream_reference> is either one of the following existing xios streams:")
+             if not use_key in usage_section:
+                perror("[usage] section exists in "+self.session.conf_file+ " but no usage stream mapping defined for "+use+" in this [usage] section")
+                perror("Please add a use mapping to the [usage] section - something like:")
+                perror(use_key+"=<xios_stream_reference>")
+                perror()
+                perror("Where <xios_stream_reference> is either one of the following existing xios streams:")
                 for i in self.xios_stream_ids:
-                   plog(i)
-                plog()
-                plog("Or a new xios_stream that you want to define")
+                   perror(i)
+                perror()
+                perror("Or a new xios_stream that you want to define")
                 exit()
              else:
                 
                 #OK so we have a usage mapping!
                 #remove ' just in case
-                use_stream=usage_section[use.replace("'","")]
+                use_stream=usage_section[use_key]
                 #does this stream already exist?
                 if not use_stream in self.xios_stream_ids:
-                   plog(use_stream+" does not exist in the existing output streams ")
+                   pwarn(use_stream+" does not exist in the existing output streams ")
 
                    #do we have this stream defined in the confi?
-                   xios_config=[key for key in main_config if 'xios_streams' in key]
+                   xios_config=[key for key in self.config if 'xios_streams' in key]
                    xios_config_map={}
                    for key in xios_config:
-                      xios_config_map[main_config[key]['file_id'].replace("'","")]=key
+                      xios_config_map[unquote(self.config[key]['file_id'])]=key
                    if use_stream in xios_config_map:
-                      plog("Aha - I see we have "+use_stream+" defined in "+conf_file)
+                      plog("Aha - I see we have "+use_stream+" defined in "+self.session.conf_file)
                       #check we don't already use the filename_base
                       this_xios_stream=xios_config_map[use_stream]
-                      this_filename_base=main_config[this_xios_stream]['filename_base'].replace("'","")
+                      this_filename_base=unquote(self.config[this_xios_stream]['filename_base'])
 
                       if this_filename_base in self.xios_stream_filename_bases:
-                         plog("Oh - the filename base name for the new xios_stream ("+this_filename_base+") is already used by another xios stream!")
-                         plog("Existing stream base names are:")
+                         perror("Oh - the filename base name for the new xios_stream ("+this_filename_base+") is already used by another xios stream!")
+                         perror("Existing stream base names are:")
                          for i in self.xios_stream_filename_bases:
-                            plog(i)
-                         plog("Please change this and rerun")
+                            perror(i)
+                         perror("Please change this and rerun")
                          exit()
                       else:
                          #Everthing OK - we now need to add the XIOS stream to ROSE
@@ -687,14 +849,14 @@ class UM:
                          
                    else:
                       for i in self.xios_stream_ids:
-                         plog(i)
+                         perror(i)
                       
-                      plog("Please either adjust this to an existing output stream - or add an xios stream definition section to "+conf_file+". Something like")
-                      plog()
-                      plog("[namelist:xios_streams("+use_stream+")]")
-                      plog("compression_level = 0")
-                      plog("file_id = '"+use_stream+"'")
-                      plog("""!!filename = ''
+                      perror("Please either adjust this to an existing output stream - or add an xios stream definition section to "+self.session.conf_file+". Something like")
+                      perror()
+                      perror("[namelist:xios_streams("+use_stream+")]")
+                      perror("compression_level = 0")
+                      perror("file_id = '"+use_stream+"'")
+                      perror("""!!filename = ''
 filename_base = './${RUNID}a_mon_'
 l_reinit = .true.
 output_freq_unit = 4
@@ -712,7 +874,7 @@ uuid_name = 'tracking_id'
                    """)
                       exit()
                 else:
-                   plog("using mapping for "+use+" in "+conf_file)
+                   plog("using mapping for "+use+" in "+self.session.conf_file)
                    plog(use+"->"+use_stream)
                    #use stream mapping exists! Add New usage and stream
                    self.add_new_usage(use,use_stream)
@@ -724,7 +886,7 @@ uuid_name = 'tracking_id'
        
     def add_new_xios_stream(self,xios):
        #link the new xios stream into ROSE
-       self.rose[xios]=main_config[xios]
+       self.rose[xios]=self.config[xios]
 
 
           
@@ -738,8 +900,13 @@ uuid_name = 'tracking_id'
        new_use={'file_id':use_stream,'locn':3,'macrotag':0,'use_name':use}
        #compute the uuid hash for this usage
        hex_uuid=self.get_uuid_hash(new_use)
-       umstash_use="namelist:umstash_use("+use.replace("'","").lower()+"_"+hex_uuid+")"
+       umstash_use="namelist:umstash_use("+unquote(use).lower()+"_"+hex_uuid+")"
+       existing=self.find_section(new_use)
+       if existing:
+          plog(use+" writes to the same stream as the existing "+' '.join(existing))
        self.rose[umstash_use]=new_use
+       self.usages[use]=Usage(umstash_use,new_use)
+       self.index_section(umstash_use,new_use)
        
 
        #hex_uuid = format(int(uuid.uuid4().hex[:8], 16), 'x')
@@ -754,8 +921,8 @@ uuid_name = 'tracking_id'
        xios_stream_keys=[key for key in self.rose.keys() if 'xios_streams' in key]
        for key in xios_stream_keys:
           xios_stream=self.rose[key]
-          xios_stream_name=xios_stream['file_id'].replace("'","")
-          xios_stream_filename_base=xios_stream['filename_base'].replace("'","")
+          xios_stream_name=unquote(xios_stream['file_id'])
+          xios_stream_filename_base=unquote(xios_stream['filename_base'])
           self.xios_stream_ids.append(xios_stream_name)
           self.xios_stream_filename_bases.append(xios_stream_filename_base)
           
@@ -775,14 +942,14 @@ uuid_name = 'tracking_id'
        return("'NEW'")
     
 
-    def read_STASHmaster_A_levels(self):
-        file=main_config['main']['stashmaster_A']
+    @staticmethod
+    def read_STASHmaster_A_levels(file):
         if not os.path.isfile(file):
-            plog(file+" does not exist")
+            perror(file+" does not exist")
             exit()
 
-        stashfile=open(file,'r')
-        stashm=stashfile.readlines()
+        stash_names={}
+        stash_levels={}
         #https://reference.metoffice.gov.uk/um/c4/_level_type_code
         #https://code.metoffice.gov.uk/doc/um/vn13.4/papers/umdp_C04.pdf    
         #1. Model rho levels
@@ -803,49 +970,49 @@ uuid_name = 'tracking_id'
                      6:'soil',
                      7:'theta'
                      }
-
-        for line in stashm:
-            if '|' in line:
+        headings=['Space','Point','Time','Grid','LevelT','LevelF','LevelL','PseudT','PseudF','PseudL','LevCom']
+
+        if os.path.getsize(file)==0:
+            return(stash_names,stash_levels)
+        #scan the file in place through a memory map rather than reading it into a list of lines
+        #only the record types we need (1 and 2) are copied out of the map, the rest are skipped over by the regex
+        with open(file,'rb') as stashfile, mmap.mmap(stashfile.fileno(),0,access=mmap.ACCESS_READ) as stashm:
+            for record in stashmaster_records.finditer(stashm):
                #see https://code.metoffice.gov.uk/doc/um/vn13.4/papers/umdp_C04.pdf
-                bits=line.split('|')
                 #line 1 in stash master
                 #|Model |Sectn | Item |Name 
-                if bits[0]=='1':
-                    model=bits[1].strip(' ')
+                if record[1]==b'1':
+                    bits=record[2].split(b'|',4)
+                    model=bits[0].strip(b' ').decode()
                     if model=='-1':
                         #end of file
                         break
-                    sec=bits[2].strip(' ')
-                    item=bits[3].strip(' ')
-                    name=bits[4]
+                    sec=bits[1].strip(b' ').decode()
+                    item=bits[2].strip(b' ').decode()
+                    name=bits[3].decode()
                     scode='m0'+model+'s'+sec.zfill(2)+'i'+item.zfill(3)
-                    self.stash_names[scode]=name
+                    stash_names[scode]=name
                 #line 2
                 #|Space |Point | Time | Grid |LevelT|LevelF|LevelL|PseudT|PseudF|PseudL|LevCom|
                 #  1       2       3      4       5    6      7      8     9       10     11
-                if bits[0]=='2':
-                    headings=['Space','Point','Time','Grid','LevelT','LevelF','LevelL','PseudT','PseudF','PseudL','LevCom']
-                    this_line={}
-
-                    
-                    for bit in range(len(headings)):
-                       this_line[headings[bit]]=int(bits[bit+1].strip(' '))
-                    self.stash_levels[scode]=this_line
+                else:
+                    bits=record[2].split(b'|',len(headings))
+                    #int() reads the digits straight from the bytes, ignoring the padding
+                    this_line=dict(zip(headings,map(int,bits[:len(headings)])))
+                    stash_levels[scode]=this_line
                     if not this_line['LevelT'] in level_names:
                         plog("Unknown level! "+str(this_line['LevelT']))
                         plog(name)
                         import pdb; pdb.set_trace()
-                    else:
-                        self.stash_levels[scode]=this_line
-        return()
+        return(stash_names,stash_levels)
 
 
 
      
     def read_STASHmaster_A_levels_old(self):
-        file=main_config['main']['stashmaster_A']
+        file=self.config['main']['stashmaster_A']
         if not os.path.isfile(file):
-            plog(file+" does not exist")
+            perror(file+" does not exist")
             exit()
 
         stashfile=open(file,'r')
@@ -903,31 +1070,8 @@ uuid_name = 'tracking_id'
         return()
 
 
-    def read_stash_mappings(self):
-        self.cf_to_stash = configparser.ConfigParser()   
-        #turn of the lowercaseization of keys
-        self.cf_to_stash.optionxform = lambda option: option
-        #configFilePath = 'common_mappings.cfg'
-        configFilePath = main_config['main']['mappings']
-        if ',' in configFilePath:
-           #this contains multiple config files, split into a list
-           configFilePaths=configFilePath.split(',')
-           for path in configFilePaths:
-              if not os.path.isfile(path):
-                 plog("ROSE conf file "+path+" does not exist")
-                 exit()
-
-           self.cf_to_stash.read(configFilePaths)
-        else:
-           if not os.path.isfile(configFilePath):
-              plog("ROSE conf file "+configFilePath+" does not exist")
-              exit()
-           self.cf_to_stash.read(configFilePath)
-        return()
-
-
-        
-    def read_rose_app_conf(self,file):
+    @staticmethod
+    def read_rose_app_conf(file):
         config = configparser.ConfigParser() 
         config.optionxform = lambda option: option
         
@@ -936,7 +1080,7 @@ uuid_name = 'tracking_id'
         #test if this is true, if so, extract this header
         header_flag=True
         if not os.path.isfile(file):
-            plog("ROSE conf file "+file+" does not exist")
+            perror("ROSE conf file "+file+" does not exist")
             exit()
  
         with open(configFilePath) as stream:
@@ -959,10 +1103,249 @@ uuid_name = 'tracking_id'
         return(config,header)
 
 
+    def read_stash_requests(self):
+        #the umstash_streq sections in rose, in order, and indexed by (isec, item)
+        self.rose_stash_requests=read_records(self.rose,StashRequest.from_section,'umstash_streq')
+        for request in self.rose_stash_requests:
+            self.index_stash_request(request)
+
+
+    def index_stash_request(self,request):
+        self.stash_requests.setdefault((request.isec,request.item),[]).append(request)
+
+
+    def balanced_usage(self,parsed,time_domain,spatial_domain,time_domain_cf):
+        '''
+        the usage for a new STASH request when there is a [usage_balance] section in the config
+        the candidates are the usages already used with time_domain - the one writing to the stream with the
+        smallest estimated output per model year is picked
+        streams over [usage_balance]:max_volume (GB per model year) are skipped - if they are all full, the next spare usage
+        listed for time_domain_cf in [usage_balance] is added to rose (from its [usage] mapping and xios_streams section)
+        '''
+        balance=self.config['usage_balance']
+        estimator=VolumeEstimator(self.config)
+        profiles=self.time_profiles_by_name()
+        if self.stream_volumes is None:
+            #the output of the STASH requests already in rose
+            self.stream_volumes={}
+            for request in self.rose_stash_requests:
+                stream=estimator.stash_stream(self,request)
+                self.stream_volumes[stream]=self.stream_volumes.get(stream,0)+estimator.stash_request(self,request,profiles)
+        size=estimator.stash_request(self,StashRequest(parsed.key[0],parsed.key[1],spatial_domain,time_domain,None),profiles)
+        max_volume=None
+        if 'max_volume' in balance:
+            try:
+                max_volume=float(balance['max_volume'])*1024**3
+            except ValueError:
+                perror("[usage_balance]:max_volume must be a number of GB per model year")
+                exit()
+
+        candidates=[]
+        for uses in self.use_matrix[time_domain].values():
+            for use in uses:
+                if not use in candidates:
+                    candidates.append(use)
+        def volume(use):
+            return(self.stream_volumes.get(estimator.usage_stream(self,use),0))
+        fits=[use for use in candidates if max_volume is None or volume(use)+size<=max_volume]
+        if fits:
+            usage=min(fits,key=lambda use:(volume(use),use))
+        else:
+            #every stream is full - add a spare usage if there is one left
+            spares=[use.strip() for use in balance.get(time_domain_cf,'').split(',') if use.strip()]
+            spares=[use for use in spares if not use in self.use_list]
+            if spares:
+                usage=spares[0]
+                plog("All the streams for "+time_domain+" are over "+balance['max_volume']+" GB per year - adding "+usage)
+                self.check_use_already_exists(usage)
+                self.use_matrix[time_domain].setdefault(spatial_domain,[]).append(usage)
+            else:
+                usage=min(candidates,key=lambda use:(volume(use),use))
+                pwarn("All the streams for "+time_domain+" are over "+balance['max_volume']+" GB per year and there are no spare usages"
+                      " for "+time_domain_cf+" in [usage_balance] - using "+usage)
+        stream=estimator.usage_stream(self,usage)
+        self.stream_volumes[stream]=self.stream_volumes.get(stream,0)+size
+        plog("Balanced usage "+usage+" for "+parsed.code+" - "+stream+" now "+human_bytes(self.stream_volumes[stream])+" per year")
+        return(usage)
+
+
+    def time_profiles_by_name(self):
+        #the first time profile with each tim_name
+        profiles={}
+        for profile in self.time_profiles:
+            profiles.setdefault(profile.name,profile)
+        return(profiles)
+
+
+    def output_stash_codes(self):
+        #the stash codes the suite already requests, e.g. m01s03i236
+        return({'m01s'+str(isec).zfill(2)+'i'+str(item).zfill(3) for isec,item in self.stash_requests})
+
+
+    def find_duplicate_stash_requests(self):
+        '''
+        groups of umstash_streq sections in rose that request the same output
+        an exact duplicate has the same content (uuid hash) as another section under a different name
+        a semantic duplicate differs only in its package or ens_name, or uses a domain, time profile or usage that
+        is identical to the other's apart from its name (a usage by the stream it writes to)
+        a group of requests for the same output is reported as its exact subgroups, then a semantic group of the
+        first section of each of them
+        returns a list of (kind, [section names]) - compact_stash_requests() keeps the first section of each group
+        '''
+        #the first name of each distinct domain, time profile and stream
+        dom_class={}
+        first={}
+        for domain in self.domains:
+            dom_class.setdefault(domain.name,first.setdefault(domain,domain.name))
+        tim_class={}
+        first={}
+        for profile in self.time_profiles:
+            tim_class.setdefault(profile.name,first.setdefault(profile,profile.name))
+        use_class={}
+        for usage in self.usages.values():
+            use_class[usage.name]=usage.stream if usage.stream else usage.name
+
+        groups={}
+        for request in self.rose_stash_requests:
+            key=(request.isec,request.item,
+                 dom_class.get(request.dom_name,request.dom_name),
+                 tim_class.get(request.tim_name,request.tim_name),
+                 use_class.get(request.use_name,request.use_name))
+            groups.setdefault(key,[]).append(request.section)
+
+        #within each group, sections with the same uuid hash are exact duplicates of each other, and the first
+        #section of each distinct hash are semantic duplicates - so byte-identical copies are always found as exact
+        duplicates=[]
+        for names in groups.values():
+            if len(names)>1:
+                by_hash={}
+                for name in names:
+                    by_hash.setdefault(self.get_uuid_hash(self.rose[name]),[]).append(name)
+                for copies in by_hash.values():
+                    if len(copies)>1:
+                        duplicates.append(('exact',copies))
+                if len(by_hash)>1:
+                    duplicates.append(('semantic',[copies[0] for copies in by_hash.values()]))
+        return(duplicates)
+
+
+    def index_sections(self):
+        #the reverse index of uuid hash -> section names, for all the STASH sections in rose
+        self.section_hashes={}
+        for key in self.rose.keys():
+            if any(tag in key for tag in ['umstash_streq','umstash_domain','umstash_time','umstash_use']):
+                self.index_section(key,self.rose[key])
+        for request in self.new_stash_requests:
+            self.section_hashes.setdefault(self.get_uuid_hash(request.as_section()),[]).append(request.section)
+
+
+    def consolidate_sections(self,kind):
+        '''
+        merge the time profiles (kind 'time') or domains (kind 'space') in rose that the UM would treat the same,
+        whatever their names - see TimeProfile.canonical() and SpaceDomain.canonical()
+        the STASH requests using a merged profile are pointed at the first profile of its group, and the merged sections
+        are removed - requests that this makes copies of each other are then removed as exact duplicates
+        (the streq section names keep their old uuid, rose will tidy these)
+        returns a list of (kept name, [merged section names]), and the duplicate requests removed
+        '''
+        name_key={'time':'tim_name','space':'dom_name'}[kind]
+        records=self.time_profiles if kind=='time' else self.domains
+        groups={}
+        for record in records:
+            groups.setdefault(record.canonical(),[]).append(record)
+        #a name given to profiles that differ can't be redirected
+        contents={}
+        for record in records:
+            contents.setdefault(record.name,set()).add(record.canonical())
+        renames={}
+        merged=[]
+        for group in groups.values():
+            kept=group[0]
+            names=[record.section for record in group[1:] if len(contents[record.name])==1]
+            if not names:
+                continue
+            for record in group[1:]:
+                if len(contents[record.name])==1:
+                    if record.name!=kept.name:
+                        renames[record.name]=kept.name
+                    self.rose.remove_section(record.section)
+            merged.append((kept.name,names))
+        if not merged:
+            return(merged,[])
+
+        #point the requests at the kept profiles
+        for request in self.rose_stash_requests:
+            section=self.rose[request.section]
+            if section[name_key] in renames:
+                section[name_key]=renames[section[name_key]]
+        for request in self.new_stash_requests:
+            if kind=='time' and request.tim_name in renames:
+                request.tim_name=renames[request.tim_name]
+            if kind=='space' and request.dom_name in renames:
+                request.dom_name=renames[request.dom_name]
+            request._hash=hash(request.canonical())
+        mappings=self.rose_time_domain_mappings if kind=='time' else self.rose_space_domain_mappings
+        for key in mappings:
+            mappings[key]=renames.get(mappings[key],mappings[key])
+        #and merge their entries in the use matrix
+        if kind=='time':
+            matrices=[(self.use_matrix,old,new) for old,new in renames.items()]
+        else:
+            matrices=[(self.use_matrix[time],old,new) for time in self.use_matrix for old,new in renames.items()]
+        for matrix,old,new in matrices:
+            if not old in matrix:
+                continue
+            entries=matrix.pop(old)
+            if kind=='time':
+                target=matrix.setdefault(new,{})
+                for space in entries:
+                    for use in entries[space]:
+                        if not use in target.setdefault(space,[]):
+                            target[space].append(use)
+            else:
+                for use in entries:
+                    if not use in matrix.setdefault(new,[]):
+                        matrix[new].append(use)
+
+        #re-read the records from the rewritten sections
+        self.stash_requests={}
+        self.read_stash_requests()
+        for request in self.new_stash_requests:
+            self.index_stash_request(request)
+        self.domains=read_records(self.rose,SpaceDomain,'umstash_domain')
+        self.domains_by_name={}
+        for domain in self.domains:
+            self.domains_by_name.setdefault(domain.name,domain)
+        self.time_profiles=read_records(self.rose,TimeProfile,'umstash_time')
+        self.index_sections()
+        duplicates=[group for group in self.find_duplicate_stash_requests() if group[0]=='exact']
+        removed=self.compact_stash_requests(duplicates)
+        return(merged,removed)
+
+
+    def compact_stash_requests(self,duplicates):
+        '''
+        remove all but the first section of each group from find_duplicate_stash_requests() from rose
+        domains, time profiles and usages are left as they are, even if no request uses them any more
+        returns the names of the sections removed
+        '''
+        removed=set()
+        for kind,names in duplicates:
+            for name in names[1:]:
+                self.rose.remove_section(name)
+                removed.add(name)
+        self.rose_stash_requests=[request for request in self.rose_stash_requests if not request.section in removed]
+        for key in self.stash_requests:
+            self.stash_requests[key]=[request for request in self.stash_requests[key] if not request.section in removed]
+        for key in self.section_hashes:
+            self.section_hashes[key]=[name for name in self.section_hashes[key] if not name in removed]
+        return(sorted(removed))
+
+
     def get_use_list(self):
-        rose_use_keys=[key for key in self.rose.keys() if 'umstash_use' in key]
-        for key in rose_use_keys:
-            self.use_list.append(self.rose[key]['use_name'])
+        for usage in read_records(self.rose,Usage,'umstash_use'):
+            self.usages.setdefault(usage.name,usage)
+            self.use_list.append(usage.name)
 
     def get_cmip6_use_mappings(self):
         cmip6_use_keys=[key for key in self.cmip6.keys() if 'umstash_use' in key]
@@ -1071,7 +1454,7 @@ uuid_name = 'tracking_id'
                             if not this_use in self.use_matrix[this_time][this_domain]:
                                #only add if this use isn't already in the list
                                self.use_matrix[this_time][this_domain].append(this_use)
-                               check_use_already_exists(this_use)
+                               self.check_use_already_exists(this_use)
                                if not this_use in self.use_list:
                                   plog("FISH")
                                   #this usage does not exist in ROSE
@@ -1088,9 +1471,9 @@ uuid_name = 'tracking_id'
                                #this usage does not exist in ROSE
                                plog("copying usage "+this_use+" to ROSE")
                                #copy usage with name this_use from CMIP6
-                               new_use=self.cmip6[self.cmip6_use_mappings[this_use]]
+                               new_use=dict(self.cmip6[self.cmip6_use_mappings[this_use]])
                                #create a consistent new file id for this usage
-                               new_use['file_id']=create_new_file_id()
+                               new_use['file_id']=self.create_new_file_id()
                                #copy reference to this usage to ROSE
                                self.rose[self.cmip6_use_mappings[this_use]]=new_use
                                import pdb; pdb.set_trace()
@@ -1100,7 +1483,7 @@ uuid_name = 'tracking_id'
 
             else:
                 #print("Time domain found in Rose")
-                plog(self.rose[rose_tim_found]['tim_name']+" found in Rose")
+                pdebug(self.rose[rose_tim_found]['tim_name']+" found in Rose")
 
                 self.rose_time_domain_mappings[freq+'_'+self.rose[rose_tim_found]['ityp']]=self.rose[rose_tim_found]['tim_name']
         #return(rose_freq_mappings)
@@ -1145,16 +1528,16 @@ uuid_name = 'tracking_id'
                     break
             if not space_name_found:
                 plog('Space domain '+this_space_dom+" Not found in CMIP6 reference!")
-                user_domains=[key for key in main_config if 'umstash_domain' in key]
+                user_domains=[key for key in self.config if 'umstash_domain' in key]
                 if user_domains:
                     plog("Found some user defined domains "+' '.join(user_domains))
-                    user_domain_found=[key for key in user_domains if main_config[key]['dom_name']==this_space_dom]
+                    user_domain_found=[key for key in user_domains if self.config[key]['dom_name']==this_space_dom]
                     if not user_domain_found:
                         plog("No "+this_space_dom+" found in the user domaines :(")
                         import pdb; pdb.set_trace()
                     #just pick first - they all match the this_space_dom!
                     user_space=user_domain_found[0]
-                    user_space_dom_full=main_config[user_space]
+                    user_space_dom_full=self.config[user_space]
                     #copy across USER DOMAON
                     #the uuid hash for this domain may not be the same as if it had been calculated for this version of the UM
                     #so let's recalculate it:
@@ -1198,7 +1581,7 @@ uuid_name = 'tracking_id'
             else:
                 #print("Space domain found in Rose")
                 #logging.info(self.rose[rose_space_found]['dom_name']+" found in ROSE")
-                plog(self.rose[rose_space_found]['dom_name']+" found in ROSE")
+                pdebug(self.rose[rose_space_found]['dom_name']+" found in ROSE")
                 self.rose_space_domain_mappings[space]=self.rose[rose_space_found]['dom_name']
         return()
 
@@ -1206,16 +1589,10 @@ uuid_name = 'tracking_id'
     def get_use_matrix(self):
         #this returns a dict (matrix) use_matrix[time][space]=[usage_list]
         #usage_list is a list of usage labels that are used for that time and space pairs in ROSE use
-        stash_c= [key for key in self.rose.sections() if re.search('umstash_streq', key)]
-        use_mappings_t={}
-        use_mappings_s={}
-        #use_matrix={}
-
-        for key in stash_c:
-            this_stash=self.rose[key]
-            this_use=this_stash['use_name']
-            this_time=this_stash['tim_name']
-            this_space=this_stash['dom_name']
+        for this_stash in self.rose_stash_requests:
+            this_use=this_stash.use_name
+            this_time=this_stash.tim_name
+            this_space=this_stash.dom_name
             tmp_dom={}
             tmp_dom[this_space]=[this_use]
 
@@ -1238,7 +1615,8 @@ uuid_name = 'tracking_id'
         
 
         if not cf_variable in self.cf_to_stash.sections():
-            plog(cf_variable+" not found in the stash mapping!")
+            pwarn(cf_variable+" not found in the stash mapping!")
+            pevent('missing',component='um',diag=cf_variable,reason='no stash mapping')
             plog(bold("skipping "+cf_variable))
             self.missing.append(cf_variable)
             return(None,None)
@@ -1309,15 +1687,13 @@ uuid_name = 'tracking_id'
            
     def rose_get_dom_level(self,dom_name):
         #returns the IOPL domain level index for dom_name in rose
-        #get all the domain keys in rose
-        rose_space_keys=[key for key in self.rose.keys() if 'umstash_domain' in key]
-        for i in rose_space_keys:
-            if self.rose[i]['dom_name']==dom_name:
-                return(int(self.rose[i]['iopl']))
+        if dom_name in self.domains_by_name:
+            return(self.domains_by_name[dom_name].iopl)
         plog(dom_name+' not found?')
         import pdb; pdb.set_trace()
 
 
+    @profiler.timed('UM.get_domain')
     def get_domain(self,stash_code,spatial_domain_cf):
         #checks to see if the domain defined by spatial_domain_cf matches what is required by stash_code
         #and returns the correct domain name, if possible
@@ -1339,14 +1715,14 @@ uuid_name = 'tracking_id'
             
         
         #do we already have a mapping for this?
-        if 'domains' in main_config:
-            user_domains=main_config['domains']
+        if 'domains' in self.config:
+            user_domains=self.config['domains']
             if stash_code in user_domains:
 
             
                 #a mapping is defined in the config
                 spatial_domain=user_domains[stash_code]
-                plog("A domain mapping for "+stash_code+" was found in "+conf_file+": "+spatial_domain+" -will use this")
+                plog("A domain mapping for "+stash_code+" was found in "+self.session.conf_file+": "+spatial_domain+" -will use this")
                 return(spatial_domain,spatial_domain_cf)
             #there is a domains section defined in the config file
            
@@ -1422,17 +1798,16 @@ uuid_name = 'tracking_id'
            plog(stash_code+" requires pseudo levels")
 
            
-           rose_space_keys=[key for key in self.rose.keys() if 'umstash_domain' in key]
            pseudo_level_found=False
-           for key in rose_space_keys:
+           for domain in self.domains:
+              key=domain.section
               #compare the Pseudo level Type with the sc_pseudo_level
-              if int(self.rose[key]['plt'])==sc_pseudo_level and int(self.rose[key]['iopl'])==sc_level:
-                 if 'pslist' in self.rose[key]:
+              if domain.plt==sc_pseudo_level and domain.iopl==sc_level:
+                 if domain.pslist is not None:
                     #OK this domain has a pslist
-                    #create pslist of integers
-                    this_dom=self.rose[key]['dom_name']
+                    this_dom=domain.name
                     
-                    pslist=[int(num) for num in self.rose[key]['pslist'].split(',')]
+                    pslist=list(domain.pslist)
                     #Does this range of this pseudo level list for this domain match the range defined for the diagnostics in STASHMASTER?
                     if pslist[0]==this_stash['PseudF'] and pslist[-1]==this_stash['PseudL']:
                        #This domain should at least contain the required range defined for this diagnostic
@@ -1442,7 +1817,7 @@ uuid_name = 'tracking_id'
                        break
                     else:
                        plog("Found "+this_dom+" but the pseudolevel range "+str(pslist)+" does not match the defined range "+str(this_stash['PseudF'])+"-"+str(this_stash['PseudL'])+" for "+stash_code)
-                       plog("If you want to use "+this_dom+" for "+stash_code+" ("+self.stash_names[stash_code].strip()+") "+" add the line:\n"+stash_code+" = "+this_dom+"\nto "+main_config['user']['log_file'].strip("'")+" under a [domains] section")
+                       plog("If you want to use "+this_dom+" for "+stash_code+" ("+self.stash_names[stash_code].strip()+") "+" add the line:\n"+stash_code+" = "+this_dom+"\nto "+self.config['user']['log_file'].strip("'")+" under a [domains] section")
                              
                     
            if pseudo_level_found:
@@ -1454,19 +1829,17 @@ uuid_name = 'tracking_id'
               plog("Pseudo level range not found in ROSE domains")
               plog("Checking CMIP reference")
             
-              cmip6_space_keys=[key for key in self.cmip6.keys() if 'umstash_domain' in key]
-              
-              for key in cmip6_space_keys:
+              for domain in self.cmip6_records['domains']:
+                 key=domain.section
                  #compare the Pseudo level Type with the sc_pseudo_level
                  #also check that the IOPL is correct
-                 if int(self.cmip6[key]['plt'])==sc_pseudo_level and  int(self.cmip6[key]['iopl'])==sc_level:
+                 if domain.plt==sc_pseudo_level and domain.iopl==sc_level:
                     
-                    if 'pslist' in self.cmip6[key]:
+                    if domain.pslist is not None:
                        #OK this domain has a pslist
-                       #create pslist of integers
-                       this_dom=self.cmip6[key]['dom_name']
+                       this_dom=domain.name
                        
-                       pslist=[int(num) for num in self.cmip6[key]['pslist'].split(',')]
+                       pslist=list(domain.pslist)
                        #Does this range of this pseudo level list for this domain match the range defined for the diagnostics in STASHMASTER?
                        if pslist[0]==this_stash['PseudF'] and pslist[-1]==this_stash['PseudL']:
                           #This domain should at least contain the required range defined for this diagnostic
@@ -1483,12 +1856,21 @@ uuid_name = 'tracking_id'
                  plog("Pseudo level "+str(sc_pseudo_level)+" found in CMIP6 in "+key)
                  import pdb; pdb.set_trace()
               else:
-                 plog("Pseudo level range  not found in CMIP6 Domains")
-                 plog("Need to define a domain usage in "+main_config['user']['log_file'].strip("'")+" under a [domains] section")
+                 perror("Pseudo level range  not found in CMIP6 Domains")
+                 perror("Need to define a domain usage in "+self.config['user']['log_file'].strip("'")+" under a [domains] section")
                  exit()
         return(spatial_domain,spatial_domain_cf)
 
 
+    def request_lbproc(self,time_domain_cf,options):
+        #the lbproc of the output a request needs - its [lbproc=..], by default a mean as in get_time_domain(),
+        #but a time profile that samples (ityp 1, eg 6hrPt) writes instantaneous values whatever the mapping says
+        if self.tim_dom.get(time_domain_cf,{}).get('ityp')=='1':
+            return('0')
+        return(options.get('lbproc','128'))
+
+
+    @profiler.timed('UM.get_time_domain')
     def get_time_domain(self,time_domain_cf,options,spatial_domain):
         '''
         find time domain for this cf time domain and the LBPROC in options
@@ -1509,29 +1891,27 @@ uuid_name = 'tracking_id'
            time_domain=self.rose_time_domain_mappings[this_time_domain_key]
         else:
            time_domain=''
-        rose_time_keys=[key for key in self.rose.keys() if 'umstash_time' in key]
-        cmip6_time_keys=[key for key in self.cmip6.keys() if 'umstash_time' in key]
-
         #pull in the part mapping for this time domain 
-        time_filter=self.tim_dom[freq]
+        #(a copy - the ityp added below depends on the lbproc of this request)
+        time_filter=dict(self.tim_dom[time_domain_cf])
         #if ityp is not already defined in time_filterm then add the ityp for the method from the lbproc mappings
         if not 'ityp' in time_filter:
             time_filter['ityp']=self.lbproc_mappings[lbproc]
-        rose_lbproc=[ x for x in rose_time_keys if is_subset(time_filter,um.rose[x])]
+        rose_lbproc=[ x for x in self.time_profiles if x.matches(time_filter)]
         time_usage_found=False
-        #rose_lbproc=[ x for x in rose_time_keys if um.rose[x]['ityp']==self.lbproc_mappings[options['lbproc']]]
+        #rose_lbproc=[ x for x in rose_time_keys if self.rose[x]['ityp']==self.lbproc_mappings[options['lbproc']]]
         if rose_lbproc:
-           plog("LBPROC found in ROSE")
+           pdebug("LBPROC found in ROSE")
            if len(rose_lbproc)>1:
               plog("Hmm - we have more than one choice here!")
               import pdb; pdb.set_trace()
            else:
-              time_domain=um.rose[rose_lbproc[0]]['tim_name']
-              plog("Switching to "+time_domain)
+              time_domain=rose_lbproc[0].name
+              pdebug("Switching to "+time_domain)
               return(time_domain)
 
-        cmip6_lbproc=[ x for x in cmip6_time_keys if is_subset(time_filter,um.cmip6[x])]
-        #cmip6_lbproc=[ x for x in cmip6_time_keys if um.cmip6[x]['ityp']==self.lbproc_mappings[options['lbproc']]]
+        cmip6_lbproc=[ x.section for x in self.cmip6_records['times'] if x.matches(time_filter)]
+        #cmip6_lbproc=[ x for x in cmip6_time_keys if self.cmip6[x]['ityp']==self.lbproc_mappings[options['lbproc']]]
         if cmip6_lbproc:
             plog("LBPROC found in CMIP6")
 
@@ -1542,18 +1922,18 @@ uuid_name = 'tracking_id'
                     plog("Too many!")
                     import pdb; pdb.set_trace()
                 else:
-                    if not is_equal_except(um.cmip6.items(cmip6_lbproc[0]),um.cmip6.items(cmip6_lbproc[1]),'tim_name'):
+                    if not is_equal_except(self.cmip6.items(cmip6_lbproc[0]),self.cmip6.items(cmip6_lbproc[1]),'tim_name'):
                         plog("Two choices, but not equivalent!")
                         import pdb; pdb.set_trace()
                     plog("2 choices, but these are equivalent time profiles")
                     plog("We will use "+cmip6_lbproc[0])
              
                     
-            time_domain=um.cmip6[cmip6_lbproc[0]]
+            time_domain=self.cmip6[cmip6_lbproc[0]]
             time_domain_name=time_domain['tim_name']
             #import pdb; pdb.set_trace()
             plog("Copying "+time_domain_name+" to ROSE")
-            self.copy_cmip6_tim_dom_to_rose(time_domain,spatial_domain)
+            self.copy_cmip6_tim_dom_to_rose(time_domain,spatial_domain,time_domain_cf)
             plog("Switching to "+time_domain_name)
 
             return(time_domain_name)
@@ -1563,33 +1943,27 @@ uuid_name = 'tracking_id'
 
         return(time_domain) 
 
-    def nc_check_stash(self,stash_code,time_domain_cf,spatial_domain_cf):
-        plog("Check output")
+    @profiler.timed('UM.nc_check_stash')
+    def nc_check_stash(self,stash_code,time_domain_cf,spatial_domain_cf,lbproc='128'):
+        #lbproc is the time processing the request needs (see request_lbproc()) - the output must have the same cell method
+        pdebug("Check output")
         #the split is because multiple occurrences of a stash code in a netcdf file will be appended with _2 _3 etc
         #we just want to check the stash code part
         #if 'pseudo' in spatial_domain_cf:
         #    import pdb; pdb.set_trace()
         
-        matches=[key for key in nc_output if key.nc_get_variable().split('_')[0]==stash_code]
+        matches=[key for key in self.session.nc_output if key['variable'].split('_')[0]==stash_code]
         if not matches:
-            plog(stash_code+" not found in NC output")
+            pdebug(stash_code+" not found in NC output")
             spatial_domain_cf_list=sorted(spatial_domain_cf.split(' '))
         else:
-            plog(stash_code+" found in NC output")
+            pdebug(stash_code+" found in NC output")
             #if 'height' in spatial_domain_cf:
             #    import pdb; pdb.set_trace()
 
             #does this have the required domain?
             #We need to remap some of the requested dimension to what the model actually writes out
-            replacements={'height10m':'',
-                          'height2m':'',
-                          'alevhalf':'model_level_number',
-                          'alevel':'model_level_number',
-                          'sdepth1':'depth',                          
-                          'sdepth':'depth',
-                          'typesi':'',
-                          'typeli':''
-                          }
+            replacements=um_domain_replacements
             model_dimensions=['latitude','longitude','depth','model_level_number','height','time','pseudo']
  #           output_replacements={'atmosphere_hybrid_height_coordinate':'model_level_number',
  #                                'long_name=Land and Vegetation Surface types':'pseudo'
@@ -1614,11 +1988,11 @@ uuid_name = 'tracking_id'
             
             for this_match in matches:
                 #get list of unique domain names
-                nc_domain=sorted(list(set(([item.identity() for item in this_match.coords().values()]))))
+                nc_domain=sorted(list(set(this_match['identities'])))
                 #check to see if there are any unexpected dimension names in this list
     
-                for torep in um.output_replacements:
-                    rep=um.output_replacements[torep]
+                for torep in self.output_replacements:
+                    rep=self.output_replacements[torep]
                     #import pdb; pdb.set_trace()
                     nc_domain=[rep if x==torep else x for x in nc_domain]
                     ##FIX THIS##
@@ -1628,19 +2002,19 @@ uuid_name = 'tracking_id'
                                  
                 if len(unexpected_names)>0:
                     #get here if unexpected_names is a NON-empty list!
-                    plog("Unexpected domain names")
-                    plog(' '.join(unexpected_names))
-                    plog("Expected names are: "+' '.join(model_dimensions))
-                    plog("Add a domain_names item to the [user] section of the config file")
-                    plog("For example:")
-                    plog("domain_names='long_name=Land and Vegetation Surface types:pseudo'")
+                    perror("Unexpected domain names")
+                    perror(' '.join(unexpected_names))
+                    perror("Expected names are: "+' '.join(model_dimensions))
+                    perror("Add a domain_names item to the [user] section of the config file")
+                    perror("For example:")
+                    perror("domain_names='long_name=Land and Vegetation Surface types:pseudo'")
                     exit()
                     import pdb; pdb.set_trace()
 
                 #nc_domain=sorted([item.standard_name for item in this_match.coords().values()])
                 if 'air_pressure' in nc_domain:
                     # if the domain contains air pressure - let's guess what the original plev was!
-                    new_name='plev'+str(this_match.coord('air_pressure').size)
+                    new_name='plev'+str(this_match['sizes']['air_pressure'])
                     nc_domain=sorted([item if item!='air_pressure' else new_name for item in nc_domain])
                 #if 'long_name=Land and Vegetation Surface types' in nc_domain:
                 #    # if the domain contains veg and surface types -this is a pseudo level
@@ -1649,7 +2023,7 @@ uuid_name = 'tracking_id'
 
                 if 'height' in nc_domain:
                     #domain contains a height coordinate
-                    if this_match.coord('height').size==1:
+                    if this_match['sizes']['height']==1:
                         #this is a single level - hence we can ignore here
                         nc_domain=sorted([item for item in nc_domain if item!='height'])
 
@@ -1663,22 +2037,55 @@ uuid_name = 'tracking_id'
                 #    nc_domain=sorted([item if item!='model_level_number' else 'alevhalf' for item in nc_domain])
                 if spatial_domain_cf_list==nc_domain:
                     #spatial domains matc
-                    #check and replace 6hr_pt etc
-                    this_time_domain=this_match.properties()['name'].split('a_')[1].replace('6hpt','6hrPt').replace('6hr_pt','6hrPt')
-                    #split for other freq
-                    this_time_domain=this_time_domain.split('_')[0]
-                    if time_domain_cf == this_time_domain:
+                    #the time domain and cell method come from the time coordinate
+                    this_time_domain=this_match['freq']
+                    this_method=this_match['method']
+                    if not this_time_domain:
+                        #otherwise from the file name, if it is named as the UM names its output (eg ..a_mon_..)
+                        if not 'a_' in this_match['name']:
+                            pdebug("Can't tell the frequency of "+this_match['variable']+" in "+this_match['file'])
+                            continue
+                        #check and replace 6hr_pt etc
+                        this_time_domain=this_match['name'].split('a_')[1].replace('6hpt','6hrPt').replace('6hr_pt','6hrPt')
+                        #split for other freq
+                        this_time_domain=this_time_domain.split('_')[0]
+                        #the cell method was only guessed without a time coordinate that could be read
+                        this_method=lbproc_methods.get(lbproc)
+                    if time_domain_cf == this_time_domain and this_method==lbproc_methods.get(lbproc):
                         #time domains match
-                        plog("Time and spatial domains match")
-                        um.nc_found.append([stash_code,time_domain_cf,spatial_domain_cf])
+                        pdebug("Time and spatial domains match")
+                        pevent('nc_found',component='um',diag=stash_code,freq=time_domain_cf,dims=spatial_domain_cf)
+                        self.nc_found.append([stash_code,time_domain_cf,spatial_domain_cf])
+                        self.session.nc_match('um',stash_code,this_match)
                         return(True)
+        #fieldsfile and pp output is checked against the index of its lookup headers
+        if self.session.um_output and self.pp_check_stash(stash_code,time_domain_cf,spatial_domain_cf,lbproc):
+            return(True)
         #if we get to here, there were no matches!
-        plog("Couldn't find "+stash_code+" in NC for "+' '.join(spatial_domain_cf_list)+" at "+time_domain_cf)
+        pwarn("Couldn't find "+stash_code+" in NC for "+' '.join(spatial_domain_cf_list)+" at "+time_domain_cf)
+        pevent('nc_missing',component='um',diag=stash_code,freq=time_domain_cf,dims=spatial_domain_cf)
         self.nc_missing.append([stash_code,time_domain_cf,spatial_domain_cf])
         #import pdb; pdb.set_trace()
 
         return(False)
      
+    @profiler.timed('UM.pp_check_stash')
+    def pp_check_stash(self,stash_code,time_domain_cf,spatial_domain_cf,lbproc='128'):
+        #as nc_check_stash, for the fieldsfile and pp output indexed by Session.read_check_output()
+        #the frequency, time processing and dimensions come from the lookup headers, so nothing depends on the file names
+        requested=spatial_domain_cf
+        for torep in um_domain_replacements:
+            requested=requested.replace(torep,um_domain_replacements[torep])
+        requested=sorted([item for item in requested.split(' ') if item!=''])
+        for group in self.session.um_output.get(stash_code,[]):
+            if group['dims']==requested and group['freq']==time_domain_cf and group['lbproc']==int(lbproc):
+                pdebug(stash_code+" found in "+group['file'])
+                pevent('nc_found',component='um',diag=stash_code,freq=time_domain_cf,dims=spatial_domain_cf,file=group['file'])
+                self.nc_found.append([stash_code,time_domain_cf,spatial_domain_cf])
+                return(True)
+        return(False)
+
+    @profiler.timed('UM.add_stash')
     def add_stash(self,stash_code0,time_domain_cf,spatial_domain_cf):
         #checks to see if the stash_code (e.g m01s03i236) exists in the rose config object
         #and that this stash code is output using the correct time and spatial domains
@@ -1686,15 +2093,10 @@ uuid_name = 'tracking_id'
 
 
 
-        pattern = r'm(\d{2})s(\d{2})i(\d{3})\[(.*?)\]'
-        if re.match(pattern,stash_code0):
-            model,isec,item,options=re.match(pattern,stash_code0).groups()
-            options=dict(pair.split('=') for pair in options.split(','))
-        else:
-            pattern = r'm(\d{2})s(\d{2})i(\d{3})'
-            model,isec,item=re.match(pattern,stash_code0).groups()
-            options={}
-        stash_code='m'+model+'s'+isec+'i'+item
+        #each distinct stash code text is only parsed once
+        parsed=parse_stash_code(stash_code0)
+        model,isec,item,options=parsed.model,parsed.isec,parsed.item,parsed.options
+        stash_code=parsed.code
 
         #COSP check - the UM will crash if we try to write out certain
         #STASH codes in the absence of others!
@@ -1704,7 +2106,7 @@ uuid_name = 'tracking_id'
             #loop over these ranges
             for i in bad_codes:
                 #does the item value lie within this range?
-                if int(item) >= i[0] and int(item)<= i[-1]:
+                if parsed.key[1] >= i[0] and parsed.key[1]<= i[-1]:
                     #if so, we need to add the 2.330 stash code!
                     plog("This stash code required m01s02i330 to be output - or the UM will complain. Adding..")
                     self.add_stash('m01s02i330',time_domain_cf,spatial_domain_cf)
@@ -1717,14 +2119,16 @@ uuid_name = 'tracking_id'
         #default time domains
         
 
+        #the requested dimensions, before get_domain adjusts them
+        dims=spatial_domain_cf
         spatial_domain,spatial_domain_cf=self.get_domain(stash_code,spatial_domain_cf)
 
-        if check_output:
-            self.nc_check_stash(stash_code,time_domain_cf,spatial_domain_cf)
+        if self.session.check_output:
+            self.nc_check_stash(stash_code,time_domain_cf,spatial_domain_cf,self.request_lbproc(time_domain_cf,options))
             #if this returns true - the the stash code exists with this time and space domain in the netcdf
             return()
 
-        plog("Add "+stash_code)
+        pdebug("Add "+stash_code)
         
         time_domain=self.get_time_domain(time_domain_cf,options,spatial_domain)
         #import pdb; pdb.set_trace()
@@ -1773,23 +2177,23 @@ uuid_name = 'tracking_id'
         stash_found=False
         time_found=False
         space_found=False
-        #extract all the umstash requests from rose 
-        stash_c= [key for key in self.rose.sections() if re.search('umstash_streq', key)]
+        #look up the umstash requests in rose with this isec and item, rather than going through every section
         #loop over all these and see if one matches the stash id we require at the same freq output and domain
-        for req in stash_c:
-            this_stash=self.rose[req]
-            #if the isec and item match and this is the atmospher (model=01)
-            if (this_stash['isec'].zfill(2)==isec) and (this_stash['item'].zfill(3)==item) and model=='01':
+        for this_stash in self.stash_requests.get(parsed.key,[]):
+            req=this_stash.section
+            #if this is the atmospher (model=01)
+            if model=='01':
 
                 #if 'm01s03i460' in stash_code:
                 #   import pdb; pdb.set_trace()
-                this_space=this_stash['dom_name']
-                this_time=this_stash['tim_name']
+                this_space=this_stash.dom_name
+                this_time=this_stash.tim_name
                 #does this stash have the required space and time domain?
                 
                 if (this_time==time_domain) and (this_space==spatial_domain):
                     stash_found=True
                     plog(stash_code+" already exists in "+self.rose_stash+" with "+time_domain+" and "+spatial_domain+" so no need to add anything")
+                    pevent('present',component='um',diag=stash_code,time=time_domain,domain=spatial_domain,section=req)
                     #logging.info(stash_code+" already exists at "+time_domain+" and "+spatial_domain)
                     
                     #if check_output:
@@ -1817,6 +2221,10 @@ uuid_name = 'tracking_id'
                 #can we find this time domain in CMIP6?
                 import pdb; pdb.set_trace()
 
+            elif 'usage_balance' in self.config:
+                #spread the new requests over the usages of this time domain by the volume of their streams
+                usage=self.balanced_usage(parsed,time_domain,spatial_domain,time_domain_cf)
+
                 #what about the spatial_domain?
             elif not spatial_domain in self.use_matrix[time_domain]:
                 plog(spatial_domain+" doesn't exist in the use matrix?")
@@ -1854,32 +2262,24 @@ uuid_name = 'tracking_id'
 
             #plog(oft)
             #logging.info(oft)
-            isec1=isec.lstrip('0') if isec!='00' else '0'
-            item1=item.lstrip('0') if item!='000' else '0'
-
-
-
-
             # Convert the UUID to an 8-digit hexadecimal representation
             #hex_uuid = format(int(uuid.uuid4().hex[:8], 16), 'x')
             
             #Added ens_name here, but maybe this just needs to be added if we are writing to XIOS rather than UM STASH?
-            new_stash={'dom_name':spatial_domain,
-                       'ens_name':"''",
-                       'isec':isec1,
-                       'item':item1,
-                       'package':"'EXTRA'",
-                       'tim_name':time_domain,
-                       'use_name':usage
-                       }
+            new_stash=StashRequest(parsed.key[0],parsed.key[1],spatial_domain,time_domain,usage)
 
             #computes the correct hash uuid for this stash
-            hex_uuid=self.get_uuid_hash(new_stash)
+            hex_uuid=self.get_uuid_hash(new_stash.as_section())
             #namelist_name="[!namelist:umstash_streq("+isec+item+"_"+hex_uuid+")]"
             namelist_name="namelist:umstash_streq("+isec+item+"_"+hex_uuid+")"
+            new_stash.section=namelist_name
             
-            self.rose[namelist_name]=new_stash
+            #the rose section is only made when the STASH is written
+            self.index_stash_request(new_stash)
+            self.section_hashes.setdefault(hex_uuid,[]).append(namelist_name)
+            self.new_stash_requests.append(new_stash)
             plog("Added new stash entry for "+stash_code+" to ROSE using "+spatial_domain+" and "+time_domain)
+            pevent('added',component='um',diag=stash_code,time=time_domain,domain=spatial_domain,usage=usage,section=namelist_name)
             self.added.append(stash_code)
             #logging.info('Added '+stash_code+' using '+time_domain+' '+spatial_domain+' '+usage)
         return(stash_found)
@@ -1988,7 +2388,7 @@ uuid_name = 'tracking_id'
                        break
                     else:
                        plog("Found "+this_dom+" but the pseudolevel range "+str(pslist)+" does not match the defined range "+str(this_stash['PseudF'])+"-"+str(this_stash['PseudL'])+" for "+stash_code)
-                       plog("If you want to use "+this_dom+" for "+stash_code+" add the line:\n"+stash_code+" = "+this_dom+"\nto "+main_config['user']['log_file'].strip("'")+" under a [domains] section")
+                       plog("If you want to use "+this_dom+" for "+stash_code+" add the line:\n"+stash_code+" = "+this_dom+"\nto "+self.config['user']['log_file'].strip("'")+" under a [domains] section")
                              
                     
            if pseudo_level_found:
@@ -2029,8 +2429,8 @@ uuid_name = 'tracking_id'
                  plog("Pseudo level "+str(sc_pseudo_level)+" found in CMIP6 in "+key)
                  import pdb; pdb.set_trace()
               else:
-                 plog("Pseudo level range  not found in CMIP6 Domains")
-                 plog("Need to define a domain usage in "+main_config['user']['log_file'].strip("'")+" under a [domains] section")
+                 perror("Pseudo level range  not found in CMIP6 Domains")
+                 perror("Need to define a domain usage in "+self.config['user']['log_file'].strip("'")+" under a [domains] section")
                  exit()
         
         if model!="01":
@@ -2141,6 +2541,10 @@ uuid_name = 'tracking_id'
         return(stash_found)
 
     def write(self,rose_outfile):
+        #turn the STASH requests added into rose sections
+        for request in self.new_stash_requests:
+            self.rose[request.section]=request.as_section()
+        self.new_stash_requests=[]
         if self.rose_header!='':
             rose_out=open(rose_outfile,'w')
             rose_out.write(self.rose_header+"\n\n")
@@ -2159,25 +2563,33 @@ uuid_name = 'tracking_id'
 class CICE:
 
 
-    def __init__(self):
-
+    def __init__(self,session,source=None):
+        #source is an optional rose-app.conf to read in place of the suite one (eg the output of a previous run)
 
+        self.session=session
+        self.config=session.config
         self.freq_map={'1d':'day','1m':'mon'}
         #self.read_rose_app_conf(file+'/'+ice_conf)
-        self.rose_cice=main_config['user']['job_path']+'app/nemo_cice/rose-app.conf'
-        self.cice_diagnostics_file=main_config['main']['cice_diags']
-        self.rose,self.rose_header=self.read_rose_app_conf(self.rose_cice)
+        self.rose_cice=self.config['user']['job_path']+'app/nemo_cice/rose-app.conf'
+        self.cice_diagnostics_file=self.config['main']['cice_diags']
+        self.rose_source=source if source else self.rose_cice
+        with profiler.stage('nemo_cice rose-app.conf'):
+            self.rose,self.rose_header=session.read_suite_file(self.rose_source,CICE.read_rose_app_conf)
 
         self.nc_found=[] #list of UM diagnostics found in the NC file during --check_output
         self.nc_missing=[] #list of UM diagnostics missing in the NC file during --check_output
 
         self.missing=[] # list of diagnostics we failed to add!
         self.added=[]#list of added diagnostics
+        self.additions=[] # (diagnostic, freq) of each addition
 
-        self.cice_diagnostics=self.read_cice_diagnostics(self.cice_diagnostics_file)
+        #the list of possible CICE diagnostics is shared by all the CICE instances in a session
+        with profiler.stage('ice_history_shared.F90'):
+            self.cice_diagnostics=session.reference_data('cice_diags')
         
 
-    def read_cice_diagnostics(self,file):
+    @staticmethod
+    def read_cice_diagnostics(file):
        #file='ice_history_shared.F90'
 
        namelist=False
@@ -2198,7 +2610,8 @@ class CICE:
 
   
         
-    def read_rose_app_conf(self,file):
+    @staticmethod
+    def read_rose_app_conf(file):
         config = configparser.ConfigParser()
         #turn of the lowercaseization of keys
         config.optionxform = lambda option: option
@@ -2220,23 +2633,31 @@ class CICE:
        return any(i in operators for i in input_string)
 
 
+    def output_fields(self):
+        #the fields the suite already writes - those with an output frequency other than x in icefields_nml,
+        #named as they are in the output (without the f_)
+        section=self.rose['namelist:icefields_nml']
+        return({key.replace('f_','',1) for key in section if key.startswith('f_') and section[key].strip("' x")})
+
+
+    @profiler.timed('CICE.nc_check_ice')
     def nc_check_ice(self,fdiag,freq,dims):
-        plog("Check Ice output")
+        pdebug("Check Ice output")
         #CICE doesn't have sea ice types, or classes, so remove this dimension
         if 'present' in fdiag:
             fdiag='f_ice_present'
 
         dims=dims.replace('typesi','')
         diag=fdiag.replace('f_','')
-        matches=[key for key in nc_output if key.nc_get_variable()==diag]
+        matches=[key for key in self.session.nc_output if key['variable']==diag]
         if matches:
-            plog(diag+" found in NC output")
+            pdebug(diag+" found in NC output")
             #does this have the required domain?
             spatial_domain_cf_list=sorted(dims.split())
             ##HERE
             ## SPATIAL domain doesn't map perfectly as ICE is IJ not long lat!
             for this_match in matches:
-                nc_domain=[item.nc_get_variable() for item in this_match.coords().values()]
+                nc_domain=list(this_match['coord_variables'])
                 nc_domain=sorted([item.replace('TLON','longitude').replace('TLAT','latitude') for item in nc_domain])
                 nc_domain=sorted([item.replace('ULON','longitude').replace('ULAT','latitude') for item in nc_domain])
                 nc_domain=sorted([item.replace('VLON','longitude').replace('VLAT','latitude') for item in nc_domain])
@@ -2250,23 +2671,32 @@ class CICE:
                 if spatial_domain_cf_list==nc_domain:
                     #spatial domains match!
                     ##THIS DOESN'T work for CICE
-                    #try and get the frequency of this variable from the original file name - should be 1d or 1m
-                    match_freq=this_match.get_filenames().pop().split('_')[-2]
-                    if match_freq in self.freq_map:
-                        match_freq=self.freq_map[match_freq]
+                    #the frequency of this variable comes from its time coordinate
+                    match_freq=this_match['freq']
+                    if not match_freq:
+                        #otherwise try and get it from the original file name - should be 1d or 1m
+                        parts=os.path.basename(this_match['file']).split('_')
+                        if len(parts)<2:
+                            pdebug("Can't tell the frequency of "+diag+" in "+this_match['file'])
+                            continue
+                        match_freq=self.freq_map.get(parts[-2],parts[-2])
                     if freq == match_freq:
                         #time domains match
-                        plog("Time and spatial domains match")
+                        pdebug("Time and spatial domains match")
+                        pevent('nc_found',component='cice',diag=diag,freq=freq,dims=dims)
                         self.nc_found.append([diag,freq,dims])
+                        self.session.nc_match('cice',diag,this_match)
                         return(True)
 
         else:
-            plog(diag+" not found in NC output")
+            pdebug(diag+" not found in NC output")
 
-        plog("Couldn't find "+diag+" in NC for "+dims+" at "+freq)
+        pwarn("Couldn't find "+diag+" in NC for "+dims+" at "+freq)
+        pevent('nc_missing',component='cice',diag=diag,freq=freq,dims=dims)
         self.nc_missing.append([diag,freq,dims])
         return(False)
     
+    @profiler.timed('CICE.addIceDiag')
     def addIceDiag(self,fdiag,freq,dims):
     
         plog("")
@@ -2282,7 +2712,7 @@ class CICE:
             import pdb; pdb.set_trace()
         this_freq=freq_map[freq]
 
-        if check_output:
+        if self.session.check_output:
             if self.nc_check_ice(fdiag,freq,dims):
                 return()
                 import pdb; pdb.set_trace()
@@ -2307,6 +2737,8 @@ class CICE:
            #this_freq = something line "'m'" so need to remove ' for comparison to work
            if not this_freq.strip("'") in diag_freq:
               plog(fdiag+" not currently output at "+freq+" - adding..")
+              pevent('added',component='cice',diag=fdiag,freq=freq)
+              self.additions.append((fdiag,freq))
               #if diag_freq is just 'x' we replace with this_freq
               if "x" in diag_freq:
                  diag_freq=this_freq
@@ -2353,6 +2785,7 @@ class CICE:
 
            else:
               plog(fdiag+" is already output at "+freq)
+              pevent('present',component='cice',diag=fdiag,freq=freq)
               
 
         else:
@@ -2362,8 +2795,9 @@ class CICE:
               import pdb; pdb.set_trace()
 
            else:
-              plog(bold(fdiag+" not found - SKIPPING"))
-              self.missing.append(diag)
+              pwarn(bold(fdiag+" not found - SKIPPING"))
+              pevent('missing',component='cice',diag=fdiag,freq=freq,reason='not a CICE diagnostic')
+              self.missing.append(fdiag)
        
 
         return()
@@ -2391,12 +2825,12 @@ class CICE:
 
 
         #is this diag in the cf mapping tables?
-        if not diag in um.cf_to_stash:
+        if not diag in self.session.um.cf_to_stash:
            #No - so let's guess it is like the CICE diags
            fdiag='f_'+diag
         else:
            #OK attempt to extract
-           this_map=um.cf_to_stash[diag]
+           this_map=self.session.um.cf_to_stash[diag]
            this_expression=this_map['expression']
            pattern = r'm\d{2}s\d{2}i\d{3}\[.*?\]'
            matches = re.findall(pattern, this_expression)
@@ -2404,7 +2838,7 @@ class CICE:
               #Aha - this IS a sea ice diagnostics, but the mapping files use atmosphere diagnostics to build in
               #So call the UM diagnostics function, and then return
               plog("We need to add UM diagnostics for this "+diag+" CICE diagnostic!")
-              um.add_cf_diagnostic(line)
+              self.session.um.add_cf_diagnostic(line)
               plog("Done")
               return()
            else:
@@ -2550,7 +2984,7 @@ class CICE:
             self.rose['namelist:setup_nml']=setup
 
         import pdb; pdb.set_trace()
-        this_map=um.cf_to_stash[diag]
+        this_map=self.session.um.cf_to_stash[diag]
         fdiag='f_'+diag
         this_section=self.rose['namelist:icefields_nml']
         if fdiag in this_section:
@@ -2598,13 +3032,26 @@ class CICE:
 
 ################### OCEAN
 
+def index_field_defs(tree):
+    #field elements in field_def.xml by name and by id, in document order - the same as findall(".//field[@name=...]")
+    index={'name':{},'id':{}}
+    for field in tree.getroot().iter('field'):
+        for key in ['name','id']:
+            if key in field.attrib:
+                index[key].setdefault(field.attrib[key],[]).append(field)
+    return(index)
+
+
 class Nemo:
     #NEMO diagnostics class
 
-    def __init__(self):
+    def __init__(self,session,source=None):
     #reads in all configuration files
     #and sets up all mappings
+    #source is an optional iodef xml to read in place of the suite one (eg the output of a previous run)
 
+        self.session=session
+        self.config=session.config
         self.freq_map={'mon':'1mo', 'day':'1d'}
 
 
@@ -2613,37 +3060,51 @@ class Nemo:
 
         self.missing=[] # list of diagnostics we failed to add!
         self.added=[] # list of diagnostics we succesfully to added!
+        self.added_fields=[] # the field elements added, in their files
 
         self.nemo_diagnostic_request=[]
         self.nemo_diagnostic_request_off=[]
         self.nemo_diagnostic_request_filename=''
-        self.read_ocean_xml()
+        with profiler.stage('iodef xml'):
+            self.read_ocean_xml(source)
         self.file_element_id_list=self.get_file_ids()
         #self.rose={}
-        #this can now be a comma-separated list of xml files
-        nemo_field_def_files=main_config['main']['nemo_def'].split(',')
+        #the field definitions are shared by all the Nemo instances in a session - fields are copied out of them, never moved
+        with profiler.stage('field_def xml'):
+            self.nemo_full_diagnostics=session.reference_data('nemo_def')
+            #name and id lookups into the field definitions
+            self.field_def_index=session.reference_data('nemo_def_index')
+
+
+    @staticmethod
+    def read_field_defs(nemo_field_def_files):
+        #this can now be a list of xml files
         #run over each file
         xml_flag=True
         for nemo_field_def_file in nemo_field_def_files:
             if not os.path.isfile(nemo_field_def_file):
-                plog(nemo_field_def_file+" does not exist")
+                perror(nemo_field_def_file+" does not exist")
                 exit()
             #loop over all files, appending to the first XML structure as we go
             if xml_flag:
-                self.nemo_full_diagnostics = ET.parse(nemo_field_def_file)
-                first_root=self.nemo_full_diagnostics.getroot()
+                nemo_full_diagnostics = ET.parse(nemo_field_def_file)
+                first_root=nemo_full_diagnostics.getroot()
                 xml_flag=False
             else:
                 next_ET=ET.parse(nemo_field_def_file)
                 next_root=next_ET.getroot()
                 for element in next_root:
                     first_root.append(element)
-                    
-        
-        
+        return(nemo_full_diagnostics)
 
 
-   
+    def find_field_defs(self,key,value):
+        #the field definitions with name (or id) value
+        return(self.field_def_index[key].get(value,[]))
+
+
+
+   
     def get_file_ids(self):
         #compile list of the file element ids
         id_list=[]
@@ -2659,14 +3120,15 @@ class Nemo:
  
 
         
-    def read_rose_app_conf(self,file):
+    @staticmethod
+    def read_rose_app_conf(file):
         #read in NEMO configuration XML
         config = configparser.ConfigParser() 
         #turn of the lowercaseization of keys
         config.optionxform = lambda option: option
         configFilePath = file
         if not os.path.isfile(file):
-            plog("ROSE conf file "+file+" does not exist")
+            perror("ROSE conf file "+file+" does not exist")
             exit()
            
         with open(configFilePath) as stream:
@@ -2677,11 +3139,11 @@ class Nemo:
   
         return(config)
 
-    def read_ocean_xml(self):
+    def read_ocean_xml(self,source=None):
         um_nemo_conf="app/xml/rose-app.conf"
 
-        self.rose_conf_file=main_config['user']['job_path']+um_nemo_conf
-        self.rose=self.read_rose_app_conf(self.rose_conf_file)
+        self.rose_conf_file=self.config['user']['job_path']+um_nemo_conf
+        self.rose=self.session.read_suite_file(self.rose_conf_file,Nemo.read_rose_app_conf)
 
         #find keys containing the ocean diag filename
         diag_keys=[key for key in self.rose.keys() if 'iodef_nemo.xml' in key]
@@ -2698,8 +3160,9 @@ class Nemo:
             plog(self.ocean_xml_filename+' does not exist?')
             import pdb; pdb.set_trace()
         #read xml file
-    
-        self.nemo_diagnostic_request=ET.ElementTree(file=self.ocean_xml_filename)
+        #ocean_xml_filename is still used to name the output, even if we read from source
+        self.ocean_xml_source=source if source else self.ocean_xml_filename
+        self.nemo_diagnostic_request=self.session.read_suite_file(self.ocean_xml_source,Nemo.read_iodef)
         #root=tree.getroot()
         self.nemo_diagnostic_request_off=self.get_nemo_commented_fields(self.nemo_diagnostic_request)
         self.nemo_diagnostic_request_filename='app'+self.ocean_xml_filename.split('app')[-1]
@@ -2707,6 +3170,21 @@ class Nemo:
 
 
 
+    @staticmethod
+    def read_iodef(file):
+        return(ET.ElementTree(file=file))
+
+
+    @staticmethod
+    def iodef_filename(rose_conf_file,rose):
+        #the iodef xml named in the xml rose-app.conf, or None if there isn't exactly one
+        diag_keys=[key for key in rose.keys() if 'iodef_nemo.xml' in key]
+        if len(diag_keys)!=1:
+            return(None)
+        this_dir='/'.join(rose_conf_file.split('/')[0:-1])
+        return(this_dir+'/file/'+rose[diag_keys[0]]['source'].split('/')[-1])
+
+
     def get_nemo_commented_fields(self,xml):
         '''
         extract all the commented out diagnostics from a iodef_nemo.xml file
@@ -2723,8 +3201,9 @@ class Nemo:
 
 
     
+    @profiler.timed('Nemo.nc_check_ocean')
     def nc_check_ocean(self,diag,freq,dims):
-        plog("Check Ocean output")
+        pdebug("Check Ocean output")
 
         # Define the dictionary with the coordinate replacements
         replacements = {
@@ -2745,9 +3224,9 @@ class Nemo:
         if diag=='vowflisf' and not 'olevel' in dims:
             plog("vowflisf is actually written out on ocean levels - adjusting")
             dims=dims+' olevel'
-        matches=[key for key in nc_output if key.nc_get_variable()==diag]
+        matches=[key for key in self.session.nc_output if key['variable']==diag]
         if matches:
-            plog(diag+" found in NC output")
+            pdebug(diag+" found in NC output")
             #import pdb; pdb.set_trace()
             #does this have the required domain?
 
@@ -2760,7 +3239,7 @@ class Nemo:
             ##HERE
             ## SPATIAL domain doesn't map perfectly as ICE is IJ not long lat!
             for this_match in matches:
-                nc_domain1=[item.nc_get_variable() for item in this_match.coords().values()]
+                nc_domain1=this_match['coord_variables']
                 #nc_domain=sorted([item.replace('nav_lon','longitude').replace('nav_lat','latitude').replace('time_counter','time').replace('deptht','olevel').replace('depthu','olevel').replace('depthv','olevel').replace('depthw','olevel')  for item in nc_domain1])
 
                 nc_domain=[]
@@ -2776,28 +3255,35 @@ class Nemo:
                 if spatial_domain_cf_list==nc_domain:
                     #spatial domains match!
                     ##THIS DOESN'T work for CICE
-                    #try and get the frequency of this variable from the original file name - should be 1d or 1m
-                    match_freq=this_match.properties()['name'].split('_')[1]
+                    #the frequency of this variable comes from its time coordinate
+                    match_freq=this_match['freq']
+                    if not match_freq:
+                        #otherwise try and get it from the original file name - should be 1d or 1m
+                        match_freq=this_match['name'].split('_')[1]
                     if freq == match_freq:
                         #time domains match
-                        plog("Time and spatial domains match")
+                        pdebug("Time and spatial domains match")
+                        pevent('nc_found',component='nemo',diag=diag,freq=freq,dims=dims)
                         self.nc_found.append([diag,freq,dims])
+                        self.session.nc_match('nemo',diag,this_match)
                         return(True)
 
         else:
-            plog(diag+" not found in NC output")
+            pdebug(diag+" not found in NC output")
 
-        plog("Couldn't find "+diag+" in NC for "+dims+" at "+freq)
+        pwarn("Couldn't find "+diag+" in NC for "+dims+" at "+freq)
+        pevent('nc_missing',component='nemo',diag=diag,freq=freq,dims=dims)
         self.nc_missing.append([diag,freq,dims])
         return(False)
 
 
+    @profiler.timed('Nemo.addOceanDiag')
     def addOceanDiag(self,diag,freq,dims):
         '''
         add an ocean diagnostic to the ocean XML
         '''
 
-        if check_output:
+        if self.session.check_output:
             self.nc_check_ocean(diag,freq,dims)
             return()
                 
@@ -2808,8 +3294,9 @@ class Nemo:
         this_name_suffix=self.get_name_suffix(diag)
         if this_name_suffix==None:
 
-            plog("Couldn't find the name_suffix!")
-            plog("Unable to add "+diag)
+            pwarn("Couldn't find the name_suffix!")
+            pwarn("Unable to add "+diag)
+            pevent('missing',component='nemo',diag=diag,freq=freq,reason='no name_suffix')
             self.missing.append(diag)
             #import pdb; pdb.set_trace()
             return()
@@ -2842,6 +3329,7 @@ class Nemo:
                     #diagnostic already exists at the requested output frequency
                     #and presumably at the correct grid/name_suffix
                     plog(diag+" already exists at "+freq)
+                    pevent('present',component='nemo',diag=diag,freq=freq)
                     return()
 
             #we are still here, so diag exists, but not at the correct frequency
@@ -2886,8 +3374,11 @@ class Nemo:
                 #set the text (if there is any)
                 new_file_element.text=parent.text
                 plog("Adding "+diag+" to "+file_id)
-                new_file_element.append(deepcopy(field))
+                pevent('added',component='nemo',diag=diag,freq=freq,file=file_id)
+                new_field=deepcopy(field)
+                new_file_element.append(new_field)
                 self.added.append(diag)
+                self.added_fields.append(new_field)
                 plog("Done")
                 return()
 
@@ -2899,11 +3390,14 @@ class Nemo:
                     #found the grid
                     #this file is the correct place to add the diagnostic
                     plog("copying "+diag+" to "+file.attrib['id'])
+                    pevent('added',component='nemo',diag=diag,freq=freq,file=file.attrib['id'])
                     self.added.append(diag)
-                    file.append(deepcopy(fields[0]))
+                    new_field=deepcopy(fields[0])
+                    file.append(new_field)
+                    self.added_fields.append(new_field)
                     return()
 
-            plog("Couldn't find "+this_name_suffix+"in "+file_groups[0])
+            plog("Couldn't find "+this_name_suffix+" in "+file_group.attrib['id'])
             import pdb; pdb.set_trace()
 
        
@@ -2930,19 +3424,19 @@ class Nemo:
 
         #is this really a CICE diagnostic?
 
-        cice_diagnostics=cice.rose['namelist:icefields_nml']
+        cice_diagnostics=self.session.cice.rose['namelist:icefields_nml']
         #if this diag is not mapped in the cf mapping AND exists in the cice_diagnostics
         #it must be a cice diagnostic!
-        if not diag in um.cf_to_stash and 'f_'+diag in cice_diagnostics:
+        if not diag in self.session.um.cf_to_stash and 'f_'+diag in cice_diagnostics:
            #YES!
            plog(diag+" is a CICE diagnostic - adding to CICE")
-           cice.addIceDiag(line)
+           self.session.cice.addIceDiag(line)
            return()
         
         
         #is this diag mapped in the cf mapping table?
-        if diag in um.cf_to_stash:
-           cf_mapping_expression=um.cf_to_stash[diag]['expression']
+        if diag in self.session.um.cf_to_stash:
+           cf_mapping_expression=self.session.um.cf_to_stash[diag]['expression']
            if not cf_mapping_expression==diag:
               #the mapping expression is not just the diag name
               #need to break down the mapping expression and add each sub diagnostic in turn
@@ -3142,7 +3636,7 @@ class Nemo:
           for match in matches:
              new_line=dict(line)
              #new_line['variable']=
-             um.add_stash(match,freq,dims)
+             self.session.um.add_stash(match,freq,dims)
              import pdb; pdb.set_trace()
        
            
@@ -3170,19 +3664,19 @@ class Nemo:
 
         #is this really a CICE diagnostic?
 
-        cice_diagnostics=cice.rose['namelist:icefields_nml']
+        cice_diagnostics=self.session.cice.rose['namelist:icefields_nml']
         #if this diag is not mapped in the cf mapping AND exists in the cice_diagnostics
         #it must be a cice diagnostic!
-        if not diag in um.cf_to_stash and 'f_'+diag in cice_diagnostics:
+        if not diag in self.session.um.cf_to_stash and 'f_'+diag in cice_diagnostics:
            #YES!
            plog(diag+" is a CICE diagnostic - adding to CICE")
-           cice.addIceDiag(line)
+           self.session.cice.addIceDiag(line)
            return()
         
         
         #is this diag mapped in the cf mapping table?
-        if diag in um.cf_to_stash:
-           cf_mapping_expression=um.cf_to_stash[diag]['expression']
+        if diag in self.session.um.cf_to_stash:
+           cf_mapping_expression=self.session.um.cf_to_stash[diag]['expression']
            if not cf_mapping_expression==diag:
               #the mapping expression is not just the diag name
               plog(diag+" is mapped in the cf mappings")
@@ -3194,7 +3688,7 @@ class Nemo:
                  #this is a stash diagnostic
                  plog(cf_mapping_expression+" is a stash diagnistics for the UM")
                  plog("adding stash diagnostics")
-                 um.add_cf_diagnostic(line)
+                 self.session.um.add_cf_diagnostic(line)
                  return()
                  
                  
@@ -3360,6 +3854,7 @@ class Nemo:
             plog("Couldn't find "+this_name_suffix+"in "+file_groups[0])
             import pdb; pdb.set_trace()
 
+    @profiler.timed('Nemo.get_name_suffix')
     def get_name_suffix(self,diag):
         #returns the correct name_suffix/grid for a given diagnostic
         #diag is a cf variable name
@@ -3370,16 +3865,16 @@ class Nemo:
         if len(fields)==0:
             #we didn't find anything!
             #try field_def.xml
-            fields=self.nemo_full_diagnostics.findall(".//field[@name='"+diag+"']")
+            fields=self.find_field_defs('name',diag)
             if len(fields)==0:
                 #nothing here either!
-                plog(bold(diag+" is unknown cf variable!"))
+                pwarn(bold(diag+" is unknown cf variable!"))
                 #loop over extra nemo fields added in main_config
-                for i in [key for key in main_config if 'nemo_field' in key]:
+                for i in [key for key in self.config if 'nemo_field' in key]:
                    if diag in i:
                       plog("Mapping for "+diag+" found in config!")
-                      this_nemo_field_ref=main_config[i]['field_ref']
-                      this_nemo_file=main_config[i]['nemo_file']
+                      this_nemo_field_ref=self.config[i]['field_ref']
+                      this_nemo_file=self.config[i]['nemo_file']
                       plog("Adding "+this_nemo_field_ref+" to the nemo "+this_nemo_file+" file stream")
                       ##Can we add this directly? But really need to make new mapping..?
                       
@@ -3396,7 +3891,7 @@ class Nemo:
             field_name=fields[0].attrib['name']
             field_ref=fields[0].attrib['field_ref']
             #find the diagnostics with this field id
-            diags=self.nemo_full_diagnostics.findall(".//field[@id='"+field_ref+"']")
+            diags=self.find_field_defs('id',field_ref)
             if len(diags)==0:
                 plog("No diags found with field_ref "+field_ref)
                 import pdb; pdb.set_trace()
@@ -3451,7 +3946,7 @@ class Nemo:
 
 
     def get_diag_from_field_def(self,diag):
-        fields=self.nemo_full_diagnostics.findall(".//field[@name='"+diag+"']")
+        fields=self.find_field_defs('name',diag)
 
 
         
@@ -3465,7 +3960,7 @@ class Nemo:
         field_ref=fields[0].attrib['field_ref']
         field_text=fields[0].text
         #find the diagnostics with this field id
-        diags=self.nemo_full_diagnostics.findall(".//field[@id='"+field_ref+"']")
+        diags=self.find_field_defs('id',field_ref)
         if len(diags)==0:
             plog("No diags found with field_ref "+field_ref)
             import pdb; pdb.set_trace()
@@ -3499,6 +3994,7 @@ class Nemo:
 
             
 
+    @profiler.timed('Nemo.add_field_to_file_group')
     def add_field_to_file_group(self,field,file_group,name_suffix):
         '''
         
@@ -3509,11 +4005,11 @@ class Nemo:
         #here we can remap using the [file_map] section in the main config file
         
         #do we have a file_map section in the main config?
-        if 'file_map' in main_config:
+        if 'file_map' in self.config:
             #is this name_suffix remapped?
-            if name_suffix in main_config['file_map']:
+            if name_suffix in self.config['file_map']:
                 #yes - so replace with remapping
-                name_suffix=main_config['file_map'][name_suffix]
+                name_suffix=self.config['file_map'][name_suffix]
 
         
             
@@ -3552,15 +4048,18 @@ class Nemo:
                 file_id=self.get_unique_file_id()
                 plog("Creating new file element "+file_id)
                 new_attrib['id']=file_id
-                file_element_id_list.append(file_id)
+                self.file_element_id_list.append(file_id)
                 #set the updated attributes#
                 new_file_element.attrib.update(new_attrib)
                 #create a dictionary from the parent attributes
                 diag=field.attrib['name']
                 new_file_element.text="\n"
                 plog("Adding "+diag+" to "+file_id)
-                new_file_element.append(deepcopy(field))
+                pevent('added',component='nemo',diag=diag,file=file_id,name_suffix=name_suffix)
+                new_field=deepcopy(field)
+                new_file_element.append(new_field)
                 self.added.append(diag)
+                self.added_fields.append(new_field)
                 plog("Done")
                 return()
         #here - there are multiple files in this file_group for the chosen output freq
@@ -3573,8 +4072,11 @@ class Nemo:
                 diag=field.attrib['name']
                 #this file is the correct place to add the diagnostic
                 plog("copying "+diag+" to "+file.attrib['id'])
-                file.append(deepcopy(field))
+                pevent('added',component='nemo',diag=diag,file=file.attrib['id'],name_suffix=name_suffix)
+                new_field=deepcopy(field)
+                file.append(new_field)
                 self.added.append(diag)
+                self.added_fields.append(new_field)
                 return()
 
         
@@ -3589,17 +4091,21 @@ class Nemo:
         #get a new file id
         new_file_id=self.get_unique_file_id()
         new_file.attrib['id']=new_file_id
+        self.file_element_id_list.append(new_file_id)
         #set the name suffix
         new_file.attrib['name_suffix']=name_suffix
         new_file.attrib['description']='ocean '+name_suffix.replace('_','')+' variables'
         #append field
         plog("Created new file "+new_file_id+" for "+name_suffix)
-        new_file.append(deepcopy(field))
+        new_field=deepcopy(field)
+        new_file.append(new_field)
         diag=field.attrib['name']
         self.added.append(diag)
+        self.added_fields.append(new_field)
         #now add this new file (and field) to the file_group
         file_group.append(new_file)
         plog("Adding "+diag+" to "+new_file.attrib['id'])
+        pevent('added',component='nemo',diag=diag,file=new_file.attrib['id'],name_suffix=name_suffix)
 
 
     def get_file_group(self,this_freq):
@@ -3628,6 +4134,115 @@ class Nemo:
         return(new_file_id)
 
 
+    def output_fields(self):
+        #the fields the suite already writes - by name and field_ref - in the enabled files of the iodef xml
+        fields=set()
+        for file in self.nemo_diagnostic_request.getroot().iter('file'):
+            group=file.getparent()
+            if '.FALSE.' in [file.get('enabled','').upper(),group.get('enabled','').upper()]:
+                continue
+            for field in file.findall('field'):
+                fields.update([name for name in [field.get('name'),field.get('field_ref')] if name])
+        return(fields)
+
+
+    def file_limits(self):
+        #the most fields, and bytes per model year, a file may hold - from the [nemo_files] section of the config
+        limits={'max_fields':None,'max_volume':None}
+        for key in limits:
+            if key in self.config['nemo_files']:
+                try:
+                    limits[key]=float(self.config['nemo_files'][key])
+                except ValueError:
+                    perror("[nemo_files]:"+key+" must be a number")
+                    exit()
+                if not limits[key]>0:
+                    perror("[nemo_files]:"+key+" must be a positive number")
+                    exit()
+        if limits['max_volume'] is not None:
+            limits['max_volume']*=1024**3
+        return(limits['max_fields'],limits['max_volume'])
+
+
+    def new_part_file(self,file_group,files,suffix):
+        #a new, empty file for the grid of files - like the first, with a new id and name_suffix (eg _grid_T_2)
+        part=len(files)+1
+        while suffix+'_'+str(part) in [file.get('name_suffix') for file in files]:
+            part+=1
+        new_file=ET.Element(files[0].tag,files[0].attrib)
+        new_file.text=files[0].text
+        new_file.tail=files[-1].tail
+        file_id=self.get_unique_file_id()
+        new_file.attrib['id']=file_id
+        new_file.attrib['name_suffix']=suffix+'_'+str(part)
+        self.file_element_id_list.append(file_id)
+        files[-1].addnext(new_file)
+        plog("Created new file "+file_id+" for "+suffix+" in "+file_group.get('id',''))
+        return(new_file)
+
+
+    def balance_files(self):
+        '''
+        split the output files so that none holds more than [nemo_files]:max_fields fields or max_volume GB per model year
+        the files of each grid (name_suffix) in each file_group are taken together - fields stay where they are while their
+        grid is within the limits - otherwise enough new files (with a new id and name_suffix, eg _grid_T_2) are added to
+        share the fields out evenly, keeping each field in its file where it can, and moving the rest to the emptiest file
+        returns a list of (field name, from file id, to file id)
+        '''
+        max_fields,max_volume=self.file_limits()
+        estimator=VolumeEstimator(self.config)
+        root=self.nemo_diagnostic_request.getroot()
+        moves=[]
+        for file_group in root.iter('file_group'):
+            grids={}
+            for file in file_group.findall('file'):
+                suffix=re.sub(r'_\d+$','',file.get('name_suffix',''))
+                grids.setdefault(suffix,[]).append(file)
+            for suffix,files in grids.items():
+                sizes={file:[(field,estimator.nemo_field(self,field)) for field in file.findall('field')] for file in files}
+                def full(count,volume):
+                    return((max_fields is not None and count>max_fields) or (max_volume is not None and volume>max_volume and count>1))
+                if not any(full(len(sizes[file]),sum(size for field,size in sizes[file])) for file in files):
+                    continue
+                #the number of files needed, and the share of the fields each should hold
+                count=sum(len(sizes[file]) for file in files)
+                volume=sum(size for file in files for field,size in sizes[file])
+                parts=len(files)
+                if max_fields is not None:
+                    parts=max(parts,math.ceil(count/max_fields))
+                if max_volume is not None:
+                    parts=max(parts,math.ceil(volume/max_volume))
+                share_fields=math.ceil(count/parts)
+                share_volume=volume/parts
+                while len(files)<parts:
+                    files.append(self.new_part_file(file_group,files,suffix))
+                load={file:[0,0] for file in files}
+                overflow=[]
+                for file in list(sizes):
+                    for field,size in sizes[file]:
+                        if load[file][0]<share_fields and (max_volume is None or load[file][1]+size<=share_volume or load[file][0]==0):
+                            load[file][0]+=1
+                            load[file][1]+=size
+                        else:
+                            overflow.append((field,size))
+                for field,size in overflow:
+                    room=[file for file in files if not full(load[file][0]+1,load[file][1]+size)]
+                    if room:
+                        target=min(room,key=lambda file:(load[file][1],load[file][0]) if max_volume else (load[file][0],load[file][1]))
+                    else:
+                        target=self.new_part_file(file_group,files,suffix)
+                        files.append(target)
+                        load[target]=[0,0]
+                    source=field.getparent()
+                    target.append(field)
+                    load[target][0]+=1
+                    load[target][1]+=size
+                    name=field.get('name',field.get('field_ref'))
+                    moves.append((name,source.get('id'),target.get('id')))
+                    pevent('moved',component='nemo',diag=name,source=source.get('id'),file=target.get('id'))
+        return(moves)
+
+
     def write(self,output_file):
         self.nemo_diagnostic_request.write(output_file)
         plog("Written "+output_file)
@@ -3661,26 +4276,760 @@ class Nemo:
 
 
 
-def read_cf_diagnostics():
-    cf_diagnostics_file=main_config['user']['cf_diagnostics_file']
+#############  Output volume estimates
 
-    if not os.path.isfile(cf_diagnostics_file):
-        plog("CF Diagnostics CSV file "+cf_diagnostics_file+" does not exist")
-        exit()
+#the model grid the output volumes are estimated for (N96L85 ORCA1) - any of these can be set in a [resolution] section of the config
+default_resolution={'atm_columns':192,
+                    'atm_rows':144,
+                    'model_levels':85,
+                    'soil_levels':4,
+                    'timestep':1200, # atmosphere timestep, seconds
+                    'ocean_columns':362,
+                    'ocean_rows':332,
+                    'ocean_levels':75,
+                    'ocean_timestep':2700,
+                    'ice_categories':5,
+                    'days_per_year':360,
+                    'bytes_per_value':4}
 
-    # Open the CSV cf_diagnostics file
-    with open(cf_diagnostics_file, 'r') as infile:
-        # Create a CSV reader object for reading as a dictionary
-        csv_reader = csv.DictReader(infile)
+#seconds in each unit of the STASH time profile unt3 and of the XIOS output_freq
+stash_time_units={2:3600,3:86400}
+xios_time_units={'mi':60,'h':3600,'d':86400,'mo':30*86400,'y':360*86400}
+cice_time_units={'hour':3600,'day':86400,'mon':30*86400,'year':360*86400}
 
-        # Convert the CSV data into a list of dictionaries
-        variable_list = list(csv_reader)
-    return(variable_list)
+
+class VolumeEstimator:
+    '''
+    estimates the bytes written per model year by STASH requests, NEMO fields and CICE diagnostics
+    from the STASHmaster and domain levels, the output frequency of the time profile or file, and the NEMO grid
+    these are the sizes of the uncompressed fields - headers, coordinates and compression are ignored
+    '''
+    def __init__(self,config):
+        self.resolution=dict(default_resolution)
+        if 'resolution' in config:
+            for key in config['resolution']:
+                if not key in default_resolution:
+                    perror("Unknown setting "+key+" in the [resolution] section - the settings are "+' '.join(default_resolution))
+                    exit()
+                value=to_int(config['resolution'][key])
+                if value is None or value<=0:
+                    perror("[resolution]:"+key+" must be a positive whole number")
+                    exit()
+                self.resolution[key]=value
+
+    def per_year(self,seconds):
+        #outputs per model year at a period of seconds
+        return(self.resolution['days_per_year']*86400/seconds)
+
+    def stash_levels(self,stash,domain):
+        #the number of levels (times pseudo levels) a STASH code is output on for a domain
+        res=self.resolution
+        values=dict(domain.items) if domain is not None else {}
+        iopl=domain.iopl if domain is not None else None
+        if iopl is None:
+            #no domain - go by the STASHmaster level type
+            iopl={1:1,2:2,6:6}.get(stash['LevelT'],5) if stash else 5
+        if iopl in [1,2,6]:
+            #model rho, theta or soil levels - a range or a list
+            default=res['soil_levels'] if iopl==6 else res['model_levels']
+            levb,levt=to_int(values.get('levb')),to_int(values.get('levt'))
+            if to_int(values.get('ilevs'))==2 and 'levlst' in values:
+                levels=len(values['levlst'].split(','))
+            elif levb is not None and levt is not None:
+                levels=levt-levb+1
+            else:
+                levels=default
+        elif iopl==5:
+            levels=1
+        else:
+            #pressure, height, theta, PV or cloud threshold levels - always a list
+            levels=1
+            for key in ['rlevlst','levlst']:
+                if key in values:
+                    levels=len(values[key].split(','))
+                    break
+        if domain is not None and domain.pslist:
+            levels*=len(domain.pslist)
+        elif stash and stash['PseudT']>0:
+            levels*=max(stash['PseudL']-stash['PseudF']+1,1)
+        #vertical means are output on one level
+        if to_int(values.get('imn'))==2:
+            levels=1
+        return(max(levels,1))
+
+    def stash_points(self,domain):
+        #the horizontal points in a STASH field - zonal, meridional and area means reduce the grid
+        res=self.resolution
+        imn=to_int(dict(domain.items).get('imn')) if domain is not None else None
+        if imn==3:
+            return(res['atm_rows'])
+        if imn==4:
+            return(res['atm_columns'])
+        if imn==5:
+            return(1)
+        return(res['atm_columns']*res['atm_rows'])
+
+    def stash_outputs(self,profile):
+        #outputs per model year for a STASH time profile
+        if profile is None:
+            return(0)
+        values=profile.values
+        ifre=to_int(values.get('ifre'))
+        if to_int(values.get('iopt'))!=1 or not ifre:
+            #output at a list of times - count them
+            for key in ['itimes','iser']:
+                if key in values:
+                    return(len(values[key].split(',')))
+            return(0)
+        unit=to_int(values.get('unt3'))
+        seconds=self.resolution['timestep'] if unit==1 else stash_time_units.get(unit,86400)
+        return(self.per_year(ifre*seconds))
+
+    def stash_request(self,um,request,profiles=None):
+        #bytes per model year for a StashRequest - profiles is um.time_profiles_by_name(), if it is to hand
+        if profiles is None:
+            profiles=um.time_profiles_by_name()
+        stash=um.stash_levels.get('m01s'+str(request.isec).zfill(2)+'i'+str(request.item).zfill(3))
+        domain=um.domains_by_name.get(request.dom_name)
+        profile=profiles.get(request.tim_name)
+        return(self.stash_levels(stash,domain)*self.stash_points(domain)*self.stash_outputs(profile)
+               *self.resolution['bytes_per_value'])
+
+    def stash_stream(self,um,request):
+        #the output stream a StashRequest writes to
+        return(self.usage_stream(um,request.use_name))
+
+    def usage_stream(self,um,use_name):
+        #the output stream of a usage - the xios file_id, or the usage itself in the UM STASH
+        usage=um.usages.get(use_name)
+        if usage is not None and usage.stream:
+            return(usage.stream)
+        return(unquote(use_name))
+
+    def xios_outputs(self,output_freq,timestep):
+        #outputs per model year for an XIOS output_freq like 1mo, 5d or 1ts
+        match=re.match(r'(\d+)(ts|mi|h|d|mo|y)$',output_freq or '')
+        if not match:
+            return(0)
+        count,unit=int(match[1]),match[2]
+        seconds=timestep if unit=='ts' else xios_time_units[unit]
+        return(self.per_year(count*seconds))
+
+    def nemo_field(self,nemo,field):
+        #bytes per model year for a field element in a NEMO file
+        res=self.resolution
+        file=field.getparent()
+        output_freq=file.get('output_freq')
+        if output_freq is None and file.getparent() is not None:
+            output_freq=file.getparent().get('output_freq')
+        #the grid is on the field, or on the field it refers to in field_def.xml, or on its field_group
+        grid=field.get('grid_ref')
+        if grid is None:
+            for definition in nemo.find_field_defs('id',field.get('field_ref')):
+                for element in [definition]+list(definition.iterancestors()):
+                    if element.get('grid_ref'):
+                        grid=element.get('grid_ref')
+                        break
+                break
+        grid=grid or ''
+        suffix=file.get('name_suffix','')
+        if 'scalar' in grid or 'scalar' in suffix:
+            points,levels=1,1
+        else:
+            points=res['ocean_columns']*res['ocean_rows']
+            levels=res['ocean_levels'] if '3D' in grid else 1
+            if 'ncatice' in grid:
+                levels*=res['ice_categories']
+        return(points*levels*self.xios_outputs(output_freq,res['ocean_timestep'])*res['bytes_per_value'])
+
+    def nemo_stream(self,field):
+        file=field.getparent()
+        return('nemo '+file.get('id','')+' '+file.get('name_suffix',''))
+
+    def cice_diagnostic(self,fdiag,freq):
+        #bytes per model year for a CICE history diagnostic - 2D on the ocean grid
+        res=self.resolution
+        seconds=res['ocean_timestep'] if freq=='timestep' else cice_time_units.get(freq)
+        if seconds is None:
+            return(0)
+        return(res['ocean_columns']*res['ocean_rows']*self.per_year(seconds)*res['bytes_per_value'])
+
+    def estimate(self,components):
+        '''
+        the estimated volume of each addition made by the components of a plan, and the totals for each stream
+        returns {'additions':[{'component','diag','stream','bytes'}..],'streams':{stream:bytes}}
+        '''
+        additions=[]
+        um=components.get('um')
+        if um is not None:
+            profiles=um.time_profiles_by_name()
+            for request in um.new_stash_requests:
+                additions.append({'component':'um',
+                                  'diag':'m01s'+str(request.isec).zfill(2)+'i'+str(request.item).zfill(3),
+                                  'stream':self.stash_stream(um,request),
+                                  'bytes':self.stash_request(um,request,profiles)})
+        nemo=components.get('nemo')
+        if nemo is not None:
+            for field in nemo.added_fields:
+                additions.append({'component':'nemo','diag':field.get('name',field.get('field_ref')),
+                                  'stream':self.nemo_stream(field),'bytes':self.nemo_field(nemo,field)})
+        cice=components.get('cice')
+        if cice is not None:
+            for fdiag,freq in cice.additions:
+                additions.append({'component':'cice','diag':fdiag,'stream':'cice '+freq,
+                                  'bytes':self.cice_diagnostic(fdiag,freq)})
+        streams={}
+        for addition in additions:
+            addition['bytes']=int(addition['bytes'])
+            streams[addition['stream']]=streams.get(addition['stream'],0)+addition['bytes']
+        return({'additions':additions,'streams':streams})
+
+
+def human_bytes(size):
+    for unit in ['B','KB','MB','GB','TB']:
+        if size<1024 or unit=='TB':
+            return(f'{size:.1f} {unit}')
+        size/=1024
+
+
+#positions (from 0) of the lookup header words read by read_um_headers()
+#https://reference.metoffice.gov.uk/um/f3 - UMDP F3, the fieldsfile and PP lookup table
+um_lookup_words={'lbyr':0,'lbmon':1,'lbdat':2,'lbhr':3,'lbmin':4,
+                 'lbyrd':6,'lbmond':7,'lbdatd':8,'lbhrd':9,'lbmind':10,
+                 'lbtim':12,'lbrel':21,'lbproc':24,'lbvc':25,'lblev':32,'lbuser4':41,'lbuser5':42}
+#BLEV, the level value, is the only real word needed
+um_lookup_blev=51
+
+#the output level coordinate for each LBVC level type, as it is named in the netcdf output
+#1 (height) is a single level, so like a single height in the netcdf is left out
+um_level_types={65:'model_level_number',
+                2:'model_level_number',
+                9:'model_level_number',
+                6:'depth',
+                8:'plev'}
+
+#the requested dimension names as the model writes them out - see UM.nc_check_stash
+um_domain_replacements={'height10m':'',
+                        'height2m':'',
+                        'alevhalf':'model_level_number',
+                        'alevel':'model_level_number',
+                        'sdepth1':'depth',
+                        'sdepth':'depth',
+                        'typesi':'',
+                        'typeli':''
+                        }
+
+
+def fieldsfile_lookup(buffer,np):
+    #the lookup table of a 64 bit big endian fieldsfile, or None if buffer isn't one
+    #the fixed length header is 256 words; FIXHD(150-152) are the start and dimensions of the lookup table
+    if len(buffer)<256*8:
+        return(None)
+    fixhd=np.frombuffer(buffer,dtype='>i8',count=256)
+    start,length,count=int(fixhd[149]),int(fixhd[150]),int(fixhd[151])
+    if fixhd[1] not in (1,2,3,4) or not 1<=fixhd[4]<=5 or length not in (64,128) or start<257 or count<0:
+        return(None)
+    if (start-1+length*count)*8>len(buffer):
+        return(None)
+    lookup=np.frombuffer(buffer,dtype='>i8',count=length*count,offset=(start-1)*8).reshape(count,length)
+    return(lookup[:,:64])
+
+
+def pp_lookup(buffer,np):
+    #the headers of a PP file, or None if buffer isn't one
+    #a PP file is fortran sequential records - a 64 word header then the data, each with a 4 byte length
+    #before and after. The length of the first record gives the byte order and word size
+    if len(buffer)<8:
+        return(None)
+    for order in '><':
+        first=int(np.frombuffer(buffer,dtype=order+'i4',count=1)[0])
+        if first in (256,512):
+            break
+    else:
+        return(None)
+    word=order+('i4' if first==256 else 'i8')
+    offsets=[]
+    position=0
+    while position+8<=len(buffer):
+        header=int(np.frombuffer(buffer,dtype=order+'i4',count=1,offset=position)[0])
+        if header!=first or position+header+12>len(buffer):
+            break
+        offsets.append(position+4)
+        data=int(np.frombuffer(buffer,dtype=order+'i4',count=1,offset=position+header+8)[0])
+        position+=header+data+16
+    if not offsets:
+        return(None)
+    return(np.stack([np.frombuffer(buffer,dtype=word,count=64,offset=offset) for offset in offsets]))
+
+
+def read_um_headers(file):
+    '''
+    the lookup headers of the fields in a UM fieldsfile or PP file, without reading any data
+    returns a dict of numpy arrays, one element per field, keyed on the names in um_lookup_words plus 'blev',
+    or None if the file is neither
+    '''
+    import numpy as np
+    with open(file,'rb') as infile:
+        if os.fstat(infile.fileno()).st_size==0:
+            return(None)
+        with mmap.mmap(infile.fileno(),0,access=mmap.ACCESS_READ) as buffer:
+            lookup=fieldsfile_lookup(buffer,np)
+            if lookup is None:
+                lookup=pp_lookup(buffer,np)
+            if lookup is None:
+                return(None)
+            #copy out the words needed, so that nothing refers to the mapped file once it is closed
+            headers={name:lookup[:,index].astype(np.int64) for name,index in um_lookup_words.items()}
+            blev=lookup[:,um_lookup_blev]
+            headers['blev']=blev.view(blev.dtype.byteorder+'f'+str(blev.dtype.itemsize)).astype(np.float64)
+            del lookup,blev
+    #unused lookup entries are filled with -99
+    used=(headers['lbuser4']>0) & (headers['lbrel']!=-99)
+    return({name:headers[name][used] for name in headers})
+
+
+def um_header_hours(headers,suffix,np):
+    #the validity times - T1, or T2 with suffix 'd' - of each field as hours
+    #LBTIM IC (the units digit) is the calendar: 2 is 360 day, otherwise the real calendar is near enough
+    years,months,days=headers['lbyr'+suffix],headers['lbmon'+suffix],headers['lbdat'+suffix]
+    hours=headers['lbhr'+suffix]+headers['lbmin'+suffix]/60.0
+    calendar360=(headers['lbtim']%10)==2
+    days360=((years*12+months-1)*30+days-1)*24.0
+    dates=((years-1970).astype('M8[Y]')+(months-1).astype('m8[M]')).astype('M8[D]')+(days-1).astype('m8[D]')
+    days_real=dates.astype(np.int64)*24.0
+    return(np.where(calendar360,days360,days_real)+hours)
+
+
+def time_period(time_coord):
+    '''
+    the period in hours of a cf time coordinate - the median width of its bounds or, without bounds or with
+    bounds of no width (point data), the median spacing of its values
+    returns (period, bounded) - bounded is True if the period came from the bounds
+    '''
+    import cf
+    import numpy as np
+    time_coord=time_coord.copy()
+    time_coord.Units=cf.Units('hours since 1970-01-01',calendar=time_coord.Units.calendar)
+    if time_coord.has_bounds():
+        bounds=np.asarray(time_coord.bounds.array,dtype=float)
+        period=float(np.median(bounds[:,1]-bounds[:,0]))
+        if period>0:
+            return((period,True))
+    values=np.asarray(time_coord.array,dtype=float).reshape(-1)
+    return((float(np.median(np.diff(values))) if values.size>1 else 0.0,False))
+
+
+def output_frequency(hours,mean):
+    #the cmip frequency name for an output period in hours - 'mon', 'day', '3hr', '6hrPt' etc
+    #mean is False for instantaneous (point) output
+    #times read from files may be a little off whole minutes
+    hours=round(hours*60)/60
+    if hours<=0:
+        return('')
+    if 27*24<=hours<=31*24:
+        name='mon'
+    elif 360*24<=hours<=366*24:
+        name='yr'
+    elif hours==24:
+        name='day'
+    elif hours<1:
+        name='subhr'
+    else:
+        name=f'{hours:g}hr'
+    if not mean:
+        name+='Pt'
+    return(name)
+
+
+def um_header_index(file,headers):
+    '''
+    groups the fields of one file read by read_um_headers() by STASH code, processing (LBPROC, LBTIM) and
+    level type (LBVC), and describes each group as check_output compares it - the frequency and the dimensions
+    returns {stash code:[{'file','lbproc','lbtim','lbvc','levels','pseudo','freq','dims'}..]}
+    '''
+    import numpy as np
+    index={}
+    if not len(headers['lbuser4']):
+        return(index)
+    keys=np.stack([headers['lbuser4'],headers['lbproc'],headers['lbtim'],headers['lbvc']],axis=1)
+    groups,inverse=np.unique(keys,axis=0,return_inverse=True)
+    inverse=inverse.reshape(-1)
+    t1=um_header_hours(headers,'',np)
+    t2=um_header_hours(headers,'d',np)
+    for n,(stash,lbproc,lbtim,lbvc) in enumerate(groups.tolist()):
+        fields=inverse==n
+        levels=len(np.unique(np.stack([headers['lblev'][fields],headers['blev'][fields]],axis=1),axis=0))
+        pseudo=len(np.unique(headers['lbuser5'][fields]))
+        #LBTIM IB (the tens digit) is 2 for a mean or accumulation over T1 to T2, otherwise T1 is a point in time
+        mean=(lbtim//10)%10==2
+        if mean:
+            period=float(np.max(t2[fields]-t1[fields]))
+        else:
+            times=np.unique(t1[fields])
+            period=float(np.min(np.diff(times))) if len(times)>1 else 0.0
+        dims=['latitude','longitude','time']
+        if lbvc in um_level_types and (levels>1 or lbvc==8):
+            level=um_level_types[lbvc]
+            dims.append(level+str(levels) if level=='plev' else level)
+        elif lbvc==1 and levels>1:
+            dims.append('height')
+        if pseudo>1:
+            dims.append('pseudo')
+        code='m01s'+str(stash//1000).zfill(2)+'i'+str(stash%1000).zfill(3)
+        index.setdefault(code,[]).append({'file':file,
+                                          'lbproc':lbproc,
+                                          'lbtim':lbtim,
+                                          'lbvc':lbvc,
+                                          'levels':levels,
+                                          'pseudo':pseudo,
+                                          'freq':output_frequency(period,mean),
+                                          'dims':sorted(dims)})
+    return(index)
+
+
+def field_content(field,memory):
+    '''
+    statistics of the data of a netcdf field, read a slice at a time so that no slice is bigger than memory bytes
+    a whole variable is never loaded - the slices step along the leading axis, or one index of the leading
+    axes at a time along the next axis if a single step is still too big
+    returns {'size','missing','nan','min','max','zero'} - zero is True if every value present is 0
+    '''
+    import numpy as np
+    data=field.data
+    shape=tuple(data.shape)
+    itemsize=data.dtype.itemsize
+    stats=content_stats()
+    if not shape:
+        slices=[()]
+    else:
+        lead=0
+        while lead<len(shape)-1 and itemsize*math.prod(shape[lead+1:])>memory:
+            lead+=1
+        step=max(1,int(memory//(itemsize*math.prod(shape[lead+1:]))))
+        slices=(index+(slice(start,start+step),)
+                for index in np.ndindex(*shape[:lead]) for start in range(0,shape[lead],step))
+    for index in slices:
+        add_content(stats,np.ma.asanyarray(data[index].array if index else data.array),np)
+    return(stats)
+
+
+def content_stats():
+    #the statistics accumulated by add_content()
+    return({'size':0,'missing':0,'nan':0,'min':None,'max':None,'zero':True})
+
+
+def add_content(stats,chunk,np):
+    #adds one slice of data, a numpy (masked) array, to the statistics of its field
+    values=np.ma.getdata(chunk)
+    missing=np.ma.getmaskarray(chunk)
+    nan=np.isnan(values)&~missing if values.dtype.kind=='f' else np.zeros(values.shape,dtype=bool)
+    valid=values[~(missing|nan)]
+    stats['size']+=values.size
+    stats['missing']+=int(missing.sum())
+    stats['nan']+=int(nan.sum())
+    if valid.size:
+        low,high=valid.min().item(),valid.max().item()
+        stats['min']=low if stats['min'] is None else min(stats['min'],low)
+        stats['max']=high if stats['max'] is None else max(stats['max'],high)
+        stats['zero']=stats['zero'] and low==0 and high==0
+
+
+def content_suspect(stats,max_missing):
+    #the reasons a field's content looks wrong, from field_content()
+    reasons=[]
+    absent=stats['missing']+stats['nan']
+    if stats['size'] and absent==stats['size']:
+        reasons.append('all missing')
+    elif stats['size'] and absent/stats['size']>=max_missing:
+        reasons.append(f'{absent/stats["size"]:.0%} missing')
+    if stats['nan']:
+        reasons.append(str(stats['nan'])+' NaN')
+    if stats['min'] is not None:
+        if stats['zero']:
+            reasons.append('all zero')
+        elif stats['min']==stats['max']:
+            reasons.append('constant '+str(stats['min']))
+    return(reasons)
+
+
+#numpy functions a mapping expression may call when it is evaluated with --evaluate
+expression_functions={'abs':'absolute',
+                      'sqrt':'sqrt',
+                      'exp':'exp',
+                      'log':'log',
+                      'log10':'log10',
+                      'maximum':'maximum',
+                      'minimum':'minimum'}
+
+#the time cell method of the output for each LBPROC in a mapping constraint
+lbproc_methods={'0':'point',
+                '128':'mean',
+                '4096':'minimum',
+                '8192':'maximum'}
+
+#the arithmetic an evaluated expression may use
+expression_nodes=(ast.Expression,ast.BinOp,ast.UnaryOp,ast.Constant,ast.Name,ast.Call,ast.Load,
+                  ast.Add,ast.Sub,ast.Mult,ast.Div,ast.Pow,ast.USub,ast.UAdd)
+
+
+class Expression:
+    '''
+    a mapping expression compiled so that it can be evaluated on numpy arrays
+    each input - a stash code, nemo or cice field, cf variable or constant, with its [constraints] - is replaced
+    by a name, so that what is left parses as python; only numbers, + - * / **, brackets and the
+    expression_functions are allowed, anything else raises ValueError
+    inputs maps each name to (input, {constraint:value})
+    '''
+    __slots__=('text','inputs','code')
+
+    def __init__(self,text):
+        self.text=text
+        self.inputs={}
+        #an identifier, not a function or keyword, with an optional [..] of constraints
+        pattern=r'\b([A-Za-z][A-Za-z0-9_]*)(?!\s*[(=A-Za-z0-9_])(?:\[(.*?)\])?'
+        code=re.sub(pattern,self.add_input,text.replace('\n',' '))
+        try:
+            tree=ast.parse(code.strip(),mode='eval')
+        except SyntaxError:
+            raise ValueError("can't parse "+text)
+        for node in ast.walk(tree):
+            if not isinstance(node,expression_nodes):
+                raise ValueError("unsupported "+type(node).__name__+" in "+text)
+            if isinstance(node,ast.Call):
+                if not isinstance(node.func,ast.Name) or node.func.id not in expression_functions or node.keywords:
+                    raise ValueError("unsupported function "+ast.unparse(node.func)+" in "+text)
+            elif isinstance(node,ast.Name):
+                if node.id not in self.inputs and node.id not in expression_functions:
+                    raise ValueError("unsupported name "+node.id+" in "+text)
+            elif isinstance(node,ast.Constant) and not isinstance(node.value,(int,float)):
+                raise ValueError("unsupported constant "+repr(node.value)+" in "+text)
+        self.code=compile(tree,'<expression>','eval')
+
+    def add_input(self,match):
+        name='_input'+str(len(self.inputs))
+        constraints={}
+        for item in (match.group(2) or '').split(','):
+            if '=' in item:
+                key,value=item.split('=',1)
+                constraints[key.strip()]=value.strip()
+            elif item.strip():
+                constraints[item.strip()]=None
+        self.inputs[name]=(match.group(1),constraints)
+        return(name)
+
+    def evaluate(self,values,np):
+        #the expression of the arrays (or numbers) in values, one for each input name
+        functions={key:getattr(np.ma,function,getattr(np,function)) for key,function in expression_functions.items()}
+        return(eval(self.code,{'__builtins__':{}},dict(functions,**values)))
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def compile_expression(text):
+    #many cf variables share an expression, so each is only compiled once
+    return(Expression(text))
+
+
+class FieldSource:
+    '''
+    an input of an expression read from an output field - data is only read a slice at a time by read()
+    '''
+    __slots__=('field','shape','itemsize')
+
+    def __init__(self,field):
+        self.field=field
+        self.shape=tuple(field.data.shape)
+        self.itemsize=field.data.dtype.itemsize
+
+    def read(self,index,np):
+        return(np.ma.asanyarray(self.field.data[index].array if index else self.field.data.array))
+
+
+class ExpressionSource:
+    '''
+    an input of an expression that is itself an expression (another cf variable) of its sources
+    '''
+    __slots__=('expression','sources','shape','itemsize')
+
+    def __init__(self,expression,sources,np):
+        self.expression=expression
+        self.sources=sources
+        shapes=[source.shape for source in sources.values() if not isinstance(source,float)]
+        self.shape=tuple(np.broadcast_shapes(*shapes)) if shapes else ()
+        self.itemsize=max([source.itemsize for source in sources.values() if not isinstance(source,float)] or [8])
+
+    def read(self,index,np):
+        return(evaluate_slice(self.expression,self.sources,index,self.shape,np))
+
+
+def evaluate_slice(expression,sources,index,shape,np):
+    #one slice of an expression - index slices the leading axis of the sources shaped like the whole result,
+    #sources without that axis (masks, areas, fixed fields) are read whole and broadcast
+    values={}
+    for name,source in sources.items():
+        if isinstance(source,float):
+            values[name]=source
+        elif index and len(source.shape)==len(shape) and source.shape[0]==shape[0]:
+            values[name]=source.read(index,np)
+        else:
+            values[name]=source.read((),np)
+    return(np.ma.asanyarray(expression.evaluate(values,np)))
+
+
+def evaluate_expression(expression,sources,memory):
+    '''
+    statistics (as field_content()) of an expression evaluated on its sources - FieldSource, ExpressionSource
+    or a number for each input name - a slice of the leading axis at a time so that the inputs of a slice
+    are under memory bytes
+    returns (shape, stats)
+    '''
+    import numpy as np
+    root=ExpressionSource(expression,sources,np)
+    stats=content_stats()
+    if not root.shape:
+        add_content(stats,root.read((),np),np)
+        return((root.shape,stats))
+    row=root.itemsize*math.prod(root.shape[1:])*max(1,len(sources))
+    step=max(1,int(memory//row))
+    for start in range(0,root.shape[0],step):
+        add_content(stats,root.read((slice(start,start+step),),np),np)
+    return((root.shape,stats))
+
+
+#bump this if the layout of the output catalogue changes - older catalogues are then ignored
+CATALOGUE_VERSION=1
+
+def nc_catalogue(file,fields,time_domain):
+    '''
+    what --check_output compares of each field read from one netcdf file - the variable name, the coordinates
+    and their sizes, and the frequency and time cell method from time_domain (Session.nc_time_domain)
+    these are cached in the output catalogue, so the file isn't read again while it is unchanged
+    '''
+    entries=[]
+    for field in fields:
+        coords=list(field.coords().values())
+        freq,method=time_domain(field)
+        entries.append({'file':file,
+                        'variable':field.nc_get_variable(''),
+                        'name':str(field.get_property('name','')),
+                        'identities':[coord.identity() for coord in coords],
+                        'coord_variables':[coord.nc_get_variable('') for coord in coords],
+                        'sizes':{coord.identity():coord.size for coord in coords},
+                        'freq':freq,
+                        'method':method})
+    return(entries)
+
+
+#held while the output catalogue is read, updated and written, as forked sessions may check output in threads
+catalogue_lock=threading.Lock()
+
+def read_catalogue(catalogue_file):
+    #the output catalogue written by a previous --check_output run, {directory:{file:entry}}
+    if not os.path.isfile(catalogue_file):
+        return({})
+    try:
+        with open(catalogue_file) as infile:
+            catalogue=json.load(infile)
+    except ValueError:
+        pwarn(catalogue_file+" can't be read - reading all output files")
+        return({})
+    if not isinstance(catalogue,dict) or catalogue.get('version')!=CATALOGUE_VERSION:
+        plog(catalogue_file+" was written by a different version of this script - reading all output files")
+        return({})
+    return(catalogue['directories'])
+
+
+def write_catalogue(catalogue_file,catalogue):
+    #written to a temporary file then renamed, so an interrupted write never leaves a partial catalogue
+    temporary=catalogue_file+'.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+    with open(temporary,'w') as outfile:
+        json.dump({'version':CATALOGUE_VERSION,'directories':catalogue},outfile,separators=(',',':'))
+    os.replace(temporary,catalogue_file)
+    plog("Written "+catalogue_file)
+
+
+#bump this if the layout of the manifest changes - older manifests are then ignored
+MANIFEST_VERSION=1
+
+def output_filename(path):
+    #output files are written to the current directory, named after the suite file they replace
+    #e.g. ../roses/u-cx749/app/xml/rose-app.conf -> u-cx749__app__xml__rose-app.conf
+    return(path.split('roses/')[-1].replace('/','__'))
+
+
+def file_digest(file):
+    #short sha1 of a file's contents
+    sha=hashlib.sha1()
+    with open(file,'rb') as infile:
+        for chunk in iter(lambda: infile.read(1<<20),b''):
+            sha.update(chunk)
+    return(sha.hexdigest()[:8])
+
+
+def row_key(line):
+    #a row of the cf diagnostics file is identified by the variable and its time and space domains
+    return(line['variable']+'|'+line['time']+'|'+line['space'])
+
+
+def row_digest(line):
+    #digest of every column in the row - changes if any part of the row is edited
+    text='\n'.join(str(key)+'='+str(line[key]) for key in sorted(line,key=str))
+    return(hashlib.sha1(text.encode(encoding="utf8")).hexdigest()[:8])
+
+
+def read_manifest(manifest_file,inputs,output_dir=''):
+    '''
+    read the manifest written by a previous run
+    the outputs it lists are relative to output_dir, the directory the outputs are written to
+    returns None if there isn't one, or if it can't be used for this run (inputs from Session.manifest_inputs())
+    '''
+    if not os.path.isfile(manifest_file):
+        plog("No manifest "+manifest_file+" from a previous run - processing all rows")
+        return(None)
+    with open(manifest_file) as infile:
+        manifest=json.load(infile)
+    if manifest.get('version')!=MANIFEST_VERSION:
+        plog(manifest_file+" was written by a different version of this script - processing all rows")
+        return(None)
+    if manifest['inputs']!=inputs:
+        changed=sorted(key for key in set(manifest['inputs'])|set(inputs) if manifest['inputs'].get(key)!=inputs.get(key))
+        plog(' '.join(changed)+" changed since "+manifest_file+" was written - processing all rows")
+        return(None)
+    for component in manifest['outputs']:
+        if not os.path.isfile(os.path.join(output_dir,manifest['outputs'][component])):
+            plog(manifest['outputs'][component]+" listed in "+manifest_file+" no longer exists - processing all rows")
+            return(None)
+    return(manifest)
+
+
+def write_manifest(manifest_file,manifest):
+    with open(manifest_file,'w') as outfile:
+        json.dump(manifest,outfile,indent=1,sort_keys=True)
+    plog("Written "+manifest_file)
+
+
+def diff_manifest(variable_list,manifest):
+    '''
+    splits the rows of the cf diagnostics file into those that are new or changed since the manifest was written
+    and those that were already processed in a previous run
+    also returns the keys of rows in the manifest that are no longer requested
+    '''
+    rows=manifest['rows']
+    new_rows=[]
+    done_rows=[]
+    for line in variable_list:
+        key=row_key(line)
+        if key in rows and rows[key]['digest']==row_digest(line):
+            done_rows.append(line)
+        else:
+            new_rows.append(line)
+    requested=set(row_key(line) for line in variable_list)
+    removed=[key for key in rows if not key in requested]
+    return(new_rows,done_rows,removed)
 
 
 def read_config(conf_file):
     if not os.path.isfile(conf_file):
-        plog("Config file "+conf_file+" dos not exist")
+        perror("Config file "+conf_file+" dos not exist")
         exit()
 
     main_config = configparser.ConfigParser()   
@@ -3689,13 +5038,59 @@ def read_config(conf_file):
     main_config.read(conf_file)
     return(main_config)
 
-def start_logging():
-    if 'log_file' in main_config['user']:
-        log_file=main_config['user']['log_file'].strip("'")
+#all messages go through this logger - the console and the log file are separate handlers with their own levels
+log=logging.getLogger('cf_to_um')
+log.setLevel(logging.DEBUG)
+log.propagate=False
+
+#level for the end of run summary - above WARNING so it is still shown on the console in quiet mode
+SUMMARY=logging.WARNING+5
+logging.addLevelName(SUMMARY,'SUMMARY')
+
+log_levels={'debug':logging.DEBUG,
+            'info':logging.INFO,
+            'warn':logging.WARNING,
+            'warning':logging.WARNING,
+            'error':logging.ERROR}
+
+
+def start_console(verbosity):
+    '''
+    console output
+    verbosity is 'quiet' (progress bar, summary and errors only), 'normal' or 'verbose' (includes debug messages)
+    '''
+    console_levels={'quiet':SUMMARY,
+                    'normal':logging.INFO,
+                    'verbose':logging.DEBUG}
+    console=logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    console.setLevel(console_levels[verbosity])
+    log.addHandler(console)
+
+
+def start_logging(config,conf_file):
+    '''
+    log file
+    records are held in memory and written in blocks of [user]:log_buffer records (default 1000)
+    anything at ERROR or above is written straight away, as we are usually about to exit
+    the level written is set by [user]:log_level - one of debug, info, warn, error (default info)
+    '''
+    if 'log_file' in config['user']:
+        log_file=config['user']['log_file'].strip("'")
     else:
         log_file='cf_to_um.log'    
-    #logging.basicConfig(filename=log_file, encoding='utf-8', level=logging.INFO, filemode='w')
-    logging.basicConfig(filename=log_file, level=logging.INFO, filemode='w')
+    log_level=config['user'].get('log_level','info').strip("'").lower()
+    if not log_level in log_levels:
+        perror("Unknown log_level "+log_level+" in "+conf_file+" - should be one of "+' '.join(log_levels))
+        exit()
+    log_buffer=int(config['user'].get('log_buffer','1000'))
+
+    log_file_handler=logging.FileHandler(log_file,mode='w')
+    log_file_handler.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+    buffered=logging.handlers.MemoryHandler(log_buffer,flushLevel=logging.ERROR,target=log_file_handler)
+    buffered.setLevel(log_levels[log_level])
+    log.addHandler(buffered)
+    #logging.shutdown() flushes the buffer at exit - including the many exit() calls
     plog("Writing log to "+log_file)
 
 def check_stash_eq(um,nemo):
@@ -3706,260 +5101,1548 @@ def check_stash_eq(um,nemo):
     import pdb; pdb.set_trace()
 
 
-def plog(message):
-    print(message)
-    logging.info(message)
-    
+def plog(message='',level=logging.INFO):
+    log.log(level,message)
+
+def pdebug(message=''):
+    log.debug(message)
 
+def pwarn(message=''):
+    log.warning(message)
 
-def check_histfreq_issues():
+def perror(message=''):
+    log.error(message)
+
+def psummary(message=''):
+    log.log(SUMMARY,message)
+
+
+class EventLog:
     '''
-    Checks the files in app/*/opt/ that are referenced in the rose-suite.conf UM_OPT_KEYS
-    if they contain histfreq or histfreq_n these will override attempts by nemo_cice/rose-app.conf to set these
-    and may cause errors in writing CICE data
+    machine readable record of each diagnostic decision, written as one JSON object per line
+    does nothing until open() is called
+    events can be emitted from several threads - each line is written under a lock, and the row is per thread
     '''
-    histfreq_found=False
-    suite_file=main_config['user']['job_path']+'rose-suite.conf'
-    if not os.path.isfile(suite_file):
-        plog("rose-suite.conf does not exist!")
-        import pdb; pdb.set_trace()
-    rose_suite,header=um.read_rose_app_conf(suite_file)
-    if 'jinja2:suite.rc' in rose_suite:
-        jinja_key='jinja2:suite.rc'
-    elif 'template variables' in rose_suite:
-        jinja_key='template variables'
-    else:
-        print("Unknown jinja key?")
-        import pdb; pdb.set_trace()
+    def __init__(self):
+        self.stream=None
+        self.lock=threading.Lock()
+        self.local=threading.local()
 
-    if 'UM_OPT_KEYS' in rose_suite[jinja_key]:
-        um_opt_keys=rose_suite[jinja_key]['UM_OPT_KEYS'].strip("'").split()
-        opt_dirs=glob.glob(main_config['user']['job_path']+'app/*/opt')
-        for um_opt_key in um_opt_keys:
-            for opt_dir in opt_dirs:
-                conf_file=glob.glob(opt_dir+'/rose-app-'+um_opt_key+'.conf')
-                if conf_file:
-                    if len(conf_file)>1:
-                        plog("More than one conf file??")
-                        import pdb; pdb.set_trace()
+    @property
+    def row(self):
+        #the row of the cf diagnostics file this thread is processing - added to every event
+        return(getattr(self.local,'row',None))
 
-                    #plog(conf_file)
-                    with open(conf_file[0]) as file:
-                        for line in file:
-                            if 'histfreq' in line:
-                                plog(conf_file[0]+" contains the line "+line)
-                                histfreq_found=True
+    @row.setter
+    def row(self,row):
+        self.local.row=row
 
+    def open(self,file):
+        self.stream=open(file,'w',buffering=1<<16)
+        atexit.register(self.close)
 
-    if histfreq_found:
-        plog("These lines will cause problems with adding CICE variables correctly and should be removed")
-        plog("opt files thatcontain histfreq or histfreq_n these will override attempts by nemo_cice/rose-app.conf to set these and may cause errors in writing CICE data")
-        exit()
+    def emit(self,event,**fields):
+        if self.stream is None:
+            return()
+        record={'event':event}
+        if self.row is not None:
+            record['row']=self.row
+        record.update(fields)
+        line=json.dumps(record)+'\n'
+        with self.lock:
+            self.stream.write(line)
 
-    
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream=None
 
-##################################
+events=EventLog()
 
-parser = argparse.ArgumentParser(description='cf_to_um_diagnostics.py adds CF diagnostics to existing UM rose job')
-parser.add_argument('-c', '--config',type=str)   
-parser.add_argument('-s', '--stash',type=str,choices=['um','xios'])
-parser.add_argument('-z', '--check_output')
+def pevent(event,**fields):
+    events.emit(event,**fields)
 
-args = parser.parse_args()
 
-if args.config:
-    conf_file=args.config
-else:
-    conf_file='cf_to_um.conf'
+class ProgressBar:
+    '''
+    single line progress bar on stderr - used instead of the message stream in quiet mode
+    only redrawn when the percentage changes, so it costs almost nothing per row
+    '''
+    def __init__(self,total,width=40,enabled=True):
+        self.total=max(total,1)
+        self.width=width
+        self.enabled=enabled and sys.stderr.isatty()
+        self.last=-1
+
+    def update(self,done):
+        if not self.enabled:
+            return()
+        percent=(100*done)//self.total
+        if percent==self.last:
+            return()
+        self.last=percent
+        filled=(self.width*done)//self.total
+        sys.stderr.write('\r['+'#'*filled+' '*(self.width-filled)+'] '+str(done)+'/'+str(self.total))
+        sys.stderr.flush()
 
-if args.stash:
-    stash_type=args.stash
-else:
-    stash_type='um'
+    def close(self):
+        if self.enabled:
+            sys.stderr.write('\n')
+            sys.stderr.flush()
 
-#this option allows use to check the netcdf/pp output 
-check_output=False
-if args.check_output:
-    plog("Checking NC output..")
-    import cf
-    nc_output=cf.read(args.check_output+"/*nc")
-    check_output=True
 
 
-    
-#read in main config file
-main_config=read_config(conf_file)
+#indexes built from each reference source - rebuilt when the source is reloaded
+reference_dependents={'nemo_def':['nemo_def_index'],
+                      'cmip6':['cmip6_records'],
+                      'cf_mappings':['mapping_index']}
 
 
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def expression_diags(expression0):
+    '''
+    the stash codes, nemo and cice and cf_diags in a mapping expression
+    many cf variables share an expression, so each distinct expression is only split once
+    '''
+    nemo_cice_diags=[]
 
+    #Run through expression and extract all the UM stashcodes and other diagnostic names
 
-#setup logging file
-start_logging()
-#Now rose should have all the required time and space domains defined as in the freq_mappings and space_mappings
-plog("Adding to the "+bold(stash_type)+" STASH, Nemo and CICE diagnostics")
-plog("------------")
+    #remove any \n
+    expression=expression0.replace('\n',' ')
+    #extract any UM stash codes
+    pattern_s = r'm\d{2}s\d{2}i\d{3}\[.*?\]'
+    um_diags = re.findall(pattern_s, expression)
+    #remove any stash codes of the form mNNsNNiNN[XXX]
+    #[XXX] defines the meaning and levels etc
+    expression = re.sub(pattern_s,'', expression)
+    #extract all UM stash codes that do not have a following [XXX]
+    pattern_s = r'm\d{2}s\d{2}i\d{3}'
+    um_diags_nobracket = re.findall(pattern_s, expression)
+    #remove any stash codes of the form mNNsNNiNN
+    expression = re.sub(pattern_s,'', expression)
+    #remove any functions of the form 'function('
+    pattern=r'[0-9a-z_]+\('
+    expression=re.sub(pattern,'',expression)
+    #replace '*' by space - as some expressions don't include spaces around *!
+    expression=expression.replace('*',' ')
+    #remove commas,  + - and and ( or )
+    translation_table = str.maketrans("", "", ",+-/()")
+    expression=expression.translate(translation_table)
+    #Now split into parts
+    sub_diags=[x for x in expression.split(' ') if x !='']
+    if sub_diags:
+        for sub_diag in sub_diags:
+            #does this string contain any lower case letters?
+            lower_case=re.search(r'[a-z]',sub_diag)
+            if lower_case:
+                #this should contain a nemo or cice diagnostic
+                if not ('=' in sub_diag or 'mask' in sub_diag or '_0' in sub_diag):
+                    #if sub_diag contains an '=' this is probably a mask argument - so we can ignore
+                    #if sub_diag contains 'mask' it is probably a mask - so we can ignore
+                    #if sub_diag contains '_0' it is probably a REFERENCE diag from another experiment - so we will ignore it
+                    #let's remove any square bracket expressions remaining (eg thetao[depth<2025])
+                    sub_diag=re.sub('\[.*?\]','',sub_diag)
+                    nemo_cice_diags.append(sub_diag)
+    #convert to list if unique elements 
+    um_diags=tuple(set(um_diags))
+    um_diags_nobracket=tuple(set(um_diags_nobracket))
+    nemo_cice_diags=tuple(set(nemo_cice_diags))
 
-#read in cf mappings
-cf_mappings=read_cf_mappings()
+    return(um_diags,um_diags_nobracket,nemo_cice_diags)
 
-#read in cf variable list
-variable_list=read_cf_diagnostics()
 
+def index_mappings(cf_mappings):
+    '''
+    the reverse of the cf mappings - the cf variables that need each stash code (with and without its
+    [constraints]) and each nemo or cice field, following cf variables defined in terms of other cf variables
+    Ofx fields are skipped, as they are when diagnostics are added
+    returns {'requires':{cf variable:(stash codes, fields)},'stash':{code:cf variables},
+             'constrained':{code[constraints]:cf variables},'fields':{field:cf variables}}
+    '''
+    direct={}
+    for name in cf_mappings.sections():
+        if 'expression' in cf_mappings[name]:
+            direct[name]=expression_diags(cf_mappings[name]['expression'])
+    requires={}
+
+    def leaves(name,seen):
+        if name in requires:
+            return(requires[name])
+        um_diags,um_diags_nobracket,nemo_cice_diags=direct[name]
+        stash=set(um_diags)|set(um_diags_nobracket)
+        fields=set()
+        for item in nemo_cice_diags:
+            #a cf variable with a mapping of its own, rather than one pointing back to itself (e.g evs -> evs)
+            if item in direct and item not in seen and direct[item]!=((),(),(item,)):
+                if cf_mappings[item].get('mip_table_id')=='Ofx':
+                    continue
+                sub_stash,sub_fields=leaves(item,seen|{item})
+                stash.update(sub_stash)
+                fields.update(sub_fields)
+            else:
+                fields.add(item)
+        requires[name]=(tuple(sorted(stash)),tuple(sorted(fields)))
+        return(requires[name])
+
+    index={'requires':requires,'stash':{},'constrained':{},'fields':{}}
+    for name in direct:
+        stash,fields=leaves(name,{name})
+        for code in stash:
+            index['stash'].setdefault(code[:10],set()).add(name)
+            index['constrained'].setdefault(code,set()).add(name)
+        for field in fields:
+            index['fields'].setdefault(field,set()).add(name)
+    return(index)
 
 
-#initialize um stash/cice instance
-#stash_type is which STASH to add diagnostics to UM or XML
-um=UM(stash_type)
+class Session:
+    '''
+    owns the configuration, cf mappings and the UM, Nemo and CICE components for one config file
+    reference data (mappings, STASHmaster_A, CMIP6 reference, field_def xml, ice_history_shared.F90) is read once
+    and shared by every suite resolved in this session, so one process can serve many requests
+    usage:
+        session=Session('cf_to_um.conf','xios')
+        session.load_reference()
+        plan=session.resolve(session.read_cf_diagnostics())
+        session.apply(plan)
+    '''
+    def __init__(self,conf_file='cf_to_um.conf',stash_type='um',check_output=None):
+        #check_output is an optional directory of netcdf, fieldsfile or pp output to check the requests against, rather than adding them
+        self.conf_file=conf_file
+        self.stash_type=stash_type
+        self.config=read_config(conf_file)
+        self.check_output=False
+        self.nc_output=None
+        self.nc_times={}
+        self.nc_matched=[]
+        self.um_output=None
+        self.cf_mappings=None
+        #reference data read so far, by source, and the functions that read it - see cached()
+        self.reference={}
+        self.readers={}
+        #one lock for each reference source, held while it is read, so that each source is only read once
+        #by the threads of preload() and forked sessions
+        self.lock=threading.Lock()
+        self.locks={}
+        #suite files being read ahead of the components by preload(), by (reader, file) - see read_suite_file()
+        self.prefetched={}
+        #threads used to read files in parallel - 1 reads them one after another
+        self.load_threads=int(self.config['user'].get('load_threads','8'))
+        self.um=None
+        self.nemo=None
+        self.cice=None
+        if check_output:
+            self.read_check_output(check_output)
 
-#initialize Nemo instance
-nemo=Nemo()
-#initialize CICE instance
-cice=CICE()
 
+    def read_check_output(self,check_output):
+        '''
+        catalogue the netcdf, fieldsfile and pp output in check_output - see nc_catalogue() and um_header_index()
+        the catalogue is kept in [user]:output_catalogue, and files with the same size and modification time
+        as when it was written are not read again, so a rerun on a growing output directory only reads the new files
+        '''
+        plog("Checking NC output..")
+        catalogue_file=self.config['user'].get('output_catalogue','cf_to_um_output_catalogue.json').strip("'")
+        directory=os.path.abspath(check_output)
+        with profiler.stage('read output'):
+            with catalogue_lock:
+                cached=read_catalogue(catalogue_file).get(directory,{})
+            files={}
+            changed=[]
+            for file in sorted(glob.glob(directory+"/*")):
+                if not os.path.isfile(file) or os.path.abspath(file)==os.path.abspath(catalogue_file):
+                    continue
+                stat=os.stat(file)
+                if file in cached and cached[file]['size']==stat.st_size and cached[file]['mtime']==stat.st_mtime:
+                    files[file]=cached[file]
+                else:
+                    files[file]={'size':stat.st_size,'mtime':stat.st_mtime,'nc':[],'um':{}}
+                    changed.append(file)
+            plog("Reading "+str(len(changed))+" new or changed output files, "+str(len(files)-len(changed))+" unchanged")
+            nc_files=[file for file in changed if file.endswith('nc')]
+            if nc_files:
+                import cf
+                for file in nc_files:
+                    files[file]['nc']=nc_catalogue(file,cf.read(file),self.nc_time_domain)
+            um_files=[file for file in changed if not file.endswith('nc')]
+            if um_files:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.load_threads) as pool:
+                    for file,headers in zip(um_files,pool.map(read_um_headers,um_files)):
+                        if headers is None:
+                            continue
+                        pdebug("Read "+str(len(headers['lbuser4']))+" UM field headers from "+file)
+                        files[file]['um']=um_header_index(file,headers)
+            if changed or len(files)!=len(cached):
+                #read again, to keep the directories other sessions have catalogued meanwhile
+                with catalogue_lock:
+                    catalogue=read_catalogue(catalogue_file)
+                    catalogue[directory]=files
+                    write_catalogue(catalogue_file,catalogue)
+            self.nc_output=[entry for file in files for entry in files[file]['nc']]
+            self.um_output={}
+            for file in files:
+                for code,groups in files[file]['um'].items():
+                    self.um_output.setdefault(code,[]).extend(groups)
+            if self.um_output:
+                plog("Indexed "+str(len(self.um_output))+" STASH codes in UM fieldsfile/pp output")
+        self.check_output=True
 
 
-#Check that the opt/ files DO NOT contain any histfreq entries - these will break the CICE outputs
-if not check_output:
-    check_histfreq_issues()
+    def nc_time_domain(self,field):
+        '''
+        the output frequency ('mon', 'day', '6hrPt'..) and time cell method ('mean', 'point', 'maximum'..)
+        of a netcdf field, from the values and bounds of its time coordinate and its cell_methods,
+        so nothing depends on how the file is named
+        the period of each time coordinate of each file is worked out once, as the fields of a file usually share one,
+        but the cell method is each field's own
+        returns (frequency, method) - frequency is '' if it can't be told, e.g. a single time with no bounds
+        '''
+        time_coord=field.dimension_coordinate('T',default=None)
+        if time_coord is None:
+            return(('',''))
+        #the cell method on the time axis, if there is one
+        method=''
+        time_axis=field.domain_axis('T',key=True,default=None)
+        for cell_method in field.cell_methods().values():
+            if time_axis in cell_method.get_axes(()) or 'time' in cell_method.get_axes(()):
+                method=cell_method.get_method('')
+        key=(tuple(sorted(field.get_filenames())),time_coord.nc_get_variable(None))
+        if key not in self.nc_times:
+            self.nc_times[key]=time_period(time_coord)
+        period,bounded=self.nc_times[key]
+        if not method:
+            method='mean' if bounded else 'point'
+        return((output_frequency(period,method!='point'),method))
+
+
+    def nc_match(self,component,diag,entry):
+        #a netcdf field found by --check_output, for check_content()
+        if not any(match[2] is entry for match in self.nc_matched):
+            self.nc_matched.append((component,diag,entry))
+
+
+    def nc_fields(self,entries):
+        #the cf fields of catalogue entries, reading each file once - the data itself is only read when used
+        import cf
+        fields={}
+        for file in sorted(set(entry['file'] for entry in entries)):
+            for field in cf.read(file):
+                fields[(file,field.nc_get_variable(''))]=field
+        return([fields[(entry['file'],entry['variable'])] for entry in entries])
+
+
+    def check_content(self):
+        '''
+        reads the data of every netcdf field found by --check_output, to find the diagnostics that are all missing,
+        all zero, constant or hold NaNs - usually a sign of a STASH or XIOS misconfiguration
+        fields are read in slices by a pool of [check_content]:workers threads, and the slices in progress at once
+        are kept under [check_content]:memory MB
+        returns [{'component','diag','stats','suspect'}..], with suspect the list of reasons
+        '''
+        settings=self.config['check_content'] if 'check_content' in self.config else {}
+        workers=int(settings.get('workers','4'))
+        memory=float(settings.get('memory','1024'))*1024**2
+        max_missing=float(settings.get('max_missing','1'))
+        #each worker holds a slice plus its masks and temporaries, about four times its size
+        slice_memory=int(memory/workers/4)
+        plog("Checking the content of "+str(len(self.nc_matched))+" output fields..")
+        with profiler.stage('check content'):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                stats=list(pool.map(functools.partial(field_content,memory=slice_memory),
+                                    self.nc_fields([match[2] for match in self.nc_matched])))
+        results=[]
+        for (component,diag,field),field_stats in zip(self.nc_matched,stats):
+            suspect=content_suspect(field_stats,max_missing)
+            if suspect:
+                pevent('content_suspect',component=component,diag=diag,reasons=suspect)
+            results.append({'component':component,'diag':diag,'stats':field_stats,'suspect':suspect})
+        return(results)
+
+
+    def expression_plan(self,expression,diag,freq,seen):
+        '''
+        finds each input of a compiled mapping expression in the output catalogue, without reading any data
+        an input is a number from [expression_constants], another cf variable with its own mapping (planned in turn),
+        or the netcdf output of a stash code, nemo or cice field at freq, with the [lbproc=..] time cell method
+        and [blev=PLEVnn] pressure levels its constraints ask for
+        returns (expression, {name:number, catalogue entry or plan}); raises ValueError for the first input that
+        can't be found
+        '''
+        constants=self.config['expression_constants'] if 'expression_constants' in self.config else {}
+        inputs={}
+        for name,(item,constraints) in expression.inputs.items():
+            if item in constants:
+                inputs[name]=float(constants[item])
+                continue
+            unsupported=[key for key in constraints if key not in ('lbproc','blev')]
+            if unsupported:
+                raise ValueError("unsupported constraint "+','.join(unsupported)+" on "+item)
+            stash=re.fullmatch(r'm\d{2}s\d{2}i\d{3}',item)
+            if (not stash and item!=diag and item not in seen and item in self.cf_mappings
+                and self.cf_mappings[item]['expression'].strip()!=item):
+                sub_expression=compile_expression(self.cf_mappings[item]['expression'])
+                inputs[name]=self.expression_plan(sub_expression,item,freq,seen|{item})
+                continue
+            if stash:
+                entries=[entry for entry in self.nc_output if entry['variable'].split('_')[0]==item]
+            else:
+                entries=[entry for entry in self.nc_output if entry['variable']==item]
+            #fixed fields - masks, areas - have no time, so no frequency
+            entries=[entry for entry in entries if entry['freq'] in (freq,'')]
+            if 'lbproc' in constraints:
+                method=lbproc_methods.get(constraints['lbproc'])
+                entries=[entry for entry in entries if entry['method'] in (method,'')]
+            if 'blev' in constraints:
+                levels=re.sub(r'\D','',constraints['blev'])
+                entries=[entry for entry in entries if str(entry['sizes'].get('air_pressure',''))==levels]
+            if not entries:
+                if stash and item in (self.um_output or {}):
+                    raise ValueError(item+" is only in fieldsfile/pp output, which can't be evaluated")
+                raise ValueError("no output for "+item+" at "+freq)
+            inputs[name]=entries[0]
+        return((expression,inputs))
+
+
+    def evaluate(self,diag,freq):
+        '''
+        computes cf variable diag at freq from the netcdf output found by --check_output, to show that its request
+        can be satisfied - the mapping expression is evaluated with numpy a slice of the time axis at a time,
+        keeping the inputs of a slice under [check_content]:memory MB, and only the inputs it uses are read
+        a variable without a mapping is read as a native nemo or cice field
+        returns {'diag','freq','shape','stats','reason'} - reason is '' if it was evaluated
+        '''
+        import numpy as np
+        result={'diag':diag,'freq':freq,'shape':None,'stats':None,'reason':''}
+        settings=self.config['check_content'] if 'check_content' in self.config else {}
+        memory=float(settings.get('memory','1024'))*1024**2
+        text=self.cf_mappings[diag]['expression'] if diag in self.cf_mappings else diag
+        try:
+            plan=self.expression_plan(compile_expression(text),diag,freq,{diag})
+            #read the fields of the inputs in one go, then build the sources from the plan
+            entries=[]
+            pending=[plan]
+            while pending:
+                for source in pending.pop()[1].values():
+                    if isinstance(source,dict):
+                        entries.append(source)
+                    elif isinstance(source,tuple):
+                        pending.append(source)
+            fields={id(entry):field for entry,field in zip(entries,self.nc_fields(entries))}
+
+            def sources(plan):
+                return({name:FieldSource(fields[id(source)]) if isinstance(source,dict)
+                        else ExpressionSource(source[0],sources(source),np) if isinstance(source,tuple)
+                        else source for name,source in plan[1].items()})
+
+            with profiler.stage('evaluate'):
+                result['shape'],result['stats']=evaluate_expression(plan[0],sources(plan),memory)
+        except ValueError as error:
+            result['reason']=str(error)
+        pevent('evaluated',diag=diag,freq=freq,reason=result['reason'])
+        return(result)
+
+
+    def fork(self,check_output=None):
+        '''
+        a new session on the same config file that shares this session's reference data
+        each fork has its own copy of the config and its own components, so forks can resolve different suites
+        '''
+        session=copy(self)
+        session.config=read_config(self.conf_file)
+        session.prefetched={}
+        session.check_output=False
+        session.nc_output=None
+        session.nc_times={}
+        session.nc_matched=[]
+        session.um_output=None
+        session.um=None
+        session.nemo=None
+        session.cice=None
+        if check_output:
+            session.read_check_output(check_output)
+        return(session)
+
+
+    def cached(self,name,reader):
+        #reference data is read by the first component that needs it, then shared
+        #the reader is kept so that the source can be re-read by reload_reference()
+        if not name in self.reference:
+            with self.lock:
+                lock=self.locks.setdefault(name,threading.Lock())
+            with lock:
+                if not name in self.reference:
+                    self.reference[name]=reader()
+                    self.readers[name]=reader
+        return(self.reference[name])
+
+
+    def reference_readers(self):
+        #how each source of reference data is read
+        main=self.config['main']
+        return({'cf_mappings':self.read_cf_mappings,
+                'STASHmaster_A':lambda: UM.read_STASHmaster_A_levels(main['stashmaster_A']),
+                'cmip6':lambda: UM.read_rose_app_conf(main['cmip6']),
+                'cmip6_records':lambda: cmip6_records(self.reference_data('cmip6')[0]),
+                'nemo_def':lambda: Nemo.read_field_defs(main['nemo_def'].split(',')),
+                'nemo_def_index':lambda: index_field_defs(self.reference_data('nemo_def')),
+                'cice_diags':lambda: CICE.read_cice_diagnostics(main['cice_diags']),
+                'mapping_index':lambda: index_mappings(self.reference_data('cf_mappings'))})
+
+
+    def reference_data(self,name):
+        #a source of reference data, read now if it hasn't been already
+        return(self.cached(name,self.reference_readers()[name]))
+
+
+    def reference_files(self):
+        #the files behind each entry in self.reference
+        return({'cf_mappings':self.config['main']['mappings'].split(','),
+                'STASHmaster_A':[self.config['main']['stashmaster_A']],
+                'cmip6':[self.config['main']['cmip6']],
+                'nemo_def':self.config['main']['nemo_def'].split(','),
+                'cice_diags':[self.config['main']['cice_diags']]})
+
+
+    def forget_reference(self,name):
+        #drop reference data, and the indexes built from it, so that it is read again when next needed
+        for key in [name]+reference_dependents.get(name,[]):
+            self.reference.pop(key,None)
+            self.readers.pop(key,None)
+        if name=='cf_mappings':
+            self.cf_mappings=None
+
+
+    def reload_reference(self,name):
+        '''
+        re-read a single reference source now, and rebuild the indexes that depend on it
+        sources that have not been read yet are left to be read when first needed
+        '''
+        if not name in self.readers:
+            self.forget_reference(name)
+            return()
+        plog("Reloading "+name)
+        dependents=[key for key in reference_dependents.get(name,[]) if key in self.readers]
+        self.reference[name]=self.readers[name]()
+        for key in dependents:
+            self.reference[key]=self.readers[key]()
+        if name=='cf_mappings':
+            self.cf_mappings=self.reference[name]
 
 
+    def load_reference(self):
+        '''
+        read all the reference data, in parallel - file reads and lxml parsing release the GIL,
+        so reads from a slow filesystem overlap
+        sources with missing files are left to be read (and reported) when first needed
+        '''
+        files=self.reference_files()
+        with profiler.stage('read_reference'):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.load_threads) as pool:
+                for name in files:
+                    if not name in self.reference and all(os.path.isfile(file) for file in files[name]):
+                        pool.submit(self.reference_data,name)
+        #read in cf mappings
+        with profiler.stage('read_cf_mappings'):
+            self.cf_mappings=self.reference_data('cf_mappings')
+
+
+    def suite_files(self,outputs={}):
+        '''
+        the suite files the UM, Nemo and CICE components will read, with their readers
+        the iodef xml is only known once the xml rose-app.conf has been read, so it is not included
+        '''
+        job_path=self.config['user']['job_path']
+        if self.stash_type=='xios':
+            um_file=job_path+'app/xml/rose-app.conf'
+        else:
+            um_file=job_path+'app/um/rose-app.conf'
+        return([(outputs.get('um',um_file),UM.read_rose_app_conf),
+                (job_path+'app/xml/rose-app.conf',Nemo.read_rose_app_conf),
+                (outputs.get('cice',job_path+'app/nemo_cice/rose-app.conf'),CICE.read_rose_app_conf)])
 
 
+    def preload(self,outputs={}):
+        '''
+        read the suite files in parallel, ready for the components to pick up with read_suite_file()
+        files that don't exist are left for the components to report
+        '''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.load_threads) as pool:
+            for file,reader in self.suite_files(outputs):
+                if os.path.isfile(file):
+                    self.prefetched[(reader.__qualname__,file)]=pool.submit(reader,file)
+            #the iodef xml is named in the xml rose-app.conf - read it as soon as that has been read
+            nemo_conf=self.config['user']['job_path']+'app/xml/rose-app.conf'
+            future=self.prefetched.get((Nemo.read_rose_app_conf.__qualname__,nemo_conf))
+            if future is not None and future.exception() is None:
+                iodef=outputs.get('nemo',Nemo.iodef_filename(nemo_conf,future.result()))
+                if iodef and os.path.isfile(iodef):
+                    self.prefetched[(Nemo.read_iodef.__qualname__,iodef)]=pool.submit(Nemo.read_iodef,iodef)
+
+
+    def read_suite_file(self,file,reader):
+        '''
+        reader(file) - or its result if preload() has already read file
+        if reading ahead failed, file is read again here so that the error is raised where it always was
+        '''
+        future=self.prefetched.pop((reader.__qualname__,file),None)
+        if future is not None and future.exception() is None:
+            return(future.result())
+        return(reader(file))
 
-plog("----------------------------")
-#loop over all cf variables
 
-#UM has multiple realms
-um_realms=['atmos','landIce','land']
+    def load_suite(self,outputs={}):
+        '''
+        (re)read the suite in [user]:job_path into fresh UM, Nemo and CICE components
+        outputs are files written by a previous run, to read in place of the suite ones
+        '''
+        #read the suite files in parallel, then build the components from them
+        with profiler.stage('read_suite'):
+            self.preload(outputs)
+        #initialize um stash/cice instance
+        #stash_type is which STASH to add diagnostics to UM or XML
+        with profiler.stage('UM.__init__'):
+            self.um=UM(self,outputs.get('um'))
+
+        #initialize Nemo instance
+        with profiler.stage('Nemo.__init__'):
+            self.nemo=Nemo(self,outputs.get('nemo'))
+        #initialize CICE instance
+        with profiler.stage('CICE.__init__'):
+            self.cice=CICE(self,outputs.get('cice'))
+
+
+    def read_cf_diagnostics(self):
+        cf_diagnostics_file=self.config['user']['cf_diagnostics_file']
+
+        if not os.path.isfile(cf_diagnostics_file):
+            perror("CF Diagnostics CSV file "+cf_diagnostics_file+" does not exist")
+            exit()
 
-for line in variable_list:
-    diag=line['variable']
-    freq=line['time']
-    dims=line['space']
-    add_cf_diagnostic(diag,freq,dims)
-    #import pdb; pdb.set_trace()
+        # Open the CSV cf_diagnostics file
+        with open(cf_diagnostics_file, 'r') as infile:
+            # Create a CSV reader object for reading as a dictionary
+            csv_reader = csv.DictReader(infile)
 
-#    realm=line['realm']
-#    #if realm in um_realms:
-#    if any(element in um_realms for element in realm.split(' ')):
-#        #all realms here use STASH
-#        plog(".")
-#        um.add_cf_diagnostic(line)
-#    elif 'ocean' in realm:
-#        #add ocean diagnostic
-#        nemo.addOceanDiag(line)
-#        #plog()
-#    elif 'seaIce' in realm:
-#        #add Sea Ice diagnostic
-#        cice.addIceDiag(line)
-#        #plog()
-#    else:
-#        plog("Unknown Realm?")
-#        plog(line['realm'])
-#        import pdb; pdb.set_trace()
+            # Convert the CSV data into a list of dictionaries
+            variable_list = list(csv_reader)
+        return(variable_list)
 
-if check_output:
-    plog("")
-    plog("")
-    if um.nc_found:
-        plog("The following STASH diagnostics were found in the output")
-        for i in um.nc_found:
-            plog(f'{i[0]:10}  {i[1]} [{i[2]}] ')
-        plog("--------------------------")
-        
-    if nemo.nc_found:
-        plog("The following NEMO diagnostics were found in the output")
-        for i in nemo.nc_found:
-            plog(f'{i[0]:20}  {i[1]} [{i[2]}] ')
-        plog("--------------------------")
-
-    if cice.nc_found:
-        plog("The following CICE diagnostics were found in the output")
-        for i in cice.nc_found:
-            plog(f'{i[0]:10}  {i[1]} [{i[2]}] ')
-        plog("--------------------------")
-
-    plog("")
-            
-    if um.nc_missing:
-        plog("The following STASH diagnostics are "+color.BOLD+" missing"+color.END+" from the output")
-        for i in um.nc_missing:
-            plog(f'{i[0]:10}  {i[1]} [{i[2]}] ')
-        plog("--------------------------")
+
+    def check_histfreq_issues(self):
+        '''
+        Checks the files in app/*/opt/ that are referenced in the rose-suite.conf UM_OPT_KEYS
+        if they contain histfreq or histfreq_n these will override attempts by nemo_cice/rose-app.conf to set these
+        and may cause errors in writing CICE data
+        '''
+        histfreq_found=False
+        suite_file=self.config['user']['job_path']+'rose-suite.conf'
+        if not os.path.isfile(suite_file):
+            plog("rose-suite.conf does not exist!")
+            import pdb; pdb.set_trace()
+        rose_suite,header=self.um.read_rose_app_conf(suite_file)
+        if 'jinja2:suite.rc' in rose_suite:
+            jinja_key='jinja2:suite.rc'
+        elif 'template variables' in rose_suite:
+            jinja_key='template variables'
+        else:
+            print("Unknown jinja key?")
+            import pdb; pdb.set_trace()
+
+        if 'UM_OPT_KEYS' in rose_suite[jinja_key]:
+            um_opt_keys=rose_suite[jinja_key]['UM_OPT_KEYS'].strip("'").split()
+            opt_dirs=glob.glob(self.config['user']['job_path']+'app/*/opt')
+            for um_opt_key in um_opt_keys:
+                for opt_dir in opt_dirs:
+                    conf_file=glob.glob(opt_dir+'/rose-app-'+um_opt_key+'.conf')
+                    if conf_file:
+                        if len(conf_file)>1:
+                            plog("More than one conf file??")
+                            import pdb; pdb.set_trace()
+
+                        #plog(conf_file)
+                        with open(conf_file[0]) as file:
+                            for line in file:
+                                if 'histfreq' in line:
+                                    plog(conf_file[0]+" contains the line "+line)
+                                    histfreq_found=True
+
+
+        if histfreq_found:
+            perror("These lines will cause problems with adding CICE variables correctly and should be removed")
+            perror("opt files thatcontain histfreq or histfreq_n these will override attempts by nemo_cice/rose-app.conf to set these and may cause errors in writing CICE data")
+            exit()
+
+
+
+
+    def manifest_filename(self,output_dir=''):
+        #the manifest lives alongside the written outputs in output_dir, unless the user names one in [user]
+        if 'manifest_file' in self.config['user']:
+            return(os.path.join(output_dir,self.config['user']['manifest_file'].strip("'")))
+        return(os.path.join(output_dir,output_filename(self.config['user']['job_path']+'cf_to_um_manifest.json')))
+
+
+    def manifest_inputs(self):
+        '''
+        the inputs that a manifest is only valid for - the config, the reference files and the suite files
+        if any of these change, all the rows need to be processed again
+        '''
+        inputs={'config':file_digest(self.conf_file),
+                'stash':self.stash_type}
+        for name,paths in self.reference_files().items():
+            for path in paths:
+                inputs[name+':'+path]=file_digest(path)
+        #the suite as it is in job_path, not the outputs of a previous run - the iodef xml is one of the
+        #files the xml app installs, so all of those are included rather than reading the rose-app.conf for its name
+        job_path=self.config['user']['job_path']
+        suite=[file for file,reader in self.suite_files()]
+        if os.path.isdir(job_path+'app/xml/file'):
+            suite+=[job_path+'app/xml/file/'+name for name in sorted(os.listdir(job_path+'app/xml/file'))]
+        for path in suite:
+            inputs['suite:'+path]=file_digest(path) if os.path.isfile(path) else None
+        return(inputs)
+
+
+    def row_progress(self):
+        #snapshot of the added and missing lists - used to work out what a single row did
+        return([len(self.um.added),len(self.nemo.added),len(self.cice.added)],
+               [len(self.um.missing),len(self.nemo.missing),len(self.cice.missing)])
+
+
+    def row_outcome(self,line,before):
+        '''
+        summarise what processing a row did since the row_progress() snapshot in before
+        outcome is 'missing' if anything could not be added, 'added' if anything was added, otherwise 'present'
+        '''
+        added_before,missing_before=before
+        added=[]
+        missing=[]
+        for component,n_added,n_missing in zip([self.um,self.nemo,self.cice],added_before,missing_before):
+            added.extend(component.added[n_added:])
+            missing.extend(component.missing[n_missing:])
+        if missing:
+            outcome='missing'
+        elif added:
+            outcome='added'
+        else:
+            outcome='present'
+        return({'digest':row_digest(line),
+                'outcome':outcome,
+                'added':added,
+                'missing':missing})
+
+
+    def read_cf_mappings(self):
+        '''
+        read the cf mappings from the mappings files linked to from the config file
+        '''
+        cf_mappings = configparser.ConfigParser()   
+        # turn of the lowercaseization of keys
+        cf_mappings.optionxform = lambda option: option
+        #configFilePath = 'common_mappings.cfg'
+        configFilePath = self.config['main']['mappings']
+        if ',' in configFilePath:
+           #this contains multiple config files, split into a list
+           configFilePaths=configFilePath.split(',')
+           for path in configFilePaths:
+              if not os.path.isfile(path):
+                 perror("ROSE conf file "+path+" does not exist")
+                 exit()
+
+           cf_mappings.read(configFilePaths)
+        else:
+           if not os.path.isfile(configFilePath):
+              perror("ROSE conf file "+configFilePath+" does not exist")
+              exit()
+           cf_mappings.read(configFilePath)
+        return(cf_mappings)
+
+
+    def diags_from_expression(self,diag):
+        '''
+        extracts the stash codes, nemo and cice  and cf_diags from the mapping expression for diag
+        '''
+        return(expression_diags(self.cf_mappings[diag]['expression']))
+
+    @profiler.timed('add_nemo_cice_diagnostic')
+    def add_nemo_cice_diagnostic(self,diag,freq,dims):
+        '''
+        Adds a single diag directly to ocean or ice
+        '''
+            #Here the diag has no CF mapping OR we have no um diags, and only 1 nemo or cice diag and this points back to itself (e.g evs -> evs )
+        #We need to look in the NEMO and CICE diagnostics for the final mappings
+        if diag=='ice_present':
+            #mappings in common_mappings.cfg is wrong for sitimefrac !
+            #ice_present in the confing by ice_history_shared.F90 is f_icepresent
+            #           fdiag='f_icepresent'
+            #        else:
+            #           fdiag='f_'+this_expression
+            diag='icepresent'
+
+        #is diag a cice diagnostic?
+        if 'f_'+diag in self.cice.cice_diagnostics:
+            plog(diag+" is a CICE diagnostic, adding..")
+            self.cice.addIceDiag('f_'+diag,freq,dims)
+            return()
+
+
+
+        #Here diag is either a nemo diag that exists in the xml definitions or it is undefined
+        #Check all the XML definitions
+
+        #either diag is NOT defined in the mapping tables, OR it IS, but the definition is circular! (eg umo -> umo )
+        fields=self.nemo.find_field_defs('name',diag)
+        if len(fields)>0:
+            #we found a matching diagnostics in the NEMO defined diagnostics
+            plog("Adding NEMO diag "+diag)
+            self.nemo.addOceanDiag(diag,freq,dims)     
+            return()
+
+        fields=self.nemo.nemo_diagnostic_request.findall(".//field[@name='"+diag+"']")
+        if len(fields)>0:
+
+            #we found a matching diagnostics in the NEMO user defined diagnostics
+            plog("Adding NEMO diag "+diag)
+            self.nemo.addOceanDiag(diag,freq,dims)
+            return()
+
+
+        #is this diagnostics just commented out in the user defined diagnostics?
+        found_in_comments=False
+        for off_diag in self.nemo.nemo_diagnostic_request_off:
+            fields=off_diag.findall(".//field[@name='"+diag+"']")
+            if len(fields)==1:
+                plog(diag+" found in the commented out diagnostics")
+                plog("uncommenting "+diag)
+
+                this_freq=self.nemo.freq_map[freq]
+                file_group=self.nemo.get_file_group(this_freq)
+                #does this diag have a parent in the off_diag?
+                parent=fields[0].getparent()
+                if len(parent)==0:
+                   plog("No parent found for "+diag+" in comments!")
+                   import pdb; pdb.set_trace()
+                this_name_suffix=parent.attrib['name_suffix']
+
+                #is there an EXISTING file within this filegroup that has this suffix
+                existing_file=file_group.findall(".//file[@name_suffix='"+this_name_suffix+"']")
+                if not existing_file:
+                    #no - so we need to add it
+                    this_id=parent.attrib['id']
+                    if this_id in self.nemo.file_element_id_list:
+                        #a file with this ID already exists
+                        #Need to add one
+                        new_file_id=self.nemo.get_unique_file_id()
+                        parent.attrib['id']=new_file_id
+                        self.nemo.file_element_id_list.append(new_file_id)
+                    if not 'output_freq' in parent.attrib:
+                        #add a output_freq if there is not one already
+                        parent.attrib['output_freq']=this_freq
+                    plog("Adding new file element for "+this_name_suffix)
+                    new_file_element=ET.SubElement(file_group,'file')
+                    new_file_element.attrib.update(dict(parent.attrib))
+
+                #add this field to the file group
+                plog(this_name_suffix)
+                #SOMETHING GOING WRONG HERE!
+                self.nemo.add_field_to_file_group(fields[0],file_group,this_name_suffix)
+                return()
+                #What is the best way to uncomment this?
+                #Need to go Into addOceanDiag somewhrer
+            if len(fields)>1:
+               plog("Too many  matches of "+diag+" in the comment fields!")
+               import pdb; pdb.set_trace()
+
+
+        if self.check_output:
+            self.nemo.nc_check_ocean(diag,freq,dims)
+        #if we are here - we didn't find the diag anywhere!
+        pwarn(diag+" not found in anywhere in NEMO diagnostics definitions")
+        pevent('missing',component='nemo',diag=diag,freq=freq,dims=dims,reason='not in any NEMO definitions')
+        self.nemo.missing.append(diag)
+
+
+    @profiler.timed('add_cf_diagnostic')
+    def add_cf_diagnostic(self,diag,freq,dims):
+        '''
+        add a cf diagnostic
+        using the CF mappings (*cfg) from mipconvert
+        a cf_diagnostic from a given realm (e.g. ocean) may map to a function of diagnostics from the UM, NEMO and CICE AND other cf_diagnostics
+        cf_diag = function( UM_diag, NEMO_diag, CICE_diag, cf_diag_2)
+        where cf_diag_2 can be ANOTHER cf_diagnostic that in turn needs mapping
+        Sometimes cf mappings will map to themselves - this implies they are variables intrinsic to the model (eg NEMO or CICE)
+        '''
+
+        plog(">>>>>>  "+diag)
+
+        ##HERE we need to proceed if the diag is in cf_mappings
+        ##IF it is, but the expression points back to itself - need to map to natice nemo or cice
+        ##IF it is NOT, we need to map to native nemo or cice 
+
+
+        #if not diag in cf_mappings:
+        #   print("No mapping for "+diag+" in the mapping files?")
+        #   import pdb; pdb.set_trace()
+        #if 'evs' in diag:
+        #   import pdb; pdb.set_trace()
+
+
+        nemo_cice_diags=[]
+
+        if diag in self.cf_mappings:
+            #diag has a mapping in cf_mappings - work through each term in the mapping expression and add each sub diagnostic in that expression
+            um_diags,um_diags_nobracket,nemo_cice_diags=self.diags_from_expression(diag)
+
+            # if we have no um diags, and only 1 nemo or cice diag and this points back to itself (e.g evs -> evs )
+            # then we probably have a native nemo or cice diag and need to move on to searches in the xml and conf files
+            # We NOT this here for all the other cases 
+            if not (len(nemo_cice_diags)==1 and nemo_cice_diags[0]==diag and len(um_diags)==0 and len(um_diags_nobracket)==0):
+                #Now add the UM diags
+                for um_diag in um_diags:
+                    if diag==um_diag:
+                        #this is the should never happen!
+                        import pdb; pdb.set_trace()
+                    #plog("Add "+um_diag)
+                    self.um.add_stash(um_diag,freq,dims)
+
+
+                    #WHAT ABOUT [] heres? blev and lbproc, lblev? 
+                    #um.add_stash(um_diag,freq,dims)
+
+                #And the UM diags with NO post stash brackets
+                for um_diag in um_diags_nobracket:
+                    if diag==um_diag:
+                        #this is the should never happen!
+                        import pdb; pdb.set_trace()
+                    #plog("Add "+um_diag)
+                    self.um.add_stash(um_diag,freq,dims)
+
+                    #um.add_stash(um_diag,freq,dims)
+
+                #For everything else we need to recurse as these diags may have additional mappings
+                for nemo_cice_diag in nemo_cice_diags:
+                    #is nemo_cice_diag a nemo diagnostic?
+                    #Skip any Ofx files
+                    if nemo_cice_diag in self.cf_mappings:
+                        if self.cf_mappings[nemo_cice_diag]['mip_table_id']=='Ofx':
+                            plog(nemo_cice_diag+" is just an Ofx field- skipping")
+                            pevent('skipped',diag=nemo_cice_diag,freq=freq,reason='Ofx field')
+                            continue
+                            #skip to next nemo_cice_diag
+                    if not nemo_cice_diag==diag:
+                       #only recurse IF we are not about to enter an infinite loop!
+                       # eg  evs -> func (a,b,evs)
+
+                       self.add_cf_diagnostic(nemo_cice_diag,freq,dims)
+                    else:
+                       plog("Nemo diag and diag matches!")
+                       plog("Adding "+diag+" directly")
+                       self.add_nemo_cice_diagnostic(diag,freq,dims)
+
+
+                return()
+
+        #Here the diag has no CF mapping OR we have no um diags, and only 1 nemo or cice diag and this points back to itself (e.g evs -> evs )
+        #We need to look in the NEMO and CICE diagnostics for the final mappings
+
+        if nemo_cice_diags:
+            #we have a single nemo or cice diagnostic that exists in the cf mappings
+            if len(nemo_cice_diags)>1:
+                plog("Something went wrong!")
+                import pdb; pdb.set_trace()
+
+
+        #Here nemo_cice_diag is either [] OR nemo_cice_diag == diag
+        #so, use diag from here on
+
+        self.add_nemo_cice_diagnostic(diag,freq,dims)
+        return()
+
+
+    def resolve(self,requests,job_path=None,incremental=False,progress=False,output_dir=''):
+        '''
+        resolve a list of requests (dicts with variable, time and space, as read by read_cf_diagnostics) against a suite
+        job_path overrides [user]:job_path
+        output_dir is where the outputs and manifest are written by apply(), by default the current directory
+        if incremental, rows already processed according to the manifest of a previous run are skipped
+        returns the plan - the outcome of every row and the components holding the changes, ready for apply()
+        '''
+        return(self.process(self.prepare(requests,job_path,incremental,output_dir),progress))
+
+
+    def prepare(self,requests,job_path=None,incremental=False,output_dir=''):
+        '''
+        the file reading part of resolve() - reads the manifest and the suite
+        returns the job for process()
+        '''
+        if self.cf_mappings is None:
+            self.load_reference()
+        if job_path:
+            self.config['user']['job_path']=job_path
+
+        #the manifest records the outcome of every row processed, so that a rerun can skip rows it has already done
+        manifest_file=self.manifest_filename(output_dir)
+        manifest=None
+        if incremental and not self.check_output:
+            manifest=read_manifest(manifest_file,self.manifest_inputs(),output_dir)
+
+        #outputs written by the previous run - an incremental run starts from these rather than the suite files
+        previous_outputs={}
+        rows={}
+        if manifest:
+            previous_outputs={key:os.path.join(output_dir,path) for key,path in manifest['outputs'].items()}
+            requests,done_rows,removed_rows=diff_manifest(requests,manifest)
+            psummary("Incremental run: "+str(len(requests))+" new or changed rows, "+str(len(done_rows))+" rows already processed")
+            for key in removed_rows:
+                plog(key+" was processed in a previous run but is no longer requested - it will not be removed from the outputs")
+            #carry over the rows skipped in this run
+            for line in done_rows:
+                rows[row_key(line)]=manifest['rows'][row_key(line)]
+
+        self.load_suite(previous_outputs)
+
+        #Check that the opt/ files DO NOT contain any histfreq entries - these will break the CICE outputs
+        if not self.check_output:
+            with profiler.stage('check_histfreq_issues'):
+                self.check_histfreq_issues()
+        return({'requests':requests,
+                'rows':rows,
+                'manifest_file':manifest_file,
+                'output_dir':output_dir,
+                'previous_outputs':previous_outputs})
+
+
+    def process(self,job,progress=False):
+        '''
+        the diagnostic processing part of resolve() - adds every request in a job from prepare() to the components
+        returns the plan
+        '''
+        requests=job['requests']
+        rows=job['rows']
+        plog("----------------------------")
+        #loop over all cf variables
+        bar=ProgressBar(len(requests),enabled=progress)
+        with profiler.stage('diagnostics'):
+            for n,line in enumerate(requests):
+                events.row=row_key(line)
+                before=self.row_progress()
+                with profiler.diagnostic(row_key(line)):
+                    self.add_cf_diagnostic(line['variable'],line['time'],line['space'])
+                rows[row_key(line)]=self.row_outcome(line,before)
+                pevent('row',outcome=rows[row_key(line)]['outcome'])
+                bar.update(n+1)
+        events.row=None
+        bar.close()
+
+        components={'um':self.um,'nemo':self.nemo,'cice':self.cice}
+        return({'job_path':self.config['user']['job_path'],
+                'manifest_file':job['manifest_file'],
+                'output_dir':job['output_dir'],
+                'previous_outputs':job['previous_outputs'],
+                'rows':rows,
+                'added':{key:sorted(components[key].added) for key in components},
+                'missing':{key:sorted(components[key].missing) for key in components},
+                'outputs':{'um':os.path.join(job['output_dir'],output_filename(self.um.rose_stash)),
+                           'nemo':os.path.join(job['output_dir'],output_filename(self.nemo.ocean_xml_filename)),
+                           'cice':os.path.join(job['output_dir'],output_filename(self.cice.rose_cice))},
+                'components':components})
+
+
+    def apply(self,plan):
+        '''
+        write the outputs for a plan from resolve(), and the manifest of processed rows
+        only components that had diagnostics added are written
+        returns the files making up the current state of the suite, by component
+        '''
+        components=plan['components']
+        with profiler.stage('write'):
+            outputs=dict(plan['previous_outputs'])
+
+            if plan['added']['um']:
+                psummary(bold("UM diagnostics added: "+' '.join(plan['added']['um'])))
+                components['um'].write(plan['outputs']['um'])
+                outputs['um']=plan['outputs']['um']
+            else:
+                psummary(bold("No UM diagnostics added."))
+
+            if plan['added']['nemo']:
+                psummary(bold("NEMO diagnostics added: "+' '.join(plan['added']['nemo'])))
+                if 'nemo_files' in self.config:
+                    moves=components['nemo'].balance_files()
+                    if moves:
+                        psummary(bold("Moved "+str(len(moves))+" NEMO fields to keep the files within [nemo_files]"))
+                components['nemo'].write(plan['outputs']['nemo'])
+                outputs['nemo']=plan['outputs']['nemo']
+            else:
+                psummary(bold("No Nemo diagnostics added."))
+
+            if plan['added']['cice']:
+                psummary(bold("CICE diagnostics added: "+' '.join(plan['added']['cice'])))
+                components['cice'].write(plan['outputs']['cice'])
+                outputs['cice']=plan['outputs']['cice']
+            else:
+                psummary(bold("No CICE diagnostics added."))
+
+            write_manifest(plan['manifest_file'],{'version':MANIFEST_VERSION,
+                                                  'cf_diagnostics_file':self.config['user']['cf_diagnostics_file'],
+                                                  'inputs':self.manifest_inputs(),
+                                                  #relative to the output directory, as read_manifest() reads them
+                                                  'outputs':{key:os.path.relpath(path,plan['output_dir']) if plan['output_dir'] else path
+                                                             for key,path in outputs.items()},
+                                                  'rows':plan['rows']})
+        return(outputs)
+
+
+    def report_volume(self,plan,top=10):
+        '''
+        report the estimated output volume per model year of the additions in a plan, by stream
+        and the top most expensive additions
+        '''
+        volume=VolumeEstimator(self.config).estimate(plan['components'])
+        for addition in volume['additions']:
+            pevent('volume',**addition)
+        psummary("")
+        psummary("Estimated output per model year of the diagnostics added")
+        total=0
+        for stream,size in sorted(volume['streams'].items(),key=lambda item:-item[1]):
+            psummary(f'{stream:40} {human_bytes(size):>12}')
+            total+=size
+        psummary(f'{"total":40} {human_bytes(total):>12}')
+        if volume['additions']:
+            psummary("Largest additions")
+            for addition in sorted(volume['additions'],key=lambda addition:-addition['bytes'])[:top]:
+                psummary(f'{addition["component"]:5} {addition["diag"]:20} {addition["stream"]:30} {human_bytes(addition["bytes"]):>12}')
+        psummary("--------------------------")
+        return(volume)
+
+
+    def report_consolidation(self,kinds,compact=False):
+        '''
+        merge the equivalent time profiles (and/or domains) of the suite STASH, reporting the reduction
+        in the number the STASH requests use
+        if compact, also write the suite STASH with them merged to the usual UM output file
+        '''
+        plan=self.resolve([])
+        um=plan['components']['um']
+        labels={'time':('time profiles','tim_name'),'space':('domains','dom_name')}
+        results={}
+        for kind in kinds:
+            label,name_key=labels[kind]
+            before=len(set(getattr(request,name_key) for request in um.rose_stash_requests))
+            merged,removed=um.consolidate_sections(kind)
+            after=len(set(getattr(request,name_key) for request in um.rose_stash_requests))
+            psummary("")
+            if not merged:
+                psummary("There are no equivalent "+label+" in "+um.rose_source)
+            for kept,names in merged:
+                psummary(f'{kept:12} replaces '+' '.join(names))
+                pevent('consolidated',component='um',kind=kind,kept=kept,sections=names)
+            psummary(str(sum(len(names) for kept,names in merged))+" "+label+" merged, "+str(len(removed))+" duplicate requests removed")
+            psummary("The STASH requests use "+str(before)+" distinct "+label+" before and "+str(after)+" after")
+            psummary("--------------------------")
+            results[kind]={'merged':merged,'removed':removed,'before':before,'after':after}
+        if compact:
+            um.write(plan['outputs']['um'])
+            psummary(bold("Written "+plan['outputs']['um']))
+        return(results)
+
+
+    def report_nemo_layout(self,compact=False):
+        '''
+        split the NEMO output files of the suite to the [nemo_files] limits, reporting each field moved
+        if compact, also write the iodef xml to the usual NEMO output file
+        '''
+        if not 'nemo_files' in self.config:
+            perror("No [nemo_files] section in "+self.conf_file)
+            perror("Please add one, with max_fields (fields per file) and/or max_volume (GB per model year per file)")
+            exit()
+        plan=self.resolve([])
+        nemo=plan['components']['nemo']
+        moves=nemo.balance_files()
+        psummary("")
+        if not moves:
+            psummary("All the NEMO output files are within the [nemo_files] limits")
+        for name,source,target in moves:
+            psummary(f'{name:20} {source:10} -> {target}')
+        psummary(str(len(moves))+" fields moved")
+        psummary("--------------------------")
+        if compact:
+            nemo.write(plan['outputs']['nemo'])
+            psummary(bold("Written "+plan['outputs']['nemo']))
+        return(moves)
+
+
+    def cf_users(self,item):
+        '''
+        the cf variables that need item - a stash code, with or without its [constraints], or a nemo or cice field -
+        from the reverse index of the cf mappings
+        '''
+        index=self.reference_data('mapping_index')
+        if '[' in item:
+            return(sorted(index['constrained'].get(item,[])))
+        if re.fullmatch(r'm\d{2}s\d{2}i\d{3}',item):
+            return(sorted(index['stash'].get(item,[])))
+        return(sorted(index['fields'].get(item,[])))
+
+
+    def coverage(self,variables=None):
+        '''
+        which cf variables (all those mapped, or variables) the suite's existing output already satisfies -
+        every stash code they need is in its umstash_streq, and every field in its iodef xml or icefields_nml
+        this is presence at any frequency - the time and space domains are not compared
+        only the variables that need something the suite writes are checked, found from the reverse index
+        returns {'covered':[cf variables],'partial':{cf variable:[what is missing]},'uncovered':[cf variables]}
+        '''
+        index=self.reference_data('mapping_index')
+        plan=self.resolve([])
+        components=plan['components']
+        stash=components['um'].output_stash_codes()
+        fields=components['nemo'].output_fields()|components['cice'].output_fields()
+        wanted=set(index['requires'] if variables is None else variables)
+        candidates=set()
+        for code in stash:
+            candidates.update(index['stash'].get(code,[]))
+        for field in fields:
+            candidates.update(index['fields'].get(field,[]))
+        result={'covered':[],'partial':{},'uncovered':[]}
+        for name in sorted(wanted):
+            if name not in candidates or name not in index['requires']:
+                result['uncovered'].append(name)
+                continue
+            needs_stash,needs_fields=index['requires'][name]
+            missing=[code for code in needs_stash if code[:10] not in stash]+[field for field in needs_fields if field not in fields]
+            if missing:
+                result['partial'][name]=missing
+            else:
+                result['covered'].append(name)
+        return(result)
+
+
+    def report_coverage(self,variables=None):
+        #summary of the --coverage run
+        result=self.coverage(variables)
+        psummary("")
+        psummary("The existing output of "+self.config['user']['job_path']+" satisfies these cf variables")
+        psummary(' '.join(result['covered']))
+        psummary("--------------------------")
+        psummary("These cf variables need output the suite doesn't write")
+        for name,missing in result['partial'].items():
+            psummary(f'{name:20} {" ".join(missing)}')
+            pevent('coverage',diag=name,covered=False,missing=missing)
+        for name in result['covered']:
+            pevent('coverage',diag=name,covered=True,missing=[])
+        psummary("--------------------------")
+        psummary(str(len(result['covered']))+" covered, "+str(len(result['partial']))+" partly covered, "
+                 +str(len(result['uncovered']))+" not covered at all")
+        return(result)
+
+
+    def report_duplicates(self,compact=False):
+        '''
+        report the duplicate STASH requests already in the suite
+        if compact, also write the suite STASH without them to the usual UM output file
+        '''
+        plan=self.resolve([])
+        um=plan['components']['um']
+        duplicates=um.find_duplicate_stash_requests()
+        psummary("")
+        if not duplicates:
+            psummary("There are no duplicate STASH requests in "+um.rose_source)
+            return(duplicates)
+        psummary("The following STASH requests in "+um.rose_source+" are duplicates")
+        for kind,names in duplicates:
+            request=um.rose[names[0]]
+            stash_code='m01s'+str(request['isec']).zfill(2)+'i'+str(request['item']).zfill(3)
+            psummary(f'{kind:9} {stash_code:11} {request["tim_name"]} {request["dom_name"]} {request["use_name"]}')
+            for name in names:
+                psummary('          '+name)
+            pevent('duplicate',component='um',diag=stash_code,kind=kind,sections=names)
+        psummary(str(sum(len(names)-1 for kind,names in duplicates))+" requests could be removed")
+        psummary("--------------------------")
+        if compact:
+            removed=um.compact_stash_requests(duplicates)
+            um.write(plan['outputs']['um'])
+            psummary(bold("Removed "+str(len(removed))+" duplicate STASH requests, written "+plan['outputs']['um']))
+        return(duplicates)
+
+
+    def report_check_output(self):
+        #summary of the --check_output run
+        psummary("")
+        psummary("")
+        if self.um.nc_found:
+            psummary("The following STASH diagnostics were found in the output")
+            for i in self.um.nc_found:
+                psummary(f'{i[0]:10}  {i[1]} [{i[2]}] ')
+            psummary("--------------------------")
+
+        if self.nemo.nc_found:
+            psummary("The following NEMO diagnostics were found in the output")
+            for i in self.nemo.nc_found:
+                psummary(f'{i[0]:20}  {i[1]} [{i[2]}] ')
+            psummary("--------------------------")
+
+        if self.cice.nc_found:
+            psummary("The following CICE diagnostics were found in the output")
+            for i in self.cice.nc_found:
+                psummary(f'{i[0]:10}  {i[1]} [{i[2]}] ')
+            psummary("--------------------------")
+
+        psummary("")
+
+        if self.um.nc_missing:
+            psummary("The following STASH diagnostics are "+color.BOLD+" missing"+color.END+" from the output")
+            for i in self.um.nc_missing:
+                psummary(f'{i[0]:10}  {i[1]} [{i[2]}] ')
+            psummary("--------------------------")
+        else:
+            psummary("There were no missing STASH diagnostics")
+
+        if self.nemo.nc_missing:
+            psummary("The following NEMO diagnostics are "+color.BOLD+" missing"+color.END+" from the output")
+            for i in self.nemo.nc_missing:
+                psummary(f'{i[0]:20}  {i[1]} [{i[2]}] ')
+            psummary("--------------------------")
+        else:
+            psummary("There were no missing NEMO diagnostics")
+
+        if self.cice.nc_missing:
+            psummary("The following CICE diagnostics are "+color.BOLD+" missing"+color.END+" from the output")
+            for i in self.cice.nc_missing:
+                psummary(f'{i[0]:10}  {i[1]} [{i[2]}] ')
+            psummary("--------------------------")
+        else:
+            psummary("There were no missing CICE diagnostics")
+
+
+    def report_content(self):
+        #summary of the --check_content run, after the --check_output summary
+        results=self.check_content()
+        suspects=[result for result in results if result['suspect']]
+        psummary("")
+        if not suspects:
+            psummary("The content of all "+str(len(results))+" diagnostics found in the NC output looks reasonable")
+            return(results)
+        psummary("The following diagnostics found in the output are "+color.BOLD+" suspect"+color.END)
+        for result in suspects:
+            stats=result['stats']
+            psummary(f'{result["component"]:5} {result["diag"]:20}  {", ".join(result["suspect"])}  '
+                     f'[min {stats["min"]} max {stats["max"]}]')
+        psummary("--------------------------")
+        return(results)
+
+
+    def report_evaluation(self,variable_list):
+        #summary of the --evaluate run - each requested cf variable computed from the output
+        settings=self.config['check_content'] if 'check_content' in self.config else {}
+        max_missing=float(settings.get('max_missing','1'))
+        results=[self.evaluate(line['variable'],line['time']) for line in variable_list]
+        psummary("")
+        psummary("Evaluating the mapping expressions of "+str(len(results))+" requests against the output")
+        for result in results:
+            if result['reason']:
+                psummary(f'{result["diag"]:20} {result["freq"]:6}  '+color.BOLD+"not evaluated"+color.END+": "+result['reason'])
+                continue
+            suspect=content_suspect(result['stats'],max_missing)
+            stats=result['stats']
+            psummary(f'{result["diag"]:20} {result["freq"]:6}  {result["shape"]} [min {stats["min"]} max {stats["max"]}]'
+                     +('  '+color.BOLD+', '.join(suspect)+color.END if suspect else ''))
+        evaluated=len([result for result in results if not result['reason']])
+        psummary(str(evaluated)+" of "+str(len(results))+" requests evaluated")
+        psummary("--------------------------")
+        return(results)
+
+
+
+class ReferenceWatcher:
+    '''
+    watches the reference files of a session and reloads only the sources that have changed
+    a change is spotted by mtime or size, then confirmed by a digest of the contents, so a touched but
+    unchanged file is not reloaded
+    '''
+    def __init__(self,session):
+        self.session=session
+        self.state={} # file -> [mtime, size, digest]
+        for name,files in session.reference_files().items():
+            for file in files:
+                self.state[file]=self.stat(file)
+
+    def stat(self,file):
+        if not os.path.isfile(file):
+            return([None,None,None])
+        info=os.stat(file)
+        return([info.st_mtime_ns,info.st_size,file_digest(file)])
+
+    def changed(self,file):
+        #has file changed since we last looked? only hashes files whose mtime or size has changed
+        old=self.state.get(file,[None,None,None])
+        if not os.path.isfile(file):
+            new=[None,None,None]
+        else:
+            info=os.stat(file)
+            if [info.st_mtime_ns,info.st_size]==old[:2]:
+                return(False)
+            new=[info.st_mtime_ns,info.st_size,file_digest(file)]
+        self.state[file]=new
+        return(new[2]!=old[2])
+
+    def check(self):
+        '''
+        reload the reference sources whose files have changed
+        returns the names of the sources reloaded
+        '''
+        sources=self.session.reference_files()
+        #a file can be behind more than one source (the mappings files), so check each file once
+        files=[]
+        for name in sources:
+            files.extend([file for file in sources[name] if not file in files])
+        changed=[file for file in files if self.changed(file)]
+        reloaded=[]
+        for name in sources:
+            if any(file in changed for file in sources[name]):
+                plog(', '.join(file for file in sources[name] if file in changed)+" changed")
+                self.session.reload_reference(name)
+                reloaded.append(name)
+        return(reloaded)
+
+
+
+##################################
+
+def main():
+    parser = argparse.ArgumentParser(description='cf_to_um_diagnostics.py adds CF diagnostics to existing UM rose job')
+    parser.add_argument('-c', '--config',type=str)   
+    parser.add_argument('-s', '--stash',type=str,choices=['um','xios'])
+    parser.add_argument('-z', '--check_output')
+    parser.add_argument('--evaluate',action='store_true',
+                        help='with --check_output, also compute each requested cf variable from the output with its mapping expression')
+    parser.add_argument('--check_content',action='store_true',
+                        help='with --check_output, also read the data of each diagnostic found to report those all missing, all zero, constant or with NaNs (see [check_content])')
+    parser.add_argument('-i', '--incremental',action='store_true',
+                        help='only process rows of the cf diagnostics file that are new or changed since the last run')
+    parser.add_argument('-q', '--quiet',action='store_true',
+                        help='only show a progress bar, errors and the final summary on the console')
+    parser.add_argument('-v', '--verbose',action='store_true',
+                        help='also show debug messages on the console')
+    parser.add_argument('-d', '--duplicates',action='store_true',
+                        help='report the duplicate STASH requests already in the suite, rather than add diagnostics')
+    parser.add_argument('--consolidate',choices=['time','space','all'],
+                        help='merge the equivalent time profiles and/or domains in the suite STASH and report the reduction, rather than add diagnostics')
+    parser.add_argument('--nemo_layout',action='store_true',
+                        help='split the NEMO output files of the suite to the [nemo_files] limits, rather than add diagnostics')
+    parser.add_argument('--coverage',action='store_true',
+                        help='report which of the mapped cf variables the existing suite output already satisfies, rather than add diagnostics')
+    parser.add_argument('--users',type=str,
+                        help='list the cf variables that need this stash code (optionally with [constraints]) or nemo/cice field')
+    parser.add_argument('--compact',action='store_true',
+                        help='with --duplicates, --consolidate or --nemo_layout, also write the rewritten suite file')
+    parser.add_argument('--volume',action='store_true',
+                        help='report the estimated output volume per model year of the diagnostics added, by stream (see [resolution])')
+    parser.add_argument('-e', '--events',type=str,
+                        help='write a JSON-lines record of every diagnostic decision to this file')
+    parser.add_argument('-p', '--profile',action='store_true',
+                        help='report wall/cpu time for each stage and the slowest diagnostics')
+    parser.add_argument('--profile_memory',action='store_true',
+                        help='also report the peak traced memory of each stage with --profile - this slows the run, so the times are inflated')
+    parser.add_argument('--profile_top',type=int,default=10,
+                        help='number of slowest diagnostics to report with --profile')
+    parser.add_argument('--profile_dump',type=str,
+                        help='also write cProfile stats (readable with pstats) to this file')
+    parser.add_argument('--profile_json',type=str,
+                        help='also write the --profile breakdown to this file as json')
+
+    args = parser.parse_args()
+
+    if args.quiet:
+        start_console('quiet')
+    elif args.verbose:
+        start_console('verbose')
     else:
-        plog("There were no missing STASH diagnostics")
+        start_console('normal')
 
-    if nemo.nc_missing:
-        plog("The following NEMO diagnostics are "+color.BOLD+" missing"+color.END+" from the output")
-        for i in nemo.nc_missing:
-            plog(f'{i[0]:20}  {i[1]} [{i[2]}] ')
-        plog("--------------------------")
+    if args.events:
+        events.open(args.events)
+
+    if args.profile or args.profile_memory or args.profile_dump or args.profile_json:
+        profiler.start(args.profile_dump,args.profile_memory)
+        #report however we exit
+        atexit.register(profiler.finish,args.profile_top,args.profile_json)
+
+    if args.config:
+        conf_file=args.config
     else:
-        plog("There were no missing NEMO diagnostics")
+        conf_file='cf_to_um.conf'
 
-    if cice.nc_missing:
-        plog("The following CICE diagnostics are "+color.BOLD+" missing"+color.END+" from the output")
-        for i in cice.nc_missing:
-            plog(f'{i[0]:10}  {i[1]} [{i[2]}] ')
-        plog("--------------------------")
+    if args.stash:
+        stash_type=args.stash
     else:
-        plog("There were no missing CICE diagnostics")
+        stash_type='um'
 
-    exit()        
+    #read in main config file
+    #the check_output option allows use to check the netcdf/pp output 
+    with profiler.stage('config'):
+        session=Session(conf_file,stash_type,args.check_output)
 
+    #setup logging file
+    start_logging(session.config,conf_file)
+    #Now rose should have all the required time and space domains defined as in the freq_mappings and space_mappings
+    plog("Adding to the "+bold(stash_type)+" STASH, Nemo and CICE diagnostics")
+    plog("------------")
 
+    session.load_reference()
+
+    if args.duplicates:
+        session.report_duplicates(args.compact)
+        return()
+
+    if args.users:
+        users=session.cf_users(args.users)
+        psummary(args.users+" is used by "+str(len(users))+" cf variables: "+' '.join(users))
+        return()
+
+    if args.coverage:
+        session.report_coverage()
+        return()
+
+    if args.nemo_layout:
+        session.report_nemo_layout(args.compact)
+        return()
+
+    if args.consolidate:
+        kinds=['time','space'] if args.consolidate=='all' else [args.consolidate]
+        session.report_consolidation(kinds,args.compact)
+        return()
+
+    #read in cf variable list
+    with profiler.stage('read_cf_diagnostics'):
+        variable_list=session.read_cf_diagnostics()
+
+    plan=session.resolve(variable_list,incremental=args.incremental,progress=args.quiet)
+
+    if session.check_output:
+        session.report_check_output()
+        if args.check_content:
+            session.report_content()
+        if args.evaluate:
+            session.report_evaluation(variable_list)
+        return()
+
+    psummary(bold("UM diagnostics unable to add: "+' '.join(plan['missing']['um'])))
+    psummary(bold("Nemo diagnostics unable to add: "+' '.join(plan['missing']['nemo'])))
+    psummary(bold("CICE diagnostics unable to add: "+' '.join(plan['missing']['cice'])))
+    psummary("----------------------")
+
+    if args.volume:
+        session.report_volume(plan)
+
+    #write diagnostics definition files
+    session.apply(plan)
+
+
+if __name__=='__main__':
+    main()
 
-um.missing.sort()
-um.added.sort()
-nemo.missing.sort()
-nemo.added.sort()
-cice.missing.sort()
-cice.added.sort()
-        
-plog(bold("UM diagnostics unable to add: "+' '.join(um.missing)))
-plog(bold("Nemo diagnostics unable to add: "+' '.join(nemo.missing)))
-plog(bold("CICE diagnostics unable to add: "+' '.join(cice.missing)))
-plog("----------------------")
-
-
-#write diagnostics definition files
-#extract job name from filename
-pattern = r'/u-([a-zA-Z0-9-]+)/'
-jobname=re.search(pattern,um.rose_stash).group(1)
-#jobname=re.search(pattern,main_config['user']['job_path']).group(1)
-ice_conf="app/nemo_cice/rose-app.conf"
-um_nemo_conf="app/xml/rose-app.conf"
-um_output_filename=um.rose_stash.split('roses/')[-1].replace('/','__')
-ocean_output_filename=nemo.ocean_xml_filename.split('roses/')[-1].replace('/','__')
-cice_output_filename=cice.rose_cice.split('roses/')[-1].replace('/','__')
-
-um_flag=um.added!=[]
-nemo_flag=nemo.added!=[]
-cice_flag=cice.added!=[]
-
-
-if um_flag:
-    plog(bold("UM diagnostics added: "+' '.join(um.added)))
-    um.write(um_output_filename)
-else:
-    plog(bold("No UM diagnostics added."))
-         
-if nemo_flag:
-    plog(bold("NEMO diagnostics added: "+' '.join(nemo.added)))
-    nemo.write(ocean_output_filename)
-else:
-    plog(bold("No Nemo diagnostics added."))
-
-if cice_flag:
-    plog(bold("CICE diagnostics added: "+' '.join(cice.added)))
-    cice.write(cice_output_filename)
-else:
-    plog(bold("No CICE diagnostics added."))
-
-#ice_output_filename=jobname+'_'+ice_conf.replace('/','__')
-### NOT OUTPUTTING CORRECT UM CONF!!!
-
-exit()    
            
 # LBPROC Processing code. This indicates what processing has been done to the basic field. It should be
 #0 if no processing has been done, otherwise the relevant numbers from the list below are added together.
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+#bench_cf_to_um.py
+#
+#Benchmarks add_cf_to_um.py against synthetic, but realistic, inputs so that
+#performance can be compared between versions without a real u-xxxxx suite.
+#For each size a scratch directory is filled with:
+#  a suite (roses/u-bench/) with an app/xml/rose-app.conf holding N umstash_streq
+#  sections plus domain/time/usage/xios_streams sections, an iodef_nemo.xml with
+#  M fields, a nemo_cice/rose-app.conf and a rose-suite.conf
+#  a CMIP6 reference rose-app.conf, a STASHmaster_A slice, a field_def.xml,
+#  an ice_history_shared.F90 namelist, a mappings file with K expressions and a
+#  request CSV
+#add_cf_to_um.py is then run on these with --profile_json and the stage and
+#per-function (add_stash, get_domain, addOceanDiag, addIceDiag..) timings collected
+#usage: bench_cf_to_um.py -s 100,1000,5000 -o report.json [--compare old_report.json]
+
+
+import subprocess
+import argparse
+import random
+import shutil
+import tempfile
+import time
+import json
+import sys
+import os
+
+
+#level types (LevelT in STASHmaster) used for the synthetic stash codes, the CF
+#dimensions that request them and the rose domain they end up on
+#(LevelT, PseudT, dimension, domain)
+level_kinds=[(5,0,'longitude latitude time',"'DIAG'"),
+             (2,0,'longitude latitude alevel time',"'DALLTH'"),
+             (1,0,'longitude latitude alevhalf time',"'DALLRH'"),
+             (3,0,'longitude latitude plev19 time',"'PLEV19'"),
+             (6,0,'longitude latitude soil time',"'DSOIL'"),
+             (5,1,'longitude latitude typeli time',"'DTILE'")]
+
+#STASH sections to draw codes from - section 2 is avoided as COSP codes pull in extra requirements
+stash_sections=[0,1,3,4,5,8,9,16,19,20,26,30,33,34,50]
+
+#the domains add_cf_to_um.py expects to find in the CMIP6 reference (UM.space_mappings)
+base_domains={"'DIAG'":{'iopl':'5','plt':'0'},
+              "'DALLTH'":{'iopl':'2','ilevs':'1','levb':'1','levt':'85','plt':'0'},
+              "'DALLRH'":{'iopl':'1','ilevs':'1','levb':'1','levt':'85','plt':'0'},
+              "'PLEV8'":{'iopl':'3','plt':'0','rlevlst':'100000,85000,70000,50000,25000,10000,5000,1000'},
+              "'PLEV14'":{'iopl':'3','plt':'0','rlevlst':','.join(str(1000*i) for i in range(1,15))},
+              "'PLEV19'":{'iopl':'3','plt':'0','rlevlst':','.join(str(5000*i) for i in range(1,20))},
+              "'DSOIL'":{'iopl':'6','ilevs':'1','levb':'1','levt':'4','plt':'0'},
+              "'DSOIL1'":{'iopl':'6','ilevs':'1','levb':'1','levt':'1','plt':'0'},
+              "'DTILE'":{'iopl':'5','plt':'1','pslist':','.join(str(i) for i in range(1,28))}}
+
+#time profiles that match UM.tim_dom for mon and day means
+base_times={"'TMONMN'":{'ifre':'30','intv':'30','iopt':'1','isam':'1','istr':'30','ityp':'3','unt1':'3','unt2':'1','unt3':'3'},
+            "'TDAYMN'":{'ifre':'1','intv':'1','iopt':'1','isam':'1','istr':'1','ityp':'3','unt1':'3','unt2':'1','unt3':'3'}}
+
+base_usages={"'UPM'":'xios_upm',"'UPD'":'xios_upd'}
+
+#the freq of each time profile and the usage its streqs write to
+time_freq={"'TMONMN'":'mon',"'TDAYMN'":'day'}
+time_usage={"'TMONMN'":"'UPM'","'TDAYMN'":"'UPD'"}
+
+#NEMO grids for the synthetic ocean fields
+nemo_grids=['grid_T','grid_U','grid_V']
+
+
+def section_text(name,items):
+    text='['+name+']\n'
+    for key in sorted(items):
+        text+=key+'='+items[key]+'\n'
+    return(text+'\n')
+
+
+def hex_id(rng):
+    return('%08x' % rng.getrandbits(32))
+
+
+class SyntheticInputs:
+    '''
+    a complete set of synthetic inputs for add_cf_to_um.py in directory root
+    n_streq existing STASH requests, n_nemo NEMO fields, n_mappings CF mapping expressions and n_requests CSV rows
+    '''
+    def __init__(self,root,n_streq,n_nemo,n_mappings,n_requests,seed=1):
+        self.root=root
+        self.n_streq=n_streq
+        self.n_nemo=n_nemo
+        self.n_mappings=n_mappings
+        self.n_requests=n_requests
+        self.rng=random.Random(seed)
+        self.job_path=os.path.join(root,'roses','u-bench')+'/'
+        #enough stash codes for the existing requests and the mappings
+        n_codes=max(n_streq,2*n_mappings)+len(level_kinds)
+        self.stash_codes=[]
+        for i in range(n_codes):
+            isec=stash_sections[(i//999)%len(stash_sections)]
+            item=i%999+1
+            self.stash_codes.append((isec,item,level_kinds[i%len(level_kinds)]))
+        self.n_cice=max(4,n_nemo//4)
+
+    def write(self):
+        for path in ['app/xml/file','app/nemo_cice','app/um']:
+            os.makedirs(os.path.join(self.job_path,path),exist_ok=True)
+        self.write_stashmaster()
+        self.write_cmip6()
+        self.write_suite_stash()
+        self.write_field_def()
+        self.write_iodef()
+        self.write_cice()
+        self.write_mappings()
+        self.write_requests()
+        self.write_config()
+        return(self)
+
+    def path(self,name):
+        return(os.path.join(self.root,name))
+
+    def write_stashmaster(self):
+        lines=['H1| SUBMODEL_NUMBER=1\n','H2| FILE_TYPE=SYSTEM\n','H3| UM_VERSION=13.0\n','#\n']
+        for isec,item,(level,pseudo,dims,domain) in self.stash_codes:
+            pseudo_first,pseudo_last=(1,27) if pseudo else (0,0)
+            lines.append('1|    1 | %4d | %4d |SYNTHETIC %02d.%03d                      |\n' % (isec,item,isec,item))
+            lines.append('2|    0 |    0 |    1 |    1 | %4d |    1 |    2 | %4d | %4d | %4d |    0 |\n'
+                         % (level,pseudo,pseudo_first,pseudo_last))
+            lines.append('3| 000000000000000000000000000000 | 00000000000000000000 |    3 |\n')
+            lines.append('4|    1 | 0 | -99  -99  -99  -99  -99  -99  -99  -99  -99  -99 |\n')
+            lines.append('5|    0 | 1 |    0 |   65 |    0 |    0 |    0 |    0 |    0 |\n')
+        lines.append('1|   -1 |   -1 |   -1 |END OF FILE MARK                      |\n')
+        with open(self.path('STASHmaster_A'),'w') as outfile:
+            outfile.writelines(lines)
+
+    def domain_sections(self,extra):
+        '''
+        the base domains plus extra synthetic ones, as {section name: items}
+        '''
+        sections={}
+        for dom_name in base_domains:
+            items=dict(base_domains[dom_name])
+            items.update({'dom_name':dom_name,'imn':'1','imsk':'1','inth':'1','iwt':'1','ndiag':'0','opat':'1','plevs':'0','zonal':'0'})
+            sections['namelist:umstash_domain('+dom_name.strip("'").lower()+'_'+hex_id(self.rng)+')']=items
+        for i in range(extra):
+            items={'dom_name':"'DBEN%04d'" % i,'iopl':'2','ilevs':'1','levb':'1','levt':str(1+i%85),'plt':'0',
+                   'imn':'1','imsk':'1','inth':'1','iwt':'1','ndiag':'0','opat':'1','plevs':'0','zonal':'0'}
+            sections['namelist:umstash_domain(dben%04d_%s)' % (i,hex_id(self.rng))]=items
+        return(sections)
+
+    def time_sections(self,extra,xios=False):
+        sections={}
+        for tim_name in base_times:
+            items=dict(base_times[tim_name])
+            items['tim_name']=tim_name
+            if xios:
+                items['ts_enabled']='.false.'
+            sections['namelist:umstash_time('+tim_name.strip("'").lower()+'_'+hex_id(self.rng)+')']=items
+        for i in range(extra):
+            #instantaneous hourly profiles - these never match the mon/day mean filters
+            items={'tim_name':"'TBEN%04d'" % i,'ifre':str(1+i%24),'intv':'1','iopt':'1','isam':'1','istr':str(1+i%24),
+                   'ityp':'1','unt1':'2','unt2':'1','unt3':'2'}
+            if xios:
+                items['ts_enabled']='.false.'
+            sections['namelist:umstash_time(tben%04d_%s)' % (i,hex_id(self.rng))]=items
+        return(sections)
+
+    def usage_sections(self,extra):
+        sections={}
+        for use_name in base_usages:
+            items={'file_id':"'"+base_usages[use_name]+"'",'locn':'3','macrotag':'0','use_name':use_name}
+            sections['namelist:umstash_use('+use_name.strip("'").lower()+'_'+hex_id(self.rng)+')']=items
+        for i in range(extra):
+            items={'file_id':"'xios_upm'",'locn':'3','macrotag':'0','use_name':"'UBN%03d'" % i}
+            sections['namelist:umstash_use(ubn%03d_%s)' % (i,hex_id(self.rng))]=items
+        return(sections)
+
+    def streq_sections(self,n):
+        sections={}
+        for i in range(n):
+            isec,item,(level,pseudo,dims,domain)=self.stash_codes[i]
+            tim_name=list(base_times)[i%len(base_times)]
+            items={'dom_name':domain,'ens_name':"''",'isec':str(isec),'item':str(item),'package':"'BENCH'",
+                   'tim_name':tim_name,'use_name':time_usage[tim_name]}
+            sections['namelist:umstash_streq(%02d%03d_%s)' % (isec,item,hex_id(self.rng))]=items
+        return(sections)
+
+    def write_cmip6(self):
+        text='meta=um-atmos/vn13.0\n\n'
+        for sections in [self.domain_sections(0),self.time_sections(0),self.usage_sections(0),self.streq_sections(min(50,self.n_streq))]:
+            for name in sections:
+                text+=section_text(name,sections[name])
+        with open(self.path('rose-app.conf.cmip6'),'w') as outfile:
+            outfile.write(text)
+
+    def write_suite_stash(self):
+        '''
+        app/xml/rose-app.conf - the xios STASH read by UM and the iodef link read by Nemo
+        '''
+        text=section_text('command',{'default':'true'})
+        text+=section_text('file:iodef_nemo.xml',{'source':'(namespace)/iodef_nemo.xml'})
+        for stream in sorted(base_usages.values()):
+            items={'compression_level':'0','file_id':"'"+stream+"'",'filename_base':"'./${RUNID}a_"+stream.split('_')[-1]+"_'",
+                   'l_reinit':'.true.','output_freq_unit':'4','output_freq_value':'1','reinit_end':'-1','reinit_start':'0',
+                   'reinit_step':'1','reinit_unit':'4','time_counter':'centered_exclusive','timeseries':'none'}
+            text+=section_text('namelist:xios_streams('+stream+')',items)
+        extra=max(1,self.n_streq//20)
+        for sections in [self.domain_sections(extra),self.time_sections(extra,xios=True),
+                         self.usage_sections(max(1,self.n_streq//50)),self.streq_sections(self.n_streq)]:
+            for name in sections:
+                text+=section_text(name,sections[name])
+        with open(os.path.join(self.job_path,'app/xml/rose-app.conf'),'w') as outfile:
+            outfile.write(text)
+        with open(os.path.join(self.job_path,'rose-suite.conf'),'w') as outfile:
+            outfile.write(section_text('jinja2:suite.rc',{'EXPT_RESOURCES':"'bench'"}))
+
+    def nemo_field(self,i):
+        #field_def id, cmor name and grid of the i'th synthetic NEMO field
+        return('nf%05d' % i,'nfield%05d' % i,nemo_grids[i%len(nemo_grids)])
+
+    def write_field_def(self):
+        groups={grid:[] for grid in nemo_grids}
+        names=[]
+        for i in range(self.n_nemo):
+            field_id,name,grid=self.nemo_field(i)
+            groups[grid].append('    <field id="%s" long_name="synthetic field %d" unit="1" />\n' % (field_id,i))
+            names.append('    <field name="%s" field_ref="%s" />\n' % (name,field_id))
+        text='<?xml version="1.0"?>\n<field_definition level="1" prec="4" operation="average" enabled=".TRUE.">\n'
+        for grid in nemo_grids:
+            text+='  <field_group id="%s" grid_ref="%s_2D">\n' % (grid,grid)+''.join(groups[grid])+'  </field_group>\n'
+        text+='  <field_group id="cmor_names">\n'+''.join(names)+'  </field_group>\n</field_definition>\n'
+        with open(self.path('field_def.xml'),'w') as outfile:
+            outfile.write(text)
+
+    def write_iodef(self):
+        '''
+        half of the NEMO fields are already output monthly, the rest are only in field_def.xml
+        '''
+        cell_measures='<variable name="cell_measures" type="string">area: area</variable>'
+        files={grid:[] for grid in nemo_grids}
+        for i in range(0,self.n_nemo,2):
+            field_id,name,grid=self.nemo_field(i)
+            files[grid].append('        <field field_ref="%s" name="%s" >%s</field>\n' % (field_id,name,cell_measures))
+        text='<?xml version="1.0"?>\n<simulation>\n <context id="nemo">\n  <file_definition type="one_file" sync_freq="1d" min_digits="4">\n'
+        text+='   <file_group id="1m" output_freq="1mo" split_freq="1mo">\n'
+        for n,grid in enumerate(nemo_grids):
+            text+='    <file id="file%d" name_suffix="_%s" output_freq="1mo">\n' % (n+1,grid)+''.join(files[grid])+'    </file>\n'
+        text+='   </file_group>\n'
+        text+='   <file_group id="1d" output_freq="1d" split_freq="1mo">\n'
+        for n,grid in enumerate(nemo_grids):
+            field_id,name,grid=self.nemo_field(n)
+            text+='    <file id="file%d" name_suffix="_%s" output_freq="1d">\n' % (len(nemo_grids)+n+1,grid)
+            text+='        <field field_ref="%s" name="%s" >%s</field>\n' % (field_id,name,cell_measures)
+            text+='    </file>\n'
+        text+='   </file_group>\n'
+        #a commented out file, as left behind by hand editing
+        text+='   <!-- <file id="file99" name_suffix="_grid_W" output_freq="1mo"><field field_ref="nf_w" name="nfield_w" /></file> -->\n'
+        text+='  </file_definition>\n </context>\n</simulation>\n'
+        with open(os.path.join(self.job_path,'app/xml/file/iodef_nemo.xml'),'w') as outfile:
+            outfile.write(text)
+
+    def write_cice(self):
+        names=['f_cfield_%04d' % i for i in range(self.n_cice)]
+        text='      namelist / icefields_nml /     &\n'
+        for i in range(0,len(names),3):
+            chunk=names[i:i+3]
+            text+='           '+', '.join(chunk)+(' , &\n' if i+3<len(names) else '\n')
+        with open(self.path('ice_history_shared.F90'),'w') as outfile:
+            outfile.write('!synthetic icefields_nml\n'+text)
+        fields={}
+        for i,name in enumerate(names):
+            #a mix of off, daily and monthly fields
+            fields[name]=["'x'","'d'","'m'"][i%3]
+        text='meta=nemo-cice/vn5.1\n\n'
+        text+=section_text('namelist:icefields_nml',fields)
+        text+=section_text('namelist:setup_nml',{'histfreq':"'m','d','x','x','x'",'histfreq_n':'1,1,1,1,1'})
+        with open(os.path.join(self.job_path,'app/nemo_cice/rose-app.conf'),'w') as outfile:
+            outfile.write(text)
+
+    def write_mappings(self):
+        '''
+        K UM mappings (single codes and sums of two codes on the same levels),
+        plus ocean mappings that point back at themselves, as in the CDDS common_mappings.cfg
+        '''
+        text=''
+        n_kinds=len(level_kinds)
+        for i in range(self.n_mappings):
+            isec,item,(level,pseudo,dims,domain)=self.stash_codes[i]
+            expression='m01s%02di%03d[lbproc=128]' % (isec,item)
+            if i%4==3:
+                isec2,item2,kind2=self.stash_codes[i+n_kinds]
+                expression+=' + m01s%02di%03d[lbproc=128]' % (isec2,item2)
+            text+=section_text('atm_%05d' % i,{'component':'atmos','dimension':dims,'expression':expression,
+                                               'mip_table_id':'Amon','status':'ok','units':'1'})
+        for i in range(self.n_nemo):
+            name=self.nemo_field(i)[1]
+            text+=section_text(name,{'component':'ocean','dimension':'longitude latitude time','expression':name,
+                                     'mip_table_id':'Omon','status':'ok','units':'1'})
+        with open(self.path('mappings.cfg'),'w') as outfile:
+            outfile.write(text)
+
+    def write_requests(self):
+        '''
+        the request list - mostly atmosphere, with ocean and sea ice rows mixed in
+        '''
+        rows=[]
+        for i in range(self.n_requests):
+            freq=['mon','day'][(i//3)%2]
+            kind=i%5
+            if kind<3:
+                n=self.rng.randrange(self.n_mappings)
+                rows.append(('atm_%05d' % n,freq,self.stash_codes[n][2][2],'atmos'))
+            elif kind==3:
+                n=self.rng.randrange(self.n_nemo)
+                rows.append((self.nemo_field(n)[1],freq,'longitude latitude time','ocean'))
+            else:
+                n=self.rng.randrange(self.n_cice)
+                rows.append(('cfield_%04d' % n,freq,'longitude latitude time','seaIce'))
+        rows.append(('nfield_w','mon','longitude latitude time','ocean'))
+        with open(self.path('requests.csv'),'w') as outfile:
+            outfile.write('variable,time,space,realm\n')
+            for row in rows:
+                outfile.write('%s,%s,%s,%s\n' % row)
+
+    def write_config(self):
+        text=section_text('main',{'cmip6':self.path('rose-app.conf.cmip6'),
+                                  'stashmaster_A':self.path('STASHmaster_A'),
+                                  'mappings':self.path('mappings.cfg'),
+                                  'nemo_def':self.path('field_def.xml'),
+                                  'cice_diags':self.path('ice_history_shared.F90')})
+        text+=section_text('user',{'cf_diagnostics_file':self.path('requests.csv'),
+                                   'job_path':self.job_path,
+                                   'log_file':"'"+self.path('cf_to_um.log')+"'"})
+        with open(self.path('cf_to_um.conf'),'w') as outfile:
+            outfile.write(text)
+
+
+def run_pipeline(script,inputs,repeat):
+    '''
+    run add_cf_to_um.py over inputs, repeat times, returning the profile of the fastest run
+    '''
+    best=None
+    for i in range(repeat):
+        workdir=inputs.path('run%d' % i)
+        os.makedirs(workdir)
+        profile_file=os.path.join(workdir,'profile.json')
+        command=[sys.executable,script,'-c',inputs.path('cf_to_um.conf'),'-s','xios','-q','--profile_json',profile_file]
+        wall0=time.perf_counter()
+        result=subprocess.run(command,cwd=workdir,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL,text=True)
+        wall=time.perf_counter()-wall0
+        if result.returncode!=0 or not os.path.isfile(profile_file):
+            print(result.stdout)
+            print("add_cf_to_um.py failed on the synthetic inputs in "+inputs.root)
+            exit(1)
+        with open(profile_file) as infile:
+            profile=json.load(infile)
+        profile['wall']=wall
+        if best is None or wall<best['wall']:
+            best=profile
+    return(best)
+
+
+def print_report(report,baseline=None):
+    #one table per size, with the ratio to the baseline run of the same size if there is one
+    for size in report['sizes']:
+        result=report['results'][size]
+        base=baseline['results'].get(size) if baseline else None
+        print("")
+        print("size "+size+": "+', '.join(key+'='+str(result['inputs'][key]) for key in sorted(result['inputs'])))
+        print(f'{"":48} {"wall(s)":>9} {"calls":>8}'+(f' {"ratio":>7}' if base else ''))
+        rows=[('total',result['wall'],1,base['wall'] if base else None)]
+        for name in result['stages']:
+            old=base['stages'].get(name,{}).get('wall') if base else None
+            rows.append((name,result['stages'][name]['wall'],result['stages'][name]['calls'],old))
+        for name in sorted(result['functions']):
+            old=base['functions'].get(name,{}).get('wall') if base else None
+            rows.append((name+'()',result['functions'][name]['wall'],result['functions'][name]['calls'],old))
+        for name,wall,calls,old in rows:
+            label='  '*name.count('/')+name.split('/')[-1]
+            line=f'{label:48} {wall:9.3f} {calls:8d}'
+            if base:
+                line+=f' {wall/old:7.2f}' if old else f' {"-":>7}'
+            print(line)
+
+
+def main():
+    parser=argparse.ArgumentParser(description='benchmark add_cf_to_um.py on synthetic suites of increasing size')
+    parser.add_argument('-s','--sizes',type=str,default='100,1000,5000',
+                        help='comma separated list of sizes N - the number of existing umstash_streq sections')
+    parser.add_argument('--nemo',type=float,default=0.25,help='NEMO fields per streq')
+    parser.add_argument('--mappings',type=float,default=0.5,help='UM mapping expressions per streq')
+    parser.add_argument('--requests',type=float,default=0.2,help='request rows per streq')
+    parser.add_argument('-r','--repeat',type=int,default=3,help='runs per size - the fastest is reported')
+    parser.add_argument('--seed',type=int,default=1)
+    parser.add_argument('-o','--output',type=str,help='write the report to this json file')
+    parser.add_argument('--compare',type=str,help='json report from a previous version to compare against')
+    parser.add_argument('--keep',type=str,help='keep the synthetic inputs in this directory')
+    args=parser.parse_args()
+
+    script=os.path.join(os.path.dirname(os.path.abspath(__file__)),'add_cf_to_um.py')
+    sizes=[int(size) for size in args.sizes.split(',')]
+    report={'sizes':[str(size) for size in sizes],'results':{}}
+    for size in sizes:
+        root=tempfile.mkdtemp(prefix='bench_cf_to_um_%d_' % size,dir=args.keep)
+        n_nemo=max(4,int(size*args.nemo))
+        n_mappings=max(len(level_kinds),int(size*args.mappings))
+        n_requests=max(5,int(size*args.requests))
+        print("Generating size %d in %s" % (size,root))
+        inputs=SyntheticInputs(root,size,n_nemo,n_mappings,n_requests,args.seed).write()
+        print("Running add_cf_to_um.py x%d" % args.repeat)
+        profile=run_pipeline(script,inputs,args.repeat)
+        profile['inputs']={'streq':size,'nemo':n_nemo,'mappings':n_mappings,'requests':n_requests}
+        report['results'][str(size)]=profile
+        if not args.keep:
+            shutil.rmtree(root)
+
+    baseline=None
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline=json.load(infile)
+    print_report(report,baseline)
+    if args.output:
+        with open(args.output,'w') as outfile:
+            json.dump(report,outfile,indent=1)
+        print("Written "+args.output)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+#cf_to_um_async.py
+#
+#Runs several add_cf_to_um resolution and --check_output validation jobs concurrently from one process
+#The reference data is read once and shared by every job. The file reading of each job - forking the session,
+#the suite rose-app.conf files and iodef xml, and the netcdf output to check - runs in threads, so slow reads from
+#a shared filesystem overlap. Everything after the reading - the diagnostic processing, the content check and
+#writing the outputs - is CPU bound and runs one job at a time, under one lock
+#The profiler and event log the reading stages share are thread safe; logging is too
+#
+#usage:  cf_to_um_async.py -c cf_to_um.conf -s xios jobs.json [-j 4]
+#
+#jobs.json is a list of jobs, each a JSON object:
+#  {"name":"u-cx749",                      (optional - used in the report, default the job number)
+#   "requests":[{"variable":"tas","time":"mon","space":"longitude latitude time"},..]  or  "csv":"my_request.csv"
+#                                          (default [user]:cf_diagnostics_file)
+#   "job_path":"../roses/u-cx749/"         (optional - defaults to [user]:job_path)
+#   "incremental":false                    (optional - see add_cf_to_um.py -i)
+#   "write":false                          (optional - also write the outputs and manifest)
+#   "check_output":"/path/to/nc/output"    (optional - validate this output rather than resolve, see add_cf_to_um.py -z)
+#   "check_content":false}                 (optional - also check the data of what is found, see add_cf_to_um.py --check_content)
+#A job reports {"name":..,"ok":true,"plan":{..},"outputs":{..},"elapsed":..} or {"name":..,"ok":false,"error":".."}
+#and a validation job reports "found" and "missing" in place of "plan", and "suspect" with check_content
+#
+#from python:
+#  runner=AsyncRunner('cf_to_um.conf','xios',concurrency=4)
+#  results=asyncio.run(runner.run([{'csv':'a.csv','job_path':'../roses/u-aa001/'},{'check_output':'/data/u-aa001'}]))
+
+
+import contextvars
+import argparse
+import logging
+import asyncio
+import json
+import time
+import csv
+import sys
+import os
+
+import add_cf_to_um as cf_to_um
+from cf_to_um_daemon import plan_json
+
+
+#the error messages of the job running in this task or thread - see JobErrors
+job_errors=contextvars.ContextVar('job_errors',default=None)
+
+
+class JobErrors(logging.Handler):
+    '''
+    sends each error message logged to the job that logged it
+    asyncio.to_thread() carries the task's context into the thread, so job_errors follows the job
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self,logging.ERROR)
+
+    def emit(self,record):
+        messages=job_errors.get()
+        if messages is not None and record.getMessage():
+            messages.append(record.getMessage())
+
+
+class AsyncRunner:
+    '''
+    runs resolution and validation jobs concurrently against forks of one Session
+    at most concurrency jobs are in progress at once, and only one of them past its reading - see run_job
+    '''
+    def __init__(self,conf_file='cf_to_um.conf',stash_type='um',concurrency=4):
+        self.conf_file=conf_file
+        self.stash_type=stash_type
+        self.concurrency=concurrency
+        self.session=None
+
+    async def start(self):
+        #read the config and the cf mappings - every job needs them
+        if self.session is not None:
+            return()
+        self.session=await asyncio.to_thread(cf_to_um.Session,self.conf_file,self.stash_type)
+        await asyncio.to_thread(self.session.load_reference)
+        cf_to_um.log.addHandler(JobErrors())
+
+    def read_requests(self,job,session):
+        if 'requests' in job:
+            requests=job['requests']
+        else:
+            file=job.get('csv',session.config['user']['cf_diagnostics_file'])
+            if not os.path.isfile(file):
+                cf_to_um.perror("CF Diagnostics CSV file "+file+" does not exist")
+                exit()
+            with open(file,'r') as infile:
+                requests=list(csv.DictReader(infile))
+        for line in requests:
+            for key in ['variable','time','space']:
+                if not key in line:
+                    cf_to_um.perror("request "+json.dumps(line)+" has no "+key)
+                    exit()
+        return(requests)
+
+    async def run_job(self,job,processing):
+        '''
+        run one job - the reading in a thread, then the processing, content check and writing in a thread
+        once processing (a lock) is free
+        '''
+        t0=time.perf_counter()
+        messages=[]
+        job_errors.set(messages)
+        try:
+            session=await asyncio.to_thread(self.session.fork,job.get('check_output'))
+            requests=await asyncio.to_thread(self.read_requests,job,session)
+            prepared=await asyncio.to_thread(session.prepare,requests,
+                                             job.get('job_path'),job.get('incremental',False))
+            async with processing:
+                plan=await asyncio.to_thread(session.process,prepared)
+                if session.check_output:
+                    components=plan['components']
+                    reply={'ok':True,
+                           'found':{key:components[key].nc_found for key in components},
+                           'missing':{key:components[key].nc_missing for key in components}}
+                    if job.get('check_content',False):
+                        results=await asyncio.to_thread(session.check_content)
+                        reply['suspect']=[{'component':result['component'],'diag':result['diag'],'reasons':result['suspect']}
+                                          for result in results if result['suspect']]
+                else:
+                    reply={'ok':True,'plan':plan_json(plan)}
+                    if job.get('write',False):
+                        reply['outputs']=await asyncio.to_thread(session.apply,plan)
+        except (SystemExit,Exception) as error:
+            message=' '.join(messages) if messages else repr(error)
+            reply={'ok':False,'error':message}
+        reply['elapsed']=time.perf_counter()-t0
+        return(reply)
+
+    async def run(self,jobs):
+        '''
+        run all of jobs, returning a reply for each in the same order
+        '''
+        await self.start()
+        slots=asyncio.Semaphore(self.concurrency)
+        processing=asyncio.Lock()
+
+        async def bounded(n,job):
+            async with slots:
+                reply=await self.run_job(job,processing)
+            reply['name']=job.get('name',str(n))
+            if reply['ok']:
+                cf_to_um.psummary("Job "+reply['name']+" done in "+f'{reply["elapsed"]:.2f}'+"s")
+            else:
+                cf_to_um.perror("Job "+reply['name']+" failed: "+reply['error'])
+            return(reply)
+
+        return(await asyncio.gather(*[bounded(n,job) for n,job in enumerate(jobs)]))
+
+
+def main():
+    parser=argparse.ArgumentParser(description='run several add_cf_to_um.py resolution and validation jobs concurrently')
+    parser.add_argument('jobs',type=str,help='JSON file holding a list of jobs')
+    parser.add_argument('-c','--config',type=str,default='cf_to_um.conf')
+    parser.add_argument('-s','--stash',type=str,choices=['um','xios'],default='um')
+    parser.add_argument('-j','--concurrency',type=int,default=4,help='number of jobs in progress at once')
+    parser.add_argument('-o','--output',type=str,help='write the replies to this JSON file, rather than print them')
+    parser.add_argument('-v','--verbose',action='store_true',help='show the library messages on the console')
+    args=parser.parse_args()
+
+    if args.verbose:
+        cf_to_um.start_console('verbose')
+    else:
+        cf_to_um.start_console('quiet')
+    #the library drops into pdb in some unexpected cases - make sure that can't hang a job
+    sys.stdin=open(os.devnull)
+    cf_to_um.start_logging(cf_to_um.read_config(args.config),args.config)
+
+    with open(args.jobs) as infile:
+        jobs=json.load(infile)
+    runner=AsyncRunner(args.config,args.stash,args.concurrency)
+    replies=asyncio.run(runner.run(jobs))
+    if args.output:
+        with open(args.output,'w') as outfile:
+            json.dump(replies,outfile,indent=1)
+    else:
+        print(json.dumps(replies,indent=1))
+    if not all(reply['ok'] for reply in replies):
+        exit(1)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+#cf_to_um_daemon.py
+#
+#Keeps one add_cf_to_um Session warm - the CF mappings, STASHmaster_A, CMIP6 reference conf,
+#NEMO field_def xml and CICE namelist are read once - and answers requests to resolve CF variables
+#against a suite over a Unix socket or HTTP on localhost
+#Reference files are checked for changes before each request - only the sources that have changed are re-read
+#
+#serve:  cf_to_um_daemon.py serve -c cf_to_um.conf -s xios --socket /tmp/cf_to_um.sock
+#        cf_to_um_daemon.py serve -c cf_to_um.conf -s xios --port 8765
+#query:  cf_to_um_daemon.py query --socket /tmp/cf_to_um.sock --csv my_request.csv [--write] [--job_path ../roses/u-cx749/]
+#
+#The socket is created readable and writable only by the user running the daemon. Over HTTP every request must
+#carry the token in --token_file (created with a random token if it does not exist, and refused unless only the
+#user can read it) as 'Authorization: Bearer <token>'
+#The csv, job_path and output_dir of a request must be absolute paths under the daemon's working directory,
+#the directory of [user]:job_path or an --allow directory
+#
+#A request is a JSON object:
+#  {"requests":[{"variable":"tas","time":"mon","space":"longitude latitude time"},..]  or  "csv":"my_request.csv"
+#   "job_path":"../roses/u-cx749/"   (optional - defaults to [user]:job_path)
+#   "incremental":false              (optional - skip rows already processed, see add_cf_to_um.py -i)
+#   "write":false                    (optional - also write the outputs and manifest)
+#   "output_dir":"."}                (optional - where outputs and the manifest are written and read, default the daemon's working directory)
+#The reply is {"ok":true,"plan":{..},"outputs":{..},"reloaded":[..],"elapsed":..} or {"ok":false,"error":".."}
+#Over the socket requests and replies are one JSON object per line; over HTTP POST the request to /resolve,
+#GET /status reports what reference data is loaded
+
+
+import http.server
+import socketserver
+import argparse
+import logging
+import secrets
+import hmac
+import socket
+import json
+import time
+import csv
+import sys
+import os
+
+import add_cf_to_um as cf_to_um
+
+
+def plan_json(plan):
+    #the plan without the UM, Nemo and CICE components, which can't be sent
+    return({key:plan[key] for key in plan if key!='components'})
+
+
+class ErrorCollector(logging.Handler):
+    '''
+    collects the error messages logged while handling one request, to send back with the reply
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self,logging.ERROR)
+        self.messages=[]
+
+    def emit(self,record):
+        if record.getMessage():
+            self.messages.append(record.getMessage())
+
+
+class Daemon:
+    '''
+    a warm Session and a watcher on the reference files it has read
+    '''
+    def __init__(self,conf_file,stash_type,allow=[]):
+        self.session=cf_to_um.Session(conf_file,stash_type)
+        cf_to_um.start_logging(self.session.config,conf_file)
+        self.default_job_path=self.session.config['user']['job_path']
+        #the directories the paths in a request may be under
+        self.allowed=[os.path.realpath(path) for path in
+                      [os.getcwd(),os.path.dirname(os.path.abspath(self.default_job_path.rstrip('/')))]+allow]
+        self.started=time.time()
+        self.served=0
+        t0=time.perf_counter()
+        self.session.load_reference()
+        #a first resolve of nothing reads the rest of the reference data
+        self.session.resolve([])
+        self.watcher=cf_to_um.ReferenceWatcher(self.session)
+        cf_to_um.psummary("Reference data loaded in "+f'{time.perf_counter()-t0:.2f}'+"s")
+
+    def check_reference(self):
+        #re-read any reference sources whose files have changed
+        reloaded=self.watcher.check()
+        if reloaded:
+            cf_to_um.psummary("Reloaded "+' '.join(reloaded))
+        return(reloaded)
+
+    def check_path(self,key,path,directory):
+        '''
+        the real path of path from a request, if it is an absolute path to an existing file or directory
+        under one of the allowed directories - otherwise the request fails
+        '''
+        if not isinstance(path,str) or not os.path.isabs(path):
+            cf_to_um.perror("request "+key+" must be an absolute path, not "+json.dumps(path))
+            exit()
+        real=os.path.realpath(path)
+        if not any(os.path.commonpath([real,allowed])==allowed for allowed in self.allowed):
+            cf_to_um.perror("request "+key+" "+path+" is not under "+' '.join(self.allowed))
+            exit()
+        if directory and not os.path.isdir(real):
+            cf_to_um.perror("request "+key+" "+path+" is not a directory")
+            exit()
+        if not directory and not os.path.isfile(real):
+            cf_to_um.perror("request "+key+" "+path+" is not a file")
+            exit()
+        return(real)
+
+    def read_csv(self,file):
+        if not os.path.isfile(file):
+            cf_to_um.perror("CF Diagnostics CSV file "+file+" does not exist")
+            exit()
+        with open(file,'r') as infile:
+            return(list(csv.DictReader(infile)))
+
+    def handle(self,request):
+        '''
+        resolve one request, returning the reply
+        errors from the library are reported with perror() then exit(), so SystemExit is caught here
+        '''
+        t0=time.perf_counter()
+        errors=ErrorCollector()
+        cf_to_um.log.addHandler(errors)
+        try:
+            reloaded=self.check_reference()
+            if 'csv' in request:
+                requests=self.read_csv(self.check_path('csv',request['csv'],False))
+            else:
+                requests=request.get('requests',[])
+            for line in requests:
+                for key in ['variable','time','space']:
+                    if not key in line:
+                        cf_to_um.perror("request "+json.dumps(line)+" has no "+key)
+                        exit()
+            job_path=self.default_job_path
+            if 'job_path' in request:
+                job_path=self.check_path('job_path',request['job_path'],True)+'/'
+            output_dir=os.getcwd()
+            if 'output_dir' in request:
+                output_dir=self.check_path('output_dir',request['output_dir'],True)
+            #the manifest and outputs are found in, and written to, output_dir - the process cwd is never changed
+            plan=self.session.resolve(requests,job_path=job_path,
+                                      incremental=request.get('incremental',False),
+                                      output_dir=output_dir)
+            reply={'ok':True,'plan':plan_json(plan),'reloaded':reloaded}
+            if request.get('write',False):
+                reply['outputs']=self.session.apply(plan)
+        except (SystemExit,Exception) as error:
+            message=' '.join(errors.messages) if errors.messages else repr(error)
+            cf_to_um.perror("Request failed: "+message)
+            reply={'ok':False,'error':message}
+        finally:
+            cf_to_um.log.removeHandler(errors)
+        self.served+=1
+        reply['elapsed']=time.perf_counter()-t0
+        return(reply)
+
+    def status(self):
+        return({'ok':True,
+                'config':self.session.conf_file,
+                'stash':self.session.stash_type,
+                'job_path':self.default_job_path,
+                'reference':sorted(self.session.reference),
+                'served':self.served,
+                'uptime':time.time()-self.started})
+
+
+def read_token(token_file):
+    '''
+    the token HTTP requests must carry, from token_file - a new random token is written there if it does not exist
+    '''
+    if not os.path.exists(token_file):
+        with os.fdopen(os.open(token_file,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o600),'w') as outfile:
+            outfile.write(secrets.token_hex(32)+'\n')
+    if os.stat(token_file).st_mode & 0o077:
+        cf_to_um.perror("Token file "+token_file+" can be read by other users - chmod 600 it")
+        exit()
+    with open(token_file,'r') as infile:
+        token=infile.read().strip()
+    if not token:
+        cf_to_um.perror("Token file "+token_file+" is empty")
+        exit()
+    return(token)
+
+
+def socket_handler(daemon,timeout):
+    class Handler(socketserver.StreamRequestHandler):
+        #one JSON request per line, one JSON reply per line
+        #a client that sends nothing for timeout seconds is dropped, so it can't hold up the other clients
+        def handle(self):
+            try:
+                self.handle_lines()
+            except TimeoutError:
+                cf_to_um.pdebug("Client timed out after "+str(timeout)+"s")
+
+        def handle_lines(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request=json.loads(line)
+                except ValueError as error:
+                    reply={'ok':False,'error':'bad request: '+str(error)}
+                else:
+                    if request.get('status'):
+                        reply=daemon.status()
+                    else:
+                        reply=daemon.handle(request)
+                self.wfile.write((json.dumps(reply)+'\n').encode(encoding="utf8"))
+                self.wfile.flush()
+    Handler.timeout=timeout
+    return(Handler)
+
+
+def http_handler(daemon,token,timeout):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self,code,reply):
+            body=json.dumps(reply).encode(encoding="utf8")
+            self.send_response(code)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def authorised(self):
+            if hmac.compare_digest(self.headers.get('Authorization',''),'Bearer '+token):
+                return(True)
+            self.reply(401,{'ok':False,'error':'missing or wrong token'})
+            return(False)
+
+        def do_GET(self):
+            if not self.authorised():
+                return()
+            if self.path=='/status':
+                self.reply(200,daemon.status())
+            else:
+                self.reply(404,{'ok':False,'error':'unknown path '+self.path})
+
+        def do_POST(self):
+            if not self.authorised():
+                return()
+            if self.path!='/resolve':
+                self.reply(404,{'ok':False,'error':'unknown path '+self.path})
+                return()
+            try:
+                request=json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+            except ValueError as error:
+                self.reply(400,{'ok':False,'error':'bad request: '+str(error)})
+                return()
+            self.reply(200,daemon.handle(request))
+
+        def log_message(self,format,*args):
+            cf_to_um.pdebug(self.address_string()+' '+format % args)
+    Handler.timeout=timeout
+    return(Handler)
+
+
+def serve(args):
+    if args.verbose:
+        cf_to_um.start_console('verbose')
+    else:
+        cf_to_um.start_console('quiet')
+    #the library drops into pdb in some unexpected cases - make sure that can't hang the daemon
+    sys.stdin=open(os.devnull)
+    allow=[os.path.abspath(path) for path in args.allow]
+    if args.port:
+        token=read_token(args.token_file)
+    daemon=Daemon(args.config,args.stash,allow)
+    if args.port:
+        #localhost only
+        server=http.server.HTTPServer(('127.0.0.1',args.port),http_handler(daemon,token,args.timeout))
+        cf_to_um.psummary("Serving on http://127.0.0.1:"+str(args.port))
+    else:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        #the socket is created 0600 - there is no window where another user could connect to it
+        umask=os.umask(0o177)
+        try:
+            server=socketserver.UnixStreamServer(args.socket,socket_handler(daemon,args.timeout))
+        finally:
+            os.umask(umask)
+        cf_to_um.psummary("Serving on "+args.socket)
+    #requests are handled one at a time - the session is not shared between threads
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not args.port and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def query(args):
+    request={}
+    if args.status:
+        request['status']=True
+    elif args.csv:
+        request['csv']=os.path.abspath(args.csv)
+    else:
+        print("query needs --csv or --status")
+        exit(1)
+    if args.job_path:
+        request['job_path']=os.path.abspath(args.job_path)+'/'
+    #the outputs and manifest are in the directory the query is run from
+    request['output_dir']=os.getcwd()
+    if args.write:
+        request['write']=True
+    if args.incremental:
+        request['incremental']=True
+    if args.port:
+        import urllib.request
+        import urllib.error
+        with open(args.token_file,'r') as infile:
+            headers={'Authorization':'Bearer '+infile.read().strip()}
+        if args.status:
+            http_request=urllib.request.Request('http://127.0.0.1:'+str(args.port)+'/status',headers=headers)
+        else:
+            http_request=urllib.request.Request('http://127.0.0.1:'+str(args.port)+'/resolve',headers=headers,
+                                                data=json.dumps(request).encode(encoding="utf8"))
+        try:
+            reply=urllib.request.urlopen(http_request).read()
+        except urllib.error.HTTPError as error:
+            reply=error.read()
+        reply=json.loads(reply)
+    else:
+        with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as client:
+            client.connect(args.socket)
+            stream=client.makefile('rwb')
+            stream.write((json.dumps(request)+'\n').encode(encoding="utf8"))
+            stream.flush()
+            reply=json.loads(stream.readline())
+    print(json.dumps(reply,indent=1))
+    if not reply.get('ok'):
+        exit(1)
+
+
+def main():
+    parser=argparse.ArgumentParser(description='serve add_cf_to_um.py diagnostic resolution requests from a warm process')
+    commands=parser.add_subparsers(dest='command',required=True)
+    serve_parser=commands.add_parser('serve',help='load the reference data and serve requests')
+    serve_parser.add_argument('-c','--config',type=str,default='cf_to_um.conf')
+    serve_parser.add_argument('-s','--stash',type=str,choices=['um','xios'],default='um')
+    serve_parser.add_argument('-v','--verbose',action='store_true',help='show the library messages on the console')
+    serve_parser.add_argument('--allow',type=str,action='append',default=[],
+                              help='a directory the paths in requests may be under, as well as the working directory and the suites directory')
+    serve_parser.add_argument('--timeout',type=float,default=30,
+                              help='seconds to wait for a client to send a request before dropping the connection')
+    query_parser=commands.add_parser('query',help='send a request to a running daemon and print the reply')
+    query_parser.add_argument('--csv',type=str,help='cf diagnostics file to resolve')
+    query_parser.add_argument('--job_path',type=str,help='suite to resolve against, instead of [user]:job_path')
+    query_parser.add_argument('--write',action='store_true',help='write the outputs to the current directory')
+    query_parser.add_argument('-i','--incremental',action='store_true')
+    query_parser.add_argument('--status',action='store_true',help='report the state of the daemon')
+    for sub in [serve_parser,query_parser]:
+        sub.add_argument('--socket',type=str,default='cf_to_um.sock',help='Unix socket to serve on / connect to')
+        sub.add_argument('--port',type=int,help='use HTTP on this localhost port instead of the Unix socket')
+        sub.add_argument('--token_file',type=str,default='cf_to_um.token',help='with --port, the file holding the token for HTTP requests')
+    args=parser.parse_args()
+    if args.command=='serve':
+        serve(args)
+    else:
+        query(args)
+
+
+if __name__=='__main__':
+    main()